@@ -0,0 +1,72 @@
+"""
+Benchmark computing the dot products with the reference spectra through the
+reference peak index versus with individual `dot` calls.
+
+Usage (with GLEAMS_HOME set):
+    python benchmarks/bench_dot.py [PEAK_FILE [FRAGMENT_MZ_TOL]]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+from gleams import config
+from gleams.feature import spectrum
+from gleams.ms_io import ms_io
+from gleams.ms_io.spectrum_batch import SpectrumBatch
+
+
+_ref_filename = os.path.join(os.path.dirname(__file__), os.pardir, 'data',
+                             'gleams_reference_spectra.mgf')
+
+
+def _get_spectra(filename):
+    batch = spectrum.preprocess_batch(
+        SpectrumBatch.from_spectra(ms_io.get_spectra(filename)),
+        config.fragment_mz_min, config.fragment_mz_max)
+    return batch[np.nonzero(batch.is_valid)[0]]
+
+
+def main(filename, fragment_mz_tol):
+    refs = _get_spectra(_ref_filename)
+    queries = _get_spectra(filename)
+    index = spectrum.get_peak_index(refs.mz, refs.intensity, refs.offsets,
+                                    fragment_mz_tol)
+    ref_peaks = [refs.get_peaks(i) for i in range(len(refs))]
+    # Compile the kernels.
+    mz, intensity = queries.get_peaks(0)
+    spectrum.dot(mz, intensity, mz, intensity, fragment_mz_tol)
+    spectrum.dot_index(mz, intensity, *index, fragment_mz_tol)
+    num_dot = min(len(queries), 200)
+    start = time.perf_counter()
+    for i in range(num_dot):
+        mz, intensity = queries.get_peaks(i)
+        for ref_mz, ref_intensity in ref_peaks:
+            spectrum.dot(ref_mz, ref_intensity, mz, intensity,
+                         fragment_mz_tol)
+    time_dot = (time.perf_counter() - start) / num_dot
+    start = time.perf_counter()
+    for i in range(len(queries)):
+        spectrum.dot_index(*queries.get_peaks(i), *index, fragment_mz_tol)
+    time_index = (time.perf_counter() - start) / len(queries)
+    scores = np.zeros((len(queries), len(refs)), np.float32)
+    spectrum.dot_index_batch(queries.mz[:0], queries.intensity[:0],
+                             queries.offsets[:1], *index, fragment_mz_tol,
+                             scores[:0])
+    start = time.perf_counter()
+    spectrum.dot_index_batch(queries.mz, queries.intensity, queries.offsets,
+                             *index, fragment_mz_tol, scores)
+    time_batch = (time.perf_counter() - start) / len(queries)
+    print(f'{filename} ({len(queries)} spectra, {len(refs)} reference '
+          f'spectra, fragment m/z tolerance {fragment_mz_tol})')
+    print(f'  dot:             {time_dot * 1e3:7.3f} ms/spectrum')
+    print(f'  dot_index:       {time_index * 1e3:7.3f} ms/spectrum '
+          f'({time_dot / time_index:.1f}x)')
+    print(f'  dot_index_batch: {time_batch * 1e3:7.3f} ms/spectrum '
+          f'({time_dot / time_batch:.1f}x)')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else _ref_filename,
+         float(sys.argv[2]) if len(sys.argv) > 2 else config.fragment_mz_tol)
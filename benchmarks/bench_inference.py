@@ -0,0 +1,114 @@
+"""
+Benchmark embedding spectra using the NumPy inference engine, with the first
+fragment convolutional layers evaluated selectively on the sparse fragment
+encodings and densely, versus using Keras (if it's available).
+
+The spectra are embedded by a GLEAMS model with random weights, which is
+built using Keras if it's available.
+
+Usage (with GLEAMS_HOME set):
+    python benchmarks/bench_inference.py [PEAK_FILE [NUM_SPECTRA
+                                          [SPARSE_MAX_FRACTION]]]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from gleams import config, testing
+from gleams.feature import feature, spectrum
+from gleams.ms_io import ms_io
+from gleams.ms_io.spectrum_batch import SpectrumBatch
+from gleams.nn import inference
+
+
+_default_filename = os.path.join(os.path.dirname(__file__), os.pardir, 'data',
+                                 'gleams_reference_spectra.mgf')
+
+
+def _get_encodings(filename, num_spectra):
+    # Use the bundled reference spectra if GLEAMS_HOME doesn't contain them.
+    if not os.path.isfile(config.ref_spectra_filename):
+        config.ref_spectra_filename = _default_filename
+    enc = feature.get_encoder()
+    batch = spectrum.preprocess_batch(
+        SpectrumBatch.from_spectra(ms_io.get_spectra(filename)),
+        config.fragment_mz_min, config.fragment_mz_max)
+    batch = batch[np.nonzero(batch.is_valid)[0]]
+    # Repeat the spectra to obtain the requested number of spectra.
+    return enc.encode_batch_split(
+        batch[np.resize(np.arange(len(batch)), num_spectra)])
+
+
+def _embed_keras(emb, encodings, fragments):
+    from gleams.nn import data_generator
+    model = emb._get_embedder_model(True)
+    # Initialize the model.
+    model.predict_on_batch(data_generator.EncodingsSequence(
+        encodings, fragments, 10, config.num_precursor_features)[0])
+    encodings_generator = data_generator.EncodingsSequence(
+        encodings, fragments, config.batch_size,
+        config.num_precursor_features)
+    start = time.perf_counter()
+    embeddings = np.vstack([
+        model.predict_on_batch(encodings_generator[i])
+        for i in range(len(encodings_generator))])
+    return embeddings, time.perf_counter() - start
+
+
+def _embed_numpy(emb, encodings, fragments, sparse_max_fraction):
+    config.inference_sparse_max_fraction = sparse_max_fraction
+    # Compile the kernels.
+    emb.embed(encodings[:10], fragments[:10])
+    start = time.perf_counter()
+    embeddings = emb.embed(encodings, fragments)
+    return embeddings, time.perf_counter() - start
+
+
+def main(filename, num_spectra, sparse_max_fraction):
+    encodings, fragments = _get_encodings(filename, num_spectra)
+    num_ref_spectra_features = (encodings.shape[1] -
+                                config.num_precursor_features)
+    with tempfile.TemporaryDirectory() as model_dir:
+        model_filename = os.path.join(model_dir, 'gleams.hdf5')
+        try:
+            emb_keras = testing.build_random_embedder(
+                model_filename, config.num_precursor_features,
+                config.num_fragment_features, num_ref_spectra_features)
+        except ImportError:
+            emb_keras = None
+            testing.write_random_weights(
+                model_filename, config.num_precursor_features,
+                config.num_fragment_features, num_ref_spectra_features)
+        emb = inference.NumpyEmbedder(
+            config.num_precursor_features, config.num_fragment_features,
+            num_ref_spectra_features, model_filename)
+        emb.load()
+        embeddings_dense, time_dense = _embed_numpy(
+            emb, encodings, fragments, 0)
+        embeddings_numpy, time_numpy = _embed_numpy(
+            emb, encodings, fragments, sparse_max_fraction)
+        print(f'{filename} ({num_spectra} spectra, '
+              f'{fragments.nnz / num_spectra:.0f} fragment peaks/spectrum, '
+              f'{emb.num_threads} threads)')
+        print(f'  NumPy dense:  {num_spectra / time_dense:8.0f} spectra/s')
+        print(f'  NumPy sparse: {num_spectra / time_numpy:8.0f} spectra/s '
+              f'({time_dense / time_numpy:.1f}x, max abs diff '
+              f'{np.abs(embeddings_numpy - embeddings_dense).max():.2e})')
+    if emb_keras is None:
+        print('  Keras: not available')
+        return
+    embeddings_keras, time_keras = _embed_keras(emb_keras, encodings,
+                                                fragments)
+    print(f'  Keras:        {num_spectra / time_keras:8.0f} spectra/s '
+          f'(NumPy sparse {time_keras / time_numpy:.1f}x, max abs diff '
+          f'{np.abs(embeddings_numpy - embeddings_keras).max():.2e})')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else _default_filename,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 2000,
+         float(sys.argv[3]) if len(sys.argv) > 3 else
+         config.inference_sparse_max_fraction)
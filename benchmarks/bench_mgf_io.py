@@ -0,0 +1,63 @@
+"""
+Benchmark reading MGF files with the native GLEAMS parser versus pyteomics
+(see `testing.get_mgf_spectra_pyteomics`).
+
+Usage (with GLEAMS_HOME set):
+    python benchmarks/bench_mgf_io.py [MGF_FILE ...]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+from gleams import testing
+from gleams.ms_io import mgf_io
+
+
+_default_filename = os.path.join(os.path.dirname(__file__), os.pardir, 'data',
+                                 'gleams_reference_spectra.mgf')
+
+
+def _read_pyteomics(filename):
+    return list(testing.get_mgf_spectra_pyteomics(filename))
+
+
+def _read_native(filename):
+    return list(mgf_io.get_spectra(filename))
+
+
+def _time(func, filename, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(filename)
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+
+def main(filenames):
+    for filename in filenames:
+        spectra_pyteomics, time_pyteomics = _time(_read_pyteomics, filename)
+        spectra_native, time_native = _time(_read_native, filename)
+        assert len(spectra_pyteomics) == len(spectra_native)
+        for spec_pyteomics, spec_native in zip(spectra_pyteomics,
+                                               spectra_native):
+            assert spec_pyteomics.identifier == spec_native.identifier
+            assert spec_pyteomics.precursor_mz == spec_native.precursor_mz
+            assert (spec_pyteomics.precursor_charge ==
+                    spec_native.precursor_charge)
+            assert (spec_pyteomics.retention_time ==
+                    spec_native.retention_time)
+            assert np.array_equal(spec_pyteomics.mz, spec_native.mz)
+            assert np.array_equal(spec_pyteomics.intensity,
+                                  spec_native.intensity)
+        num_spectra = len(spectra_native)
+        print(f'{filename} ({os.path.getsize(filename) / 2**20:.1f} MB, '
+              f'{num_spectra} spectra)')
+        print(f'  pyteomics: {num_spectra / time_pyteomics:8.0f} spectra/s')
+        print(f'  native:    {num_spectra / time_native:8.0f} spectra/s '
+              f'({time_pyteomics / time_native:.1f}x)')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or [_default_filename])
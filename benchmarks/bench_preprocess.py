@@ -0,0 +1,52 @@
+"""
+Benchmark preprocessing spectra in batches versus as individual spectrum
+objects.
+
+Usage (with GLEAMS_HOME set):
+    python benchmarks/bench_preprocess.py [PEAK_FILE [NUM_SPECTRA]]
+"""
+import os
+import sys
+import time
+
+import numba as nb
+import numpy as np
+
+from gleams import config
+from gleams.feature import spectrum
+from gleams.ms_io import ms_io
+from gleams.ms_io.spectrum_batch import SpectrumBatch
+
+
+_default_filename = os.path.join(os.path.dirname(__file__), os.pardir, 'data',
+                                 'gleams_reference_spectra.mgf')
+
+
+def main(filename, num_spectra):
+    batch = SpectrumBatch.from_spectra(ms_io.get_spectra(filename))
+    # Repeat the spectra to obtain the requested number of spectra.
+    batch = batch[np.resize(np.arange(len(batch)), num_spectra)]
+    args = config.fragment_mz_min, config.fragment_mz_max
+    # Compile the kernels.
+    spectrum.preprocess_batch(batch[:100], *args)
+    spectra = list(batch[:min(num_spectra, 20000)].to_spectra())
+    start = time.perf_counter()
+    for spec in spectra:
+        spectrum.preprocess(spec, *args)
+    time_object = (time.perf_counter() - start) / len(spectra)
+    times = []
+    for _ in range(3):
+        start = time.perf_counter()
+        spectrum.preprocess_batch(batch, *args)
+        times.append(time.perf_counter() - start)
+    time_batch = min(times) / num_spectra
+    print(f'{filename} ({num_spectra} spectra, {len(batch.mz)} peaks, '
+          f'{nb.config.NUMBA_NUM_THREADS} threads)')
+    print(f'  preprocess:       {1 / time_object:10.0f} spectra/s')
+    print(f'  preprocess_batch: {1 / time_batch:10.0f} spectra/s '
+          f'({time_object / time_batch:.1f}x)')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else _default_filename,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 100000)
@@ -0,0 +1,70 @@
+"""
+Benchmark reading spectra from spectrum stores versus from their source peak
+files.
+
+Usage (with GLEAMS_HOME set):
+    python benchmarks/bench_store_io.py [PEAK_FILE ...]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from gleams.ms_io import ms_io, store_io
+
+
+_default_filename = os.path.join(os.path.dirname(__file__), os.pardir, 'data',
+                                 'gleams_reference_spectra.mgf')
+
+
+def _get_peaks(spectrum):
+    # Peaks with identical m/z values can be in any order.
+    order = np.lexsort((spectrum.intensity, spectrum.mz))
+    return spectrum.mz[order], spectrum.intensity[order]
+
+
+def _read(filename, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        spectra = list(ms_io.get_spectra(filename))
+        times.append(time.perf_counter() - start)
+    return spectra, min(times)
+
+
+def main(filenames):
+    with tempfile.TemporaryDirectory() as store_dir:
+        for filename in filenames:
+            store_filename = os.path.join(
+                store_dir, f'{os.path.basename(filename)}.spec')
+            start = time.perf_counter()
+            store_io.convert(filename, store_filename)
+            time_convert = time.perf_counter() - start
+            spectra_source, time_source = _read(filename)
+            spectra_store, time_store = _read(store_filename)
+            assert len(spectra_source) == len(spectra_store)
+            for spectrum_source, spectrum_store in zip(spectra_source,
+                                                       spectra_store):
+                assert (spectrum_source.precursor_mz ==
+                        spectrum_store.precursor_mz)
+                assert np.array_equal(_get_peaks(spectrum_source),
+                                      _get_peaks(spectrum_store))
+            arrays = store_io.read_arrays(store_filename)
+            start = time.perf_counter()
+            float(arrays['mz'].sum()) + float(arrays['intensity'].sum())
+            time_arrays = time.perf_counter() - start
+            num_spectra = len(spectra_store)
+            num_bytes = arrays['mz'].nbytes + arrays['intensity'].nbytes
+            print(f'{filename} ({num_spectra} spectra, converted in '
+                  f'{time_convert:.2f} s)')
+            print(f'  source: {num_spectra / time_source:8.0f} spectra/s')
+            print(f'  store:  {num_spectra / time_store:8.0f} spectra/s '
+                  f'({time_source / time_store:.1f}x)')
+            print(f'  raw peak arrays: {num_bytes / 1e6:.1f} MB summed in '
+                  f'{time_arrays * 1e3:.1f} ms')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or [_default_filename])
@@ -0,0 +1,110 @@
+"""
+Write synthetic mzML and mzXML peak files with random spectra for the
+benchmarks. Every fifth spectrum is an MS1 spectrum.
+
+Usage: python benchmarks/make_peak_files.py OUT_DIR [NUM_SPECTRA]
+"""
+import base64
+import os
+import sys
+import zlib
+
+import numpy as np
+
+
+def _get_spectra(num_spectra, seed=0):
+    rng = np.random.RandomState(seed)
+    for i in range(num_spectra):
+        num_peaks = rng.randint(5, 300)
+        yield (i + 1, 1 if i % 5 == 0 else 2, rng.uniform(400, 1200),
+               rng.randint(0, 5), np.sort(rng.uniform(100, 2000, num_peaks)),
+               rng.uniform(1, 1e5, num_peaks))
+
+
+def _write_mzml(filename, spectra):
+    cv_param = '<cvParam cvRef="MS" accession="{}" name="{}" value="{}"/>'
+    with open(filename, 'w') as f_out:
+        f_out.write('<?xml version="1.0" encoding="utf-8"?>\n'
+                    '<mzML xmlns="http://psi.hupo.org/ms/mzml" '
+                    'version="1.1.0">\n<cvList count="1"><cv id="MS" '
+                    'fullName="PSI-MS" URI="x"/></cvList>\n<run id="r">\n'
+                    '<spectrumList>\n')
+        for i, (scan, ms_level, precursor_mz, charge, mz, intensity) in \
+                enumerate(spectra):
+            f_out.write(
+                f'<spectrum index="{i}" id="controllerType=0 '
+                f'controllerNumber=1 scan={scan}" '
+                f'defaultArrayLength="{len(mz)}">\n')
+            f_out.write(cv_param.format('MS:1000511', 'ms level', ms_level))
+            f_out.write(
+                f'<scanList count="1"><scan>'
+                f'{cv_param.format("MS:1000016", "scan start time", scan)}'
+                f'</scan></scanList>\n')
+            if ms_level == 2:
+                selected_ion = cv_param.format(
+                    'MS:1000744', 'selected ion m/z', precursor_mz)
+                if charge:
+                    selected_ion += cv_param.format('MS:1000041',
+                                                    'charge state', charge)
+                f_out.write(
+                    f'<precursorList count="1"><precursor><selectedIonList '
+                    f'count="1"><selectedIon>{selected_ion}</selectedIon>'
+                    f'</selectedIonList></precursor></precursorList>\n')
+            f_out.write('<binaryDataArrayList count="2">\n')
+            for values, accession, name in (
+                    (mz, 'MS:1000514', 'm/z array'),
+                    (intensity, 'MS:1000515', 'intensity array')):
+                encoded = base64.b64encode(zlib.compress(
+                    values.astype(np.float64).tobytes())).decode()
+                f_out.write(
+                    f'<binaryDataArray encodedLength="{len(encoded)}">'
+                    f'{cv_param.format("MS:1000523", "64-bit float", "")}'
+                    f'{cv_param.format("MS:1000574", "zlib compression", "")}'
+                    f'{cv_param.format(accession, name, "")}'
+                    f'<binary>{encoded}</binary></binaryDataArray>\n')
+            f_out.write('</binaryDataArrayList></spectrum>\n')
+        f_out.write('</spectrumList></run></mzML>\n')
+
+
+def _write_mzxml(filename, spectra):
+    with open(filename, 'w') as f_out:
+        f_out.write('<?xml version="1.0" encoding="ISO-8859-1"?>\n'
+                    '<mzXML xmlns="http://sashimi.sourceforge.net/schema_'
+                    'revision/mzXML_3.2">\n<msRun>\n')
+        # MS/MS scans are nested in their preceding MS1 scan.
+        ms1_open = False
+        for scan, ms_level, precursor_mz, charge, mz, intensity in spectra:
+            if ms_level == 1 and ms1_open:
+                f_out.write('</scan>\n')
+            peaks = np.empty(2 * len(mz), '>f4')
+            peaks[0::2], peaks[1::2] = mz, intensity
+            encoded = base64.b64encode(zlib.compress(peaks.tobytes()))\
+                .decode()
+            f_out.write(f'<scan num="{scan}" msLevel="{ms_level}" '
+                        f'peaksCount="{len(mz)}" retentionTime="PT{scan}S">\n')
+            if ms_level == 2:
+                charge = f' precursorCharge="{charge}"' if charge else ''
+                f_out.write(f'<precursorMz precursorIntensity="1"{charge} '
+                            f'activationMethod="HCD">{precursor_mz}'
+                            f'</precursorMz>\n')
+            f_out.write(f'<peaks compressionType="zlib" '
+                        f'compressedLen="{len(encoded)}" precision="32" '
+                        f'byteOrder="network" contentType="m/z-int">'
+                        f'{encoded}</peaks>\n')
+            if ms_level == 2:
+                f_out.write('</scan>\n')
+            ms1_open = ms_level == 1 or ms1_open
+        if ms1_open:
+            f_out.write('</scan>\n')
+        f_out.write('</msRun>\n</mzXML>\n')
+
+
+def main(out_dir, num_spectra):
+    os.makedirs(out_dir, exist_ok=True)
+    spectra = list(_get_spectra(num_spectra))
+    _write_mzml(os.path.join(out_dir, 'synthetic.mzML'), spectra)
+    _write_mzxml(os.path.join(out_dir, 'synthetic.mzXML'), spectra)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 16000)
@@ -17,6 +17,7 @@ import tqdm
 from sklearn.cluster import DBSCAN
 
 from gleams import config
+from gleams.feature import shard
 
 
 logger = logging.getLogger('gleams')
@@ -52,8 +53,8 @@ def compute_pairwise_distances(embeddings_filename: str,
     Parameters
     ----------
     embeddings_filename : str
-        NumPy file containing the embedding vectors for which to compute
-        pairwise distances.
+        NumPy file or sharded embedding manifest (see `shard.load`) containing
+        the embedding vectors for which to compute pairwise distances.
     metadata_filename : str
         Metadata file with precursor m/z information for all embeddings.
     """
@@ -73,7 +74,7 @@ def compute_pairwise_distances(embeddings_filename: str,
                                        .replace('.npz', '.npy'))
     if os.path.isfile(dist_filename):
         return
-    embeddings = np.load(embeddings_filename, mmap_mode='r')
+    embeddings = shard.load(embeddings_filename)
     precursor_mzs = (pd.read_parquet(metadata_filename, columns=['mz'])
                      .squeeze().sort_values())
     min_mz, max_mz = precursor_mzs.min(), precursor_mzs.max()
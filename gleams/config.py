@@ -20,6 +20,27 @@ test_ratio = 0.1
 split_ratio_tolerance = 0.01
 pair_mz_tolerance = 10  # ppm
 
+# Peak files larger than this size (in bytes) are split in parts with equal
+# numbers of spectra, which are converted to features concurrently.
+peak_file_part_size = 2**28
+# The spectrum indexes that are used to read only the requested spectra from
+# peak files are stored in this directory.
+spectrum_index_dir = os.path.join(os.environ['GLEAMS_HOME'], 'data', 'index')
+# Peak files are converted to features in batches of this number of spectra,
+# while a background thread reads ahead at most this number of spectra with at
+# most this total peak size (in bytes).
+peak_batch_size = 2**14
+prefetch_num_spectra = 2**14
+prefetch_bytes = 2**28
+# The preprocessed spectra and features of each peak file can be cached in this
+# directory, up to this total size (in bytes), and reused as long as the peak
+# file and the relevant preprocessing and encoder settings don't change. The
+# least recently used entries are removed first. The cache is disabled by
+# default (size 0). Enable it (e.g. 2**36 for 64 GB) when the same peak files
+# are converted repeatedly.
+feature_cache_dir = os.path.join(os.environ['GLEAMS_HOME'], 'data', 'cache')
+feature_cache_size = 0
+
 # MS/MS spectrum preprocessing settings.
 
 # Minimum number of peaks for an MS/MS spectrum to be considered.
@@ -62,6 +83,26 @@ fragment_mz_tol = 0.05  # Da
 # Neural network settings.
 embedding_size = 32
 
+# Inference settings.
+# Engine used to embed spectra: 'keras' (requires a GPU), 'numpy' (CPU-only,
+# doesn't require TensorFlow), or 'auto' (Keras if a GPU is available, NumPy
+# otherwise).
+inference_engine = 'auto'
+# Number of spectra embedded at once by each thread of the NumPy engine.
+inference_batch_size = 32
+# Number of threads of the NumPy engine (None to use the CPUs that aren't used
+# by the feature conversion worker processes).
+inference_threads = None
+# Number of feature conversion worker processes while embedding spectra using
+# the NumPy engine (None to use the CPUs that aren't used by the NumPy engine
+# threads, or a quarter of the CPUs if both are None).
+inference_feature_processes = None
+# Maximum fraction of positions at which the first fragment convolutional
+# layers of the NumPy engine are evaluated selectively, i.e. only where their
+# input differs from that of an all-zero fragment input (0 to always evaluate
+# them densely).
+inference_sparse_max_fraction = 0.9
+
 # Training hyperparameters.
 loss_label_certainty = 0.99
 margin = 1
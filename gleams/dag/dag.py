@@ -24,7 +24,7 @@ import tensorflow.compat.v1 as tf
 
 from gleams import config
 from gleams.cluster import cluster
-from gleams.feature import feature
+from gleams.feature import feature, shard
 from gleams.metadata import metadata
 from gleams.nn import nn
 
@@ -126,7 +126,7 @@ with DAG('gleams', default_args=default_args,
                    'filename_feat_train':
                        os.path.join(feat_dir,
                                     f'feature_{config.massivekb_task_id}_'
-                                    f'train.npy'),
+                                    f'train{shard.manifest_ext}'),
                    'filename_train_pairs_pos':
                        os.path.join(feat_dir,
                                     f'feature_{config.massivekb_task_id}_'
@@ -138,7 +138,7 @@ with DAG('gleams', default_args=default_args,
                    'filename_feat_val':
                        os.path.join(feat_dir,
                                     f'feature_{config.massivekb_task_id}_'
-                                    f'val.npy'),
+                                    f'val{shard.manifest_ext}'),
                    'filename_val_pairs_pos':
                        os.path.join(feat_dir,
                                     f'feature_{config.massivekb_task_id}_'
@@ -0,0 +1,297 @@
+import hashlib
+import logging
+import os
+import shutil
+from typing import Any, Optional, Sequence, Tuple
+
+import numpy as np
+
+from gleams import config
+from gleams.feature import encoder
+from gleams.ms_io import archive_io
+
+
+logger = logging.getLogger('gleams')
+
+
+# Version of the cache entry format, which is included in the cache keys so
+# that incompatible entries are never reused.
+_version = 1
+# Settings that determine the preprocessed spectra.
+_preprocessing_settings = (
+    'min_peaks', 'min_mz_range', 'remove_precursor_tolerance',
+    'min_intensity', 'max_peaks_used', 'scaling', 'fragment_mz_min',
+    'fragment_mz_max')
+# Settings that determine the features of the preprocessed spectra (see
+# `feature.get_encoder`).
+_encoder_settings = (
+    'num_bits_precursor_mz', 'precursor_mz_min', 'precursor_mz_max',
+    'num_bits_precursor_mass', 'precursor_mass_min', 'precursor_mass_max',
+    'precursor_charge_max', 'fragment_mz_min', 'fragment_mz_max', 'bin_size',
+    'ref_spectra_filename', 'num_ref_spectra', 'fragment_mz_tol')
+
+
+def get_keys(peak_filename: str, enc: encoder.MultipleEncoder,
+             scan_nrs: Sequence[int] = None, part: Tuple[int, int] = None)\
+        -> Optional[Tuple[str, str]]:
+    """
+    Get the cache keys of the preprocessed spectra and of the features of
+    the given peak file.
+
+    The keys combine the peak file's identity (see `get_file_key`), the
+    requested spectra, and the settings in the config
+    that determine the preprocessed spectra. The key of the features
+    additionally includes the encoder key (see `get_encoder_key`).
+
+    Parameters
+    ----------
+    peak_filename : str
+        The peak file name or archive member path.
+    enc : encoder.MultipleEncoder
+        The MultipleEncoder used to convert the spectra to features.
+    scan_nrs : Sequence[int]
+        The scan numbers of the requested spectra, or None if all spectra are
+        requested.
+    part : Tuple[int, int]
+        The requested part of the peak file (see `ms_io.get_spectra`), or None
+        if the full peak file is requested.
+
+    Returns
+    -------
+    Optional[Tuple[str, str]]
+        The keys of the preprocessed spectra and of the features, or None if
+        the cache is disabled.
+    """
+    if config.feature_cache_size <= 0:
+        return None
+    os.makedirs(config.feature_cache_dir, exist_ok=True)
+    preprocessed_key = _hash([
+        _version, get_file_key(peak_filename), part,
+        _hash(np.asarray(scan_nrs, np.int64).tobytes())
+        if scan_nrs is not None else None,
+        *[getattr(config, setting) for setting in _preprocessing_settings]])
+    features_key = _hash([preprocessed_key, get_encoder_key(enc)])
+    return preprocessed_key, features_key
+
+
+def get_file_key(peak_filename: str) -> str:
+    """
+    Get a key that identifies the current version of the given peak file.
+
+    Parameters
+    ----------
+    peak_filename : str
+        The peak file name or archive member path.
+
+    Returns
+    -------
+    str
+        The key, which combines the peak file's path, size, and modification
+        time.
+    """
+    peak_stat = archive_io.stat(peak_filename)
+    return _hash([os.path.abspath(peak_filename), peak_stat.st_size,
+                  peak_stat.st_mtime_ns])
+
+
+def get_encoder_key(enc: encoder.MultipleEncoder) -> str:
+    """
+    Get a key that identifies the features produced by the given encoder.
+
+    The key combines the settings in the config that determine the features
+    and the identifiers of the reference spectra selected by the encoder, in
+    order. The reference spectra are selected randomly (see
+    `encoder.ReferenceSpectraEncoder`), so encoders created in different
+    processes with the same settings can produce features with differently
+    ordered reference spectra features.
+
+    Parameters
+    ----------
+    enc : encoder.MultipleEncoder
+        The MultipleEncoder used to convert spectra to features.
+
+    Returns
+    -------
+    str
+        The encoder key.
+    """
+    try:
+        ref_stat = os.stat(config.ref_spectra_filename)
+        ref_key = ref_stat.st_size, ref_stat.st_mtime_ns
+    except OSError:
+        ref_key = None
+    ref_spectra = [[spec.identifier for spec in child_enc.ref_spectra]
+                   for child_enc in enc.encoders
+                   if isinstance(child_enc, encoder.ReferenceSpectraEncoder)]
+    return _hash([_version, ref_key, ref_spectra,
+                  *[getattr(config, setting)
+                    for setting in _encoder_settings]])
+
+
+def _hash(value: Any) -> str:
+    """
+    Hash the given value.
+
+    Parameters
+    ----------
+    value : Any
+        The bytes to be hashed, or a value with a deterministic string
+        representation.
+
+    Returns
+    -------
+    str
+        The hexadecimal SHA-1 digest of the value.
+    """
+    if not isinstance(value, bytes):
+        value = repr(value).encode()
+    return hashlib.sha1(value).hexdigest()
+
+
+def get_preprocessed_filename(key: str) -> str:
+    """
+    Get the file name of the cached preprocessed spectra with the given key.
+
+    Parameters
+    ----------
+    key : str
+        The cache key of the preprocessed spectra (see `get_keys`).
+
+    Returns
+    -------
+    str
+        The spectrum store file name (see `store_io.SpectrumStoreWriter`).
+    """
+    return os.path.join(config.feature_cache_dir, f'{key}.spec')
+
+
+def get_features_dirname(key: str) -> str:
+    """
+    Get the directory name of the cached features with the given key.
+
+    Parameters
+    ----------
+    key : str
+        The cache key of the features (see `get_keys`).
+
+    Returns
+    -------
+    str
+        The directory name.
+    """
+    return os.path.join(config.feature_cache_dir, f'{key}.features')
+
+
+def lookup(path: str) -> bool:
+    """
+    Check whether the given cache entry exists, and mark it as recently used
+    if it does.
+
+    Parameters
+    ----------
+    path : str
+        The file or directory name of the cache entry.
+
+    Returns
+    -------
+    bool
+        True if the cache entry exists, False otherwise.
+    """
+    try:
+        os.utime(path)
+        return True
+    except OSError:
+        return False
+
+
+def get_temp_path(path: str) -> str:
+    """
+    Get a temporary name to which a cache entry is written before it's
+    published (see `publish`).
+
+    Parameters
+    ----------
+    path : str
+        The file or directory name of the cache entry.
+
+    Returns
+    -------
+    str
+        The temporary file or directory name, which is unique per process.
+    """
+    return f'{path}.{os.getpid()}.tmp'
+
+
+def publish(temp_path: str, path: str) -> None:
+    """
+    Atomically publish a cache entry that was written to a temporary location.
+
+    If the entry was already published by another process the temporary
+    entry is removed.
+
+    Parameters
+    ----------
+    temp_path : str
+        The temporary file or directory name (see `get_temp_path`).
+    path : str
+        The file or directory name of the cache entry.
+    """
+    try:
+        os.rename(temp_path, path)
+    except OSError:
+        if not os.path.exists(path):
+            raise
+        remove(temp_path)
+
+
+def evict() -> None:
+    """
+    Remove the least recently used cache entries until the total size of the
+    cache doesn't exceed the configured size.
+    """
+    if (config.feature_cache_size <= 0 or
+            not os.path.isdir(config.feature_cache_dir)):
+        return
+    entries = []
+    for entry in os.scandir(config.feature_cache_dir):
+        # Skip entries that are still being written.
+        if entry.name.endswith('.tmp'):
+            continue
+        try:
+            if entry.is_dir():
+                size = sum([child.stat().st_size
+                            for child in os.scandir(entry.path)])
+            else:
+                size = entry.stat().st_size
+            entries.append((entry.stat().st_mtime, size, entry.path))
+        except OSError:
+            # The entry was removed concurrently.
+            pass
+    cache_size, num_evicted = sum([size for _, size, _ in entries]), 0
+    for _, size, path in sorted(entries):
+        if cache_size <= config.feature_cache_size:
+            break
+        remove(path)
+        cache_size -= size
+        num_evicted += 1
+    if num_evicted > 0:
+        logger.debug('Evicted %d entries from the feature cache (%.1f MB '
+                     'remaining)', num_evicted, cache_size / 10**6)
+
+
+def remove(path: str) -> None:
+    """
+    Remove the given cache entry, if it exists.
+
+    Parameters
+    ----------
+    path : str
+        The file or directory name of the cache entry.
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
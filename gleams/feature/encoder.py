@@ -2,14 +2,16 @@ import abc
 import itertools
 import logging
 import random
-from typing import List
+from typing import List, Tuple
 
 import numba as nb
 import numpy as np
+import scipy.sparse as ss
 from spectrum_utils.spectrum import MsmsSpectrum
 
 from gleams.feature import spectrum
 from gleams.ms_io import ms_io
+from gleams.ms_io.spectrum_batch import SpectrumBatch
 
 
 logger = logging.getLogger('gleams')
@@ -21,6 +23,9 @@ class SpectrumEncoder(metaclass=abc.ABCMeta):
     """
 
     feature_names = None
+    # Whether the encoder supports sparse encoding using
+    # `encode_batch_sparse`.
+    sparse = False
 
     def __init__(self):
         pass
@@ -42,6 +47,35 @@ class SpectrumEncoder(metaclass=abc.ABCMeta):
         """
         pass
 
+    def encode_batch(self, batch: SpectrumBatch, out: np.ndarray = None)\
+            -> np.ndarray:
+        """
+        Encode all spectra in the given batch.
+
+        By default the spectra are encoded individually. Subclasses can
+        override this to encode the batch without creating objects for the
+        individual spectra.
+
+        Parameters
+        ----------
+        batch : SpectrumBatch
+            The spectra to be encoded.
+        out : np.ndarray
+            Output array with one row per spectrum and one column per feature
+            in which the features are stored. Can be a view on a larger
+            array. If None, a new array is allocated.
+
+        Returns
+        -------
+        np.ndarray
+            Encoded spectrum features with one row per spectrum (the output
+            array if specified).
+        """
+        out = _get_out(out, len(batch), len(self.feature_names))
+        for i, spec in enumerate(batch.to_spectra()):
+            out[i] = self.encode(spec)
+        return out
+
 
 class PrecursorEncoder(SpectrumEncoder):
     """
@@ -107,15 +141,74 @@ class PrecursorEncoder(SpectrumEncoder):
             precursor m/z, a gray encoding of the precursor neutral mass, and
             a one-hot encoding of the precursor charge.
         """
-        gray_code_mz = binary_encode(
-            spec.precursor_mz, self.mz_min, self.mz_max, self.num_bits_mz)
+        return self._encode_precursor(np.asarray([spec.precursor_mz]),
+                                      np.asarray([spec.precursor_charge]))[0]
+
+    def encode_batch(self, batch: SpectrumBatch, out: np.ndarray = None)\
+            -> np.ndarray:
+        """
+        Encode the precursors of all spectra in the given batch.
+
+        Parameters
+        ----------
+        batch : SpectrumBatch
+            The spectra to be encoded.
+        out : np.ndarray
+            Output array with one row per spectrum and one column per feature
+            in which the features are stored. If None, a new array is
+            allocated.
+
+        Returns
+        -------
+        np.ndarray
+            Spectrum precursor features with one row per spectrum (the output
+            array if specified).
+        """
+        return self._encode_precursor(batch.precursor_mz,
+                                      batch.precursor_charge, out)
+
+    def _encode_precursor(self, precursor_mz: np.ndarray,
+                          precursor_charge: np.ndarray,
+                          out: np.ndarray = None) -> np.ndarray:
+        """
+        Encode the given precursors.
+
+        Parameters
+        ----------
+        precursor_mz : np.ndarray
+            The precursor m/z values.
+        precursor_charge : np.ndarray
+            The precursor charges.
+        out : np.ndarray
+            Output array with one row per precursor and one column per feature
+            in which the features are stored. If None, a new array is
+            allocated.
+
+        Returns
+        -------
+        np.ndarray
+            Precursor features with one row per precursor consisting of: a
+            gray encoding of the precursor m/z, a gray encoding of the
+            precursor neutral mass, and a one-hot encoding of the precursor
+            charge.
+        """
+        precursor_mz = np.asarray(precursor_mz, np.float64)
+        precursor_charge = np.asarray(precursor_charge, np.int64)
+        features = _get_out(out, len(precursor_mz), len(self.feature_names))
+        mass_start = self.num_bits_mz
+        charge_start = mass_start + self.num_bits_mass
+        features[:, :mass_start] = binary_encode(
+            precursor_mz, self.mz_min, self.mz_max, self.num_bits_mz)
         precursor_mass = neutral_mass_from_mz_charge(
-            spec.precursor_mz, spec.precursor_charge)
-        gray_code_mass = binary_encode(
+            precursor_mz, precursor_charge)
+        features[:, mass_start:charge_start] = binary_encode(
             precursor_mass, self.mass_min, self.mass_max, self.num_bits_mass)
-        one_hot_charge = np.zeros((self.charge_max,), np.float32)
-        one_hot_charge[min(spec.precursor_charge, self.charge_max) - 1] = 1.
-        return np.hstack([gray_code_mz, gray_code_mass, one_hot_charge])
+        # Charges below one wrap around to the last one-hot position.
+        charge_idx = (np.minimum(precursor_charge, self.charge_max) - 1) \
+            % self.charge_max
+        features[:, charge_start:] = 0.
+        features[np.arange(len(features)), charge_start + charge_idx] = 1.
+        return features
 
 
 class FragmentEncoder(SpectrumEncoder):
@@ -123,6 +216,8 @@ class FragmentEncoder(SpectrumEncoder):
     Represents a spectrum as a vector of fragment ions.
     """
 
+    sparse = True
+
     def __init__(self, min_mz: float, max_mz: float, bin_size: float):
         """
         Instantiate a FragmentEncoder.
@@ -163,6 +258,51 @@ class FragmentEncoder(SpectrumEncoder):
         return spectrum.to_vector(spec.mz, spec.intensity, self.min_mz,
                                   self.bin_size, self.num_bins)
 
+    def encode_batch(self, batch: SpectrumBatch, out: np.ndarray = None)\
+            -> np.ndarray:
+        """
+        Encode the fragments of all spectra in the given batch.
+
+        Parameters
+        ----------
+        batch : SpectrumBatch
+            The spectra to be encoded.
+        out : np.ndarray
+            Output array with one row per spectrum and one column per feature
+            in which the features are stored. If None, a new array is
+            allocated.
+
+        Returns
+        -------
+        np.ndarray
+            Spectrum fragment features with one row per spectrum (the output
+            array if specified).
+        """
+        return spectrum.to_vector_batch(
+            batch.mz, batch.intensity, batch.offsets, self.min_mz,
+            self.bin_size, self.num_bins,
+            _get_out(out, len(batch), self.num_bins))
+
+    def encode_batch_sparse(self, batch: SpectrumBatch) -> ss.csr_matrix:
+        """
+        Encode the fragments of all spectra in the given batch as sparse
+        vectors.
+
+        Parameters
+        ----------
+        batch : SpectrumBatch
+            The spectra to be encoded.
+
+        Returns
+        -------
+        ss.csr_matrix
+            Spectrum fragment features with one row per spectrum.
+        """
+        return ss.csr_matrix(spectrum.to_vector_batch_sparse(
+            batch.mz, batch.intensity, batch.offsets, self.min_mz,
+            self.bin_size, self.num_bins), (len(batch), self.num_bins),
+            np.float32)
+
 
 class ReferenceSpectraEncoder(SpectrumEncoder):
     """
@@ -208,8 +348,14 @@ class ReferenceSpectraEncoder(SpectrumEncoder):
                 self.ref_spectra.append(spec)
                 if len(self.ref_spectra) == num_ref_spectra:
                     break
+        # Index the reference peaks to compute all similarities at once.
+        ref_batch = SpectrumBatch.from_spectra(self.ref_spectra)
+        self.ref_index = spectrum.get_peak_index(
+            ref_batch.mz, ref_batch.intensity, ref_batch.offsets,
+            fragment_mz_tol)
 
-        self.feature_names = [f'ref_{i}' for i in range(len(ref_spectra))]
+        self.feature_names = [f'ref_{i}'
+                              for i in range(len(self.ref_spectra))]
 
     def encode(self, spec: MsmsSpectrum) -> np.ndarray:
         """
@@ -227,9 +373,34 @@ class ReferenceSpectraEncoder(SpectrumEncoder):
             Reference spectrum features consisting of the spectrum's dot
             product similarity to a set of reference spectra.
         """
-        return np.asarray([spectrum.dot(ref.mz, ref.intensity, spec.mz,
-                                        spec.intensity, self.fragment_mz_tol)
-                           for ref in self.ref_spectra], dtype=np.float32)
+        return spectrum.dot_index(spec.mz, spec.intensity, *self.ref_index,
+                                  self.fragment_mz_tol)
+
+    def encode_batch(self, batch: SpectrumBatch, out: np.ndarray = None)\
+            -> np.ndarray:
+        """
+        Encode all spectra in the given batch by their similarity with a set of
+        reference spectra.
+
+        Parameters
+        ----------
+        batch : SpectrumBatch
+            The spectra to be encoded.
+        out : np.ndarray
+            Output array with one row per spectrum and one column per feature
+            in which the features are stored. If None, a new array is
+            allocated.
+
+        Returns
+        -------
+        np.ndarray
+            Reference spectrum features with one row per spectrum (the output
+            array if specified).
+        """
+        return spectrum.dot_index_batch(
+            batch.mz, batch.intensity, batch.offsets, *self.ref_index,
+            self.fragment_mz_tol,
+            _get_out(out, len(batch), len(self.feature_names)))
 
 
 class MultipleEncoder(SpectrumEncoder):
@@ -252,6 +423,11 @@ class MultipleEncoder(SpectrumEncoder):
 
         self.feature_names = list(itertools.chain.from_iterable(
             [enc.feature_names for enc in self.encoders]))
+        # The number of features of the child encoders that don't support
+        # sparse encoding (see `encode_batch_split`).
+        self.num_dense_features = sum([len(enc.feature_names)
+                                       for enc in self.encoders
+                                       if not enc.sparse])
 
     def encode(self, spec: MsmsSpectrum) -> np.ndarray:
         """
@@ -269,6 +445,121 @@ class MultipleEncoder(SpectrumEncoder):
         """
         return np.hstack([enc.encode(spec) for enc in self.encoders])
 
+    def encode_batch(self, batch: SpectrumBatch, out: np.ndarray = None)\
+            -> np.ndarray:
+        """
+        Encode all spectra in the given batch using the child encoders.
+
+        Each child encoder directly fills its columns of the output array.
+
+        Parameters
+        ----------
+        batch : SpectrumBatch
+            The spectra to be encoded.
+        out : np.ndarray
+            Output array with one row per spectrum and one column per feature
+            in which the features are stored. If None, a new array is
+            allocated.
+
+        Returns
+        -------
+        np.ndarray
+            Concatenated spectrum features produced by all child encoders with
+            one row per spectrum (the output array if specified).
+        """
+        return _encode_batch_columns(
+            self.encoders, batch,
+            _get_out(out, len(batch), len(self.feature_names)))
+
+    def encode_batch_split(self, batch: SpectrumBatch, out: np.ndarray = None)\
+            -> Tuple[np.ndarray, ss.csr_matrix]:
+        """
+        Encode all spectra in the given batch using the child encoders, with
+        separate dense and sparse features.
+
+        Parameters
+        ----------
+        batch : SpectrumBatch
+            The spectra to be encoded.
+        out : np.ndarray
+            Output array with one row per spectrum and one column per dense
+            feature (see `num_dense_features`) in which the dense features are
+            stored. If None, a new array is allocated.
+
+        Returns
+        -------
+        Tuple[np.ndarray, ss.csr_matrix]
+            Concatenated features produced by all child encoders that don't
+            support sparse encoding (the output array if specified), and
+            concatenated sparse features produced by all child encoders that
+            do, with one row per spectrum.
+        """
+        encodings = _encode_batch_columns(
+            [enc for enc in self.encoders if not enc.sparse], batch,
+            _get_out(out, len(batch), self.num_dense_features))
+        sparse = [enc.encode_batch_sparse(batch) for enc in self.encoders
+                  if enc.sparse]
+        return (encodings,
+                ss.hstack(sparse, 'csr', np.float32) if len(sparse) > 0 else
+                ss.csr_matrix((len(batch), 0), dtype=np.float32))
+
+
+def _encode_batch_columns(encoders: List[SpectrumEncoder],
+                          batch: SpectrumBatch, out: np.ndarray) -> np.ndarray:
+    """
+    Encode all spectra in the given batch with multiple encoders that each
+    fill consecutive columns of the output array.
+
+    Parameters
+    ----------
+    encoders : List[SpectrumEncoder]
+        The encoders, with the number of columns of each encoder given by the
+        number of its feature names.
+    batch : SpectrumBatch
+        The spectra to be encoded.
+    out : np.ndarray
+        Output array with one row per spectrum and one column per feature of
+        all encoders.
+
+    Returns
+    -------
+    np.ndarray
+        The output array.
+    """
+    start = 0
+    for enc in encoders:
+        stop = start + len(enc.feature_names)
+        enc.encode_batch(batch, out[:, start:stop])
+        start = stop
+    return out
+
+
+def _get_out(out: np.ndarray, num_spectra: int, num_features: int)\
+        -> np.ndarray:
+    """
+    Get an output array to store encoded spectrum features.
+
+    Parameters
+    ----------
+    out : np.ndarray
+        The output array given by the caller, or None to allocate a new array.
+    num_spectra : int
+        The number of spectra (rows) to be encoded.
+    num_features : int
+        The number of features (columns) per spectrum.
+
+    Returns
+    -------
+    np.ndarray
+        The given output array, or a new array if no output array was given.
+    """
+    if out is None:
+        return np.zeros((num_spectra, num_features), np.float32)
+    if out.shape != (num_spectra, num_features):
+        raise ValueError(f'Invalid output array shape {out.shape}, '
+                         f'{(num_spectra, num_features)} required')
+    return out
+
 
 @nb.njit
 def neutral_mass_from_mz_charge(mz: float, charge: int) -> float:
@@ -291,15 +582,15 @@ def neutral_mass_from_mz_charge(mz: float, charge: int) -> float:
     return (mz - hydrogen_mass) * charge
 
 
-def _gray_code(value: int, num_bits: int) -> np.ndarray:
+def _gray_code(value: np.ndarray, num_bits: int) -> np.ndarray:
     """
-    Return the Gray code for a given integer, given the number of bits to use
-    for the encoding.
+    Return the Gray codes for the given integers, given the number of bits to
+    use for the encoding.
 
     Parameters
     ----------
-    value : int
-        The integer value to be converted to Gray code.
+    value : np.ndarray
+        The integer values to be converted to Gray code.
     num_bits : int
         The number of bits of the encoding. No checking is done to ensure a
         sufficient number of bits to store the encoding is specified.
@@ -307,23 +598,26 @@ def _gray_code(value: int, num_bits: int) -> np.ndarray:
     Returns
     -------
     np.ndarray
-        An array of individual bit values as floats.
+        An array of individual bit values as floats, with the most significant
+        bit first along the last axis.
     """
     # Gray encoding: https://stackoverflow.com/a/38745459
-    return np.asarray(list(f'{value ^ (value >> 1):0{num_bits}b}'), np.float32)
+    value = np.asarray(value, np.int64)
+    gray_code = value ^ (value >> 1)
+    shifts = np.arange(num_bits - 1, -1, -1, dtype=np.int64)
+    return ((gray_code[..., np.newaxis] >> shifts) & 1).astype(np.float32)
 
 
-@nb.njit
-def _get_bin_index(value: float, min_value: float, max_value: float,
-                   num_bits: int) -> int:
+def _get_bin_index(value: np.ndarray, min_value: float, max_value: float,
+                   num_bits: int) -> np.ndarray:
     """
-    Get the index of the given value between a minimum and maximum value given
-    a specified number of bits.
+    Get the indexes of the given values between a minimum and maximum value
+    given a specified number of bits.
 
     Parameters
     ----------
-    value : float
-        The value to be converted to a bin index.
+    value : np.ndarray
+        The values to be converted to bin indexes.
     min_value : float
         The minimum possible value.
     max_value : float
@@ -333,33 +627,32 @@ def _get_bin_index(value: float, min_value: float, max_value: float,
 
     Returns
     -------
-    int
-        The integer bin index of the value between the given minimum and
+    np.ndarray
+        The integer bin indexes of the values between the given minimum and
         maximum value using the specified number of bits.
     """
     # Divide the value range into equal intervals
     # and find the value's integer index.
     num_bins = 2 ** num_bits
     bin_size = (max_value - min_value) / num_bins
-    bin_index = int((value - min_value) / bin_size)
     # Clip to min/max.
-    bin_index = max(0, min(num_bins - 1, bin_index))
-    return bin_index
+    return np.clip((np.asarray(value, np.float64) - min_value) / bin_size,
+                   0, num_bins - 1).astype(np.int64)
 
 
-def binary_encode(value: float, min_value: float, max_value: float,
+def binary_encode(value: np.ndarray, min_value: float, max_value: float,
                   num_bits: int) -> np.ndarray:
     """
-    Return the Gray code for a given value, given the number of bits to use
-    for the encoding. The given number of bits equally spans the range between
-    the given minimum and maximum value.
-    If the given value is not within the interval given by the minimum and
+    Return the Gray codes for the given values, given the number of bits to
+    use for the encoding. The given number of bits equally spans the range
+    between the given minimum and maximum value.
+    If a given value is not within the interval given by the minimum and
     maximum value it will be clipped to either extremum.
 
     Parameters
     ----------
-    value : float
-        The value to be converted to Gray code.
+    value : np.ndarray
+        The values to be converted to Gray code.
     min_value : float
         The minimum possible value.
     max_value : float
@@ -370,7 +663,8 @@ def binary_encode(value: float, min_value: float, max_value: float,
     Returns
     -------
     np.ndarray
-        An array of individual bit values as floats.
+        An array of individual bit values as floats, with the bits of each
+        value along the last axis.
     """
     bin_index = _get_bin_index(value, min_value, max_value, num_bits)
     return _gray_code(bin_index, num_bits)
@@ -1,28 +1,496 @@
+import collections
+import contextlib
+import fcntl
+import functools
+import json
 import logging
+import math
+import multiprocessing
+import multiprocessing.pool
 import os
-from typing import List, Optional, Tuple
+import shutil
+import struct
+import time
+from typing import (Callable, Dict, Iterable, Iterator, List, Optional,
+                    Sequence, Tuple, Union)
 
-import joblib
 import numpy as np
 import pandas as pd
 import pyarrow as pa
 import pyarrow.parquet as pq
+import scipy.sparse as ss
+import threadpoolctl
 
 from gleams import config
-from gleams.feature import encoder, spectrum
-from gleams.ms_io import ms_io
+from gleams.feature import cache, encoder, shard, spectrum
+from gleams.ms_io import archive_io, ms_io, store_io
+from gleams.ms_io.reader_stats import ReaderStats
+from gleams.ms_io.spectrum_batch import SpectrumBatch
+from gleams.ms_io.spectrum_filter import SpectrumFilter
 
 
 logger = logging.getLogger('gleams')
 
 
+# Persistent pool of worker processes to convert peak files to features,
+# which is reused for all datasets and processing stages.
+_worker_pool = None
+_worker_pool_encoder = None
+_worker_pool_processes = None
+# The encoder in a worker process, initialized once when the worker starts.
+_worker_encoder = None
+
+# Size of the NumPy header of feature buffers, which is rewritten with the
+# final number of rows when the buffer is closed.
+_buffer_header_size = 128
+
+
+@functools.lru_cache(None)
+def get_encoder() -> encoder.MultipleEncoder:
+    """
+    Get the encoder to convert spectra to features as specified in the config.
+
+    The encoder is created only once, so that all processing stages use the
+    same reference spectra.
+
+    Returns
+    -------
+    encoder.MultipleEncoder
+        The MultipleEncoder used to convert spectra to features.
+    """
+    return encoder.MultipleEncoder([
+        encoder.PrecursorEncoder(
+            config.num_bits_precursor_mz, config.precursor_mz_min,
+            config.precursor_mz_max, config.num_bits_precursor_mass,
+            config.precursor_mass_min, config.precursor_mass_max,
+            config.precursor_charge_max),
+        encoder.FragmentEncoder(
+            config.fragment_mz_min, config.fragment_mz_max, config.bin_size),
+        encoder.ReferenceSpectraEncoder(
+            config.ref_spectra_filename, config.fragment_mz_min,
+            config.fragment_mz_max, config.fragment_mz_tol,
+            config.num_ref_spectra)
+    ])
+
+
+def get_worker_pool(enc: encoder.MultipleEncoder,
+                    num_processes: Optional[int] = None)\
+        -> multiprocessing.pool.Pool:
+    """
+    Get the persistent pool of worker processes to convert peak files to
+    features with the given encoder.
+
+    The worker processes receive the encoder once when they start. The pool
+    is reused until it is requested for a different encoder or number of
+    processes, or closed using `close_worker_pool`.
+
+    The worker processes are forked from the current process, so that they
+    inherit its configuration and logging setup. Forking isn't safe after
+    TensorFlow has initialized the GPUs, so the pool should be started before
+    TensorFlow is used (see `nn.embed`).
+
+    Parameters
+    ----------
+    enc : encoder.MultipleEncoder
+        The MultipleEncoder used to convert spectra to features.
+    num_processes : Optional[int]
+        The number of worker processes, or None to use all CPUs.
+
+    Returns
+    -------
+    multiprocessing.pool.Pool
+        The worker pool.
+    """
+    global _worker_pool, _worker_pool_encoder, _worker_pool_processes
+    num_processes = num_processes or os.cpu_count()
+    if (_worker_pool is None or _worker_pool_encoder is not enc or
+            _worker_pool_processes != num_processes):
+        close_worker_pool()
+        _worker_pool_processes = num_processes
+        logger.debug('Start the feature conversion worker pool (%d '
+                     'processes)', _worker_pool_processes)
+        _worker_pool = multiprocessing.Pool(
+            _worker_pool_processes, _init_worker, (enc,))
+        _worker_pool_encoder = enc
+    return _worker_pool
+
+
+def close_worker_pool() -> None:
+    """
+    Stop the persistent worker processes to convert peak files to features.
+    """
+    global _worker_pool, _worker_pool_encoder, _worker_pool_processes
+    if _worker_pool is not None:
+        _worker_pool.close()
+        _worker_pool.join()
+        _worker_pool, _worker_pool_encoder = None, None
+        _worker_pool_processes = None
+
+
+def _init_worker(enc: encoder.MultipleEncoder) -> None:
+    """
+    Initialize a worker process to convert peak files to features.
+
+    The spectrum preprocessing and encoding functions are compiled upfront
+    so that the worker is warm when it receives its first file. BLAS is
+    limited to a single thread per worker process, so that the worker
+    processes don't oversubscribe the CPUs.
+
+    Parameters
+    ----------
+    enc : encoder.MultipleEncoder
+        The MultipleEncoder used to convert spectra to features.
+    """
+    global _worker_encoder
+    start_time = time.time()
+    _worker_encoder = enc
+    threadpoolctl.threadpool_limits(1, 'blas')
+    # Use multiple spectra so that the output column slices of the encoders
+    # have the same (non-contiguous) layout as for actual peak files.
+    mz = np.linspace(config.fragment_mz_min, config.fragment_mz_max,
+                     config.min_peaks * 2, dtype=np.float32)
+    batch = SpectrumBatch(
+        np.asarray(['0', '1']), np.full(2, config.fragment_mz_max / 2),
+        np.full(2, 2), np.tile(mz, 2), np.ones(2 * len(mz), np.float32),
+        np.asarray([0, len(mz), 2 * len(mz)]))
+    batch = spectrum.preprocess_batch(
+        batch, config.fragment_mz_min, config.fragment_mz_max)
+    enc.encode_batch_split(batch[batch.is_valid])
+    logger.debug('Feature conversion worker %d initialized in %.2f s',
+                 os.getpid(), time.time() - start_time)
+
+
+def map_peaks_to_features(
+        filenames: Iterable[Tuple[str, str, Optional[pd.DataFrame], str]],
+        enc: encoder.MultipleEncoder,
+        callback: Callable[[str, int, Tuple[str, pd.DataFrame, List[
+            Tuple[int, int, np.ndarray]]]], None] = None,
+        keep_features: bool = True, num_processes: Optional[int] = None)\
+        -> Iterator[Tuple[str, List[Tuple[str, pd.DataFrame]], pd.DataFrame]]:
+    """
+    Convert the spectra in the given peak files to features in parallel using
+    the persistent worker pool.
+
+    All peak files are processed in a single queue, ordered from the largest
+    to the smallest file, so that a few large files don't delay the
+    completion of all other files. Peak files that are larger than the
+    configured part size are split in parts with equal numbers of spectra
+    (see `ms_io.get_spectra`), which are processed concurrently and merged
+    back in their original order. The worker processes write the features
+    directly to the feature buffer of each peak file (see `_create_buffer`)
+    and only return the spectrum information and the positions of their
+    features in the buffer. As soon as all peak files for a feature buffer
+    have been processed, its features are stored as `save_features` would,
+    and can be read using `load_features`. Additionally statistics about
+    reading the peak files and the time to convert them are reported to find
+    problematic peak files.
+
+    If the cache is enabled (see `config.feature_cache_size`), the
+    preprocessed spectra and features of each peak file (part) are cached (see
+    `cache.get_keys`), so that peak files that are converted again with the
+    same preprocessing and encoder settings don't need to be read and
+    processed again. The least recently used cache entries are evicted after
+    all peak files have been converted.
+
+    Features can additionally be consumed while the remaining peak files are
+    still being converted using a callback function, which is called for each
+    converted peak file (part) as soon as its features have been written to
+    the feature buffer. Its features can be read using `read_buffer`.
+
+    Parameters
+    ----------
+    filenames : Iterable[Tuple[str, str, Optional[pd.DataFrame], str]]
+        Tuples of the peak file's dataset, the peak file name, the metadata of
+        the PSMs in the peak file to be processed or None to process all
+        spectra in the peak file, and the feature file name to which the
+        features are written. The feature file name should be a NumPy binary
+        file.
+    enc : encoder.MultipleEncoder
+        The MultipleEncoder used to convert spectra to features.
+    callback : Callable[[str, int, Tuple[str, pd.DataFrame,
+                                         List[Tuple[int, int, np.ndarray]]]],
+                        None]
+        Function that is called in the calling process with the feature
+        buffer file name, the index of the converted part of the peak file,
+        and the result of `_peaks_to_features` for each peak file (part) with
+        valid spectra, or None if no callback is required.
+    keep_features : bool
+        If True, the feature buffers are completed to feature files after all
+        of their peak files have been converted. If False, the feature buffers
+        are removed instead, for when the features have already been consumed
+        using the callback function.
+    num_processes : Optional[int]
+        The number of worker processes (see `get_worker_pool`), or None to use
+        all CPUs.
+
+    Returns
+    -------
+    Iterator[Tuple[str, List[Tuple[str, pd.DataFrame]], pd.DataFrame]]
+        Tuples of the feature file name, the peak file names and information
+        about their converted spectra (see `_peaks_to_features`), and the
+        statistics of the peak files (see `_get_file_stats`), in the order in
+        which the feature files are completed. The features are ordered by
+        peak file in this order, which can differ from the order of the given
+        peak files.
+    """
+    pool = get_worker_pool(enc, num_processes)
+    tasks, sizes, num_files = [], [], 0
+    for dataset, filename, metadata, filename_encodings in filenames:
+        size = _get_peak_file_size(dataset, filename)
+        num_parts = _get_num_parts(dataset, filename, size)
+        for i in range(num_parts):
+            tasks.append((dataset, filename, metadata, filename_encodings,
+                          (i, num_parts) if num_parts > 1 else None))
+            sizes.append(size / num_parts)
+        num_files += 1
+    tasks = [tasks[i] for i in np.argsort(sizes, kind='mergesort')[::-1]]
+    num_remaining = collections.Counter()
+    for task in tasks:
+        if num_remaining[task[3]] == 0:
+            _create_buffer(task[3])
+        num_remaining[task[3]] += 1
+    logger.debug('Convert %d peak files (%.1f MB, %d tasks) to %d feature '
+                 'files', num_files, sum(sizes) / 10**6, len(tasks),
+                 len(num_remaining))
+    results = collections.defaultdict(list)
+    stats = collections.defaultdict(list)
+    start_time, busy_time = time.time(), 0.
+    for filename_encodings, part_i, result, reader_stats, task_time in \
+            pool.imap_unordered(_peaks_to_features_worker, tasks):
+        busy_time += task_time
+        if result[2] is not None:
+            results[filename_encodings].append((part_i, result))
+            if callback is not None:
+                callback(filename_encodings, part_i, result)
+        stats[filename_encodings].append((reader_stats, task_time))
+        num_remaining[filename_encodings] -= 1
+        if num_remaining[filename_encodings] == 0:
+            file_scans, positions = _merge_parts(
+                results.pop(filename_encodings, []))
+            if keep_features:
+                _close_buffer(filename_encodings, enc, positions)
+            else:
+                _remove_buffer(filename_encodings)
+            yield (filename_encodings, file_scans,
+                   _get_file_stats(stats.pop(filename_encodings), file_scans))
+    cache.evict()
+    wall_time = time.time() - start_time
+    logger.info('Converted %d peak files in %.1f s (%.0f%% worker '
+                'utilization)', num_files, wall_time,
+                100 * busy_time / max(wall_time * _worker_pool_processes,
+                                      1e-9))
+
+
+def _get_peak_file_size(dataset: str, filename: str) -> int:
+    """
+    Get the size of a peak file, used to schedule the largest files first.
+
+    Parameters
+    ----------
+    dataset : str
+        The peak file's dataset.
+    filename : str
+        The peak file name.
+
+    Returns
+    -------
+    int
+        The (uncompressed for archive members) peak file size in bytes, or 0 if
+        the peak file doesn't exist.
+    """
+    try:
+        return archive_io.getsize(os.path.join(
+            os.environ['GLEAMS_HOME'], 'data', 'peak', dataset, filename))
+    except OSError:
+        return 0
+
+
+def _get_num_parts(dataset: str, filename: str, size: int) -> int:
+    """
+    Get the number of parts in which a peak file is split to be processed
+    concurrently.
+
+    Parameters
+    ----------
+    dataset : str
+        The peak file's dataset.
+    filename : str
+        The peak file name.
+    size : int
+        The peak file size in bytes.
+
+    Returns
+    -------
+    int
+        The number of parts, at most the number of worker processes.
+    """
+    # Compressed files (and compressed archive members) can't be read
+    # efficiently from arbitrary offsets.
+    peak_filename = os.path.join(
+        os.environ['GLEAMS_HOME'], 'data', 'peak', dataset, filename)
+    if (size <= config.peak_file_part_size or
+            os.path.splitext(filename.lower())[1] in ('.gz', '.xz') or
+            not archive_io.is_seekable(peak_filename)):
+        return 1
+    num_parts = min(math.ceil(size / config.peak_file_part_size),
+                    _worker_pool_processes)
+    if num_parts > 1:
+        logger.debug('Split peak file %s/%s in %d parts', dataset, filename,
+                     num_parts)
+        # Make sure that the spectrum index exists before the parts are read.
+        ms_io.build_index(peak_filename)
+    return num_parts
+
+
+def _merge_parts(
+        results: List[Tuple[int, Tuple[str, pd.DataFrame,
+                                       List[Tuple[int, int, np.ndarray]]]]])\
+        -> Tuple[List[Tuple[str, pd.DataFrame]],
+                 List[Tuple[int, int, np.ndarray]]]:
+    """
+    Merge the results of the peak files written to a feature buffer.
+
+    Peak files are ordered by the first row of their features in the buffer,
+    i.e. in the order in which they were processed. The parts of peak files
+    that were split are merged in their original order.
+
+    Parameters
+    ----------
+    results : List[Tuple[int, Tuple[str, pd.DataFrame,
+                                    List[Tuple[int, int, np.ndarray]]]]]
+        Tuples of the part index and the result of `_peaks_to_features` for
+        all peak files (parts) with features written to the buffer.
+
+    Returns
+    -------
+    Tuple[List[Tuple[str, pd.DataFrame]], List[Tuple[int, int, np.ndarray]]]
+        Tuples of the peak file names and information about their converted
+        spectra, and the corresponding positions of the features in the
+        buffer (see `_write_buffer`).
+    """
+    file_results = collections.defaultdict(list)
+    for part_i, result in results:
+        file_results[result[0]].append((part_i, result))
+    file_results = sorted(
+        [sorted(parts, key=lambda part: part[0])
+         for parts in file_results.values()],
+        key=lambda parts: min([result[2][0][0] for _, result in parts]))
+    file_scans, positions = [], []
+    for parts in file_results:
+        file_scans.append((parts[0][1][0], pd.concat(
+            [result[1] for _, result in parts], ignore_index=True)
+            if len(parts) > 1 else parts[0][1][1]))
+        for _, result in parts:
+            positions.extend(result[2])
+    return file_scans, positions
+
+
+def _get_file_stats(stats: List[Tuple[ReaderStats, float]],
+                    file_scans: List[Tuple[str, pd.DataFrame]])\
+        -> pd.DataFrame:
+    """
+    Combine the statistics of the peak files (parts) written to a feature
+    buffer.
+
+    Parameters
+    ----------
+    stats : List[Tuple[ReaderStats, float]]
+        Tuples of the reader statistics and the processing time in seconds of
+        all processed peak files (parts).
+    file_scans : List[Tuple[str, pd.DataFrame]]
+        Tuples of the peak file names and information about their converted
+        spectra (see `_merge_parts`).
+
+    Returns
+    -------
+    pd.DataFrame
+        A DataFrame with for each peak file its number of parts, the number
+        of spectra converted to features, the total processing time (reading,
+        preprocessing, and encoding) in seconds, and the reader statistics
+        (see `ReaderStats.to_dict`), ordered by decreasing processing time.
+    """
+    file_stats = {}
+    for reader_stats, task_time in stats:
+        if reader_stats.filename not in file_stats:
+            file_stats[reader_stats.filename] = \
+                [ReaderStats(reader_stats.filename), 0, 0.]
+        file_stat = file_stats[reader_stats.filename]
+        file_stat[0].update(reader_stats)
+        file_stat[1] += 1
+        file_stat[2] += task_time
+    num_converted = {filename: len(scans) for filename, scans in file_scans}
+    file_stats = pd.DataFrame([
+        {'parts': num_parts, 'time': file_time,
+         'spectra_converted': num_converted.get(filename, 0),
+         **reader_stats.to_dict()}
+        for filename, (reader_stats, num_parts, file_time)
+        in file_stats.items()])
+    columns = (['filename', 'parts', 'time', 'spectra_converted'] +
+               [column for column in file_stats.columns
+                if column not in ('filename', 'parts', 'time',
+                                  'spectra_converted')])
+    skipped = [column for column in columns if column.startswith('skipped:')]
+    file_stats[skipped] = file_stats[skipped].fillna(0).astype(np.int64)
+    return (file_stats[columns].sort_values('time', ascending=False)
+            .reset_index(drop=True))
+
+
+def _peaks_to_features_worker(
+        task: Tuple[str, str, Optional[pd.DataFrame], str,
+                    Optional[Tuple[int, int]]])\
+        -> Tuple[str, int,
+                 Tuple[str, Optional[pd.DataFrame],
+                       Optional[List[Tuple[int, int, np.ndarray]]]],
+                 ReaderStats, float]:
+    """
+    Convert the spectra in a peak file to features in a worker process using
+    the worker's encoder.
+
+    Parameters
+    ----------
+    task : Tuple[str, str, Optional[pd.DataFrame], str,
+                 Optional[Tuple[int, int]]]
+        The peak file's dataset, the peak file name, the metadata of the PSMs
+        in the peak file to be processed, the feature buffer file name, and
+        the part of the peak file to be processed (see `_peaks_to_features`).
+
+    Returns
+    -------
+    Tuple[str, int, Tuple[str, Optional[pd.DataFrame],
+                          Optional[List[Tuple[int, int, np.ndarray]]]],
+          ReaderStats, float]
+        The feature buffer file name, the index of the processed part of the
+        peak file, the result of `_peaks_to_features`, the statistics of
+        reading the peak file, and the processing time in seconds.
+    """
+    dataset, filename, metadata, filename_encodings, part = task
+    start_time = time.time()
+    stats = ReaderStats(filename)
+    result = _peaks_to_features(dataset, filename, metadata, _worker_encoder,
+                                filename_encodings, part, stats)
+    task_time = time.time() - start_time
+    logger.debug('Converted file %s/%s%s in %.3f s', dataset, filename,
+                 f' (part {part[0] + 1}/{part[1]})' if part is not None
+                 else '', task_time)
+    return (filename_encodings, part[0] if part is not None else 0, result,
+            stats, task_time)
+
+
 def _peaks_to_features(dataset: str, filename: str,
                        metadata: Optional[pd.DataFrame],
-                       enc: encoder.SpectrumEncoder)\
-        -> Tuple[str, Optional[pd.DataFrame], Optional[List[np.ndarray]]]:
+                       enc: encoder.MultipleEncoder, filename_encodings: str,
+                       part: Tuple[int, int] = None,
+                       stats: ReaderStats = None)\
+        -> Tuple[str, Optional[pd.DataFrame],
+                 Optional[List[Tuple[int, int, np.ndarray]]]]:
     """
-    Convert the spectra with the given identifiers in the given file to a
-    feature array.
+    Convert the spectra with the given identifiers in the given file to
+    features in a feature buffer.
+
+    The spectra are converted in batches, while the next spectra are read
+    ahead in the background. Cached features or preprocessed spectra of the
+    peak file are used if available, otherwise they're added to the cache
+    (see `cache.get_keys`).
 
     Parameters
     ----------
@@ -34,40 +502,583 @@ def _peaks_to_features(dataset: str, filename: str,
         DataFrame containing metadata for the PSMs in the peak file to be
         processed. If None, all spectra in the peak file are converted to
         features.
-    enc : encoder.SpectrumEncoder
-        The SpectrumEncoder used to convert spectra to features.
+    enc : encoder.MultipleEncoder
+        The MultipleEncoder used to convert spectra to features.
+    filename_encodings : str
+        The feature buffer file name (see `_create_buffer`).
+    part : Tuple[int, int]
+        Only process part `i` of `k` parts of the peak file, specified as a
+        tuple `(i, k)` (see `ms_io.get_spectra`). If None, the full peak file
+        is processed.
+    stats : ReaderStats
+        Statistics in which reading the peak file is recorded. If None, no
+        statistics are recorded.
 
     Returns
     -------
-    Tuple[str, Optional[pd.DataFrame], Optional[List[np.ndarray]]]
+    Tuple[str, Optional[pd.DataFrame],
+          Optional[List[Tuple[int, int, np.ndarray]]]]
         A tuple of length 3 containing: the name of the file that has been
         converted, information about the converted spectra (scan number,
-        precursor charge, and precursor m/z), the converted spectra.
+        precursor charge, and precursor m/z), and the positions of the
+        spectra's features in the feature buffer for each batch (see
+        `_write_buffer`).
         If the given file does not exist the final two elements of the tuple
-        are None.
+        are None. If the file doesn't contain any valid spectra the final
+        element of the tuple is None.
     """
     peak_filename = os.path.join(
         os.environ['GLEAMS_HOME'], 'data', 'peak', dataset, filename)
-    if not os.path.isfile(peak_filename):
+    if not archive_io.isfile(peak_filename):
         logger.warning('Missing peak file %s, no features generated',
                        peak_filename)
         return filename, None, None
     logger.debug('Process file %s/%s', dataset, filename)
-    file_scans, file_mz, file_charge, file_encodings = [], [], [], []
-    if metadata is not None:
-        metadata = metadata.reset_index(['dataset', 'filename'], drop=True)
-    for spec in ms_io.get_spectra(peak_filename):
-        if ((metadata is None or np.int64(spec.identifier) in metadata.index)
-                and spectrum.preprocess(spec, config.fragment_mz_min,
-                                        config.fragment_mz_max).is_valid):
-            file_scans.append(spec.identifier)
-            file_mz.append(spec.precursor_mz)
-            file_charge.append(spec.precursor_charge)
-            file_encodings.append(enc.encode(spec))
-    scans = pd.DataFrame({'scan': file_scans, 'charge': file_charge,
-                          'mz': file_mz})
+    scan_nrs = (metadata.index.get_level_values('scan')
+                if metadata is not None else None)
+    cache_keys = cache.get_keys(peak_filename, enc, scan_nrs, part)
+    if cache_keys is not None:
+        cached = _read_cached_features(
+            cache.get_features_dirname(cache_keys[1]), filename_encodings,
+            enc, stats)
+        if cached is not None:
+            logger.debug('Use cached features for file %s/%s', dataset,
+                         filename)
+            scans, positions = cached
+            return filename, scans, positions if len(positions) > 0 else None
+    # The next spectra are read in the background while a batch is encoded.
+    scans, positions = [], []
+    for batch in _get_preprocessed_batches(
+            peak_filename, scan_nrs, part, stats,
+            cache.get_preprocessed_filename(cache_keys[0])
+            if cache_keys is not None else None):
+        scans.append(_get_scans(batch))
+        if len(batch) > 0:
+            positions.append(_write_buffer(filename_encodings, batch, enc))
+    scans = (pd.concat(scans, ignore_index=True) if len(scans) > 1 else
+             scans[0] if len(scans) == 1 else
+             _get_scans(SpectrumBatch.from_spectra([])))
+    if cache_keys is not None:
+        _write_cached_features(cache.get_features_dirname(cache_keys[1]),
+                               filename_encodings, enc, scans, positions)
+    return filename, scans, positions if len(positions) > 0 else None
+
+
+def _get_preprocessed_batches(peak_filename: str,
+                              scan_nrs: Optional[Sequence[int]],
+                              part: Optional[Tuple[int, int]],
+                              stats: Optional[ReaderStats],
+                              cache_filename: Optional[str])\
+        -> Iterator[SpectrumBatch]:
+    """
+    Read and preprocess the spectra in the given peak file in batches.
+
+    If the preprocessed spectra are cached they're read from the cache
+    instead of from the peak file. Otherwise they're written to the cache
+    after all spectra have been read.
+
+    Parameters
+    ----------
+    peak_filename : str
+        The peak file name.
+    scan_nrs : Optional[Sequence[int]]
+        Only read spectra with the given scan numbers. If None, all spectra
+        are read. Spectra in MGF files and spectrum stores are selected by
+        their identifier instead (see `_select_identifiers`).
+    part : Optional[Tuple[int, int]]
+        Only read part `i` of `k` parts of the peak file (see
+        `ms_io.get_spectra`). If None, the full peak file is read.
+    stats : Optional[ReaderStats]
+        Statistics in which reading the peak file (or the cached spectra) is
+        recorded. If None, no statistics are recorded.
+    cache_filename : Optional[str]
+        The file name of the cached preprocessed spectra (see
+        `cache.get_preprocessed_filename`). If None, the preprocessed spectra
+        aren't cached.
+
+    Returns
+    -------
+    Iterator[SpectrumBatch]
+        An iterator over batches of the valid preprocessed spectra.
+    """
+    if cache_filename is not None and cache.lookup(cache_filename):
+        for batch in ms_io.get_spectrum_batches(
+                cache_filename, batch_size=config.peak_batch_size,
+                stats=stats):
+            batch.is_processed = True
+            yield batch
+        return
+    # Spectra with too few peaks are invalid after preprocessing, so their
+    # peaks don't need to be read.
+    spectrum_filter = SpectrumFilter(min_peaks=config.min_peaks)
+    # The scan numbers of MGF files are the spectra's positions in the file
+    # (see `ms_io.get_spectra`), and spectrum stores keep the scan numbers of
+    # the file that they were converted from, whereas the metadata refers to
+    # spectra by their identifier. Hence those spectra are selected after
+    # reading them.
+    identifiers = None
+    if (scan_nrs is not None and
+            ms_io.get_file_format(peak_filename) in ('mgf', 'spec')):
+        identifiers, scan_nrs = np.asarray(scan_nrs).astype(np.str_), None
+    writer = (store_io.SpectrumStoreWriter(cache_filename)
+              if cache_filename is not None else None)
+    try:
+        for batch in ms_io.get_spectrum_batches(
+                peak_filename, scan_nrs, part, config.peak_batch_size,
+                config.prefetch_num_spectra, config.prefetch_bytes,
+                spectrum_filter, stats):
+            if identifiers is not None:
+                batch = _select_identifiers(batch, identifiers)
+            batch = spectrum.preprocess_batch(
+                batch, config.fragment_mz_min, config.fragment_mz_max)
+            batch = batch[batch.is_valid]
+            if writer is not None:
+                writer.write(batch)
+            yield batch
+    except BaseException:
+        if writer is not None:
+            writer.discard()
+        raise
+    if writer is not None:
+        try:
+            writer.close()
+        except OSError as e:
+            logger.warning('Failed to cache preprocessed spectra %s: %s',
+                           cache_filename, e)
+
+
+def _select_identifiers(batch: SpectrumBatch,
+                        identifiers: np.ndarray) -> SpectrumBatch:
+    """
+    Select the spectra with the given identifiers from the given batch.
+
+    Parameters
+    ----------
+    batch : SpectrumBatch
+        The spectra.
+    identifiers : np.ndarray
+        The identifiers of the spectra to be selected.
+
+    Returns
+    -------
+    SpectrumBatch
+        The spectra in the batch with one of the given identifiers.
+    """
+    return batch[np.isin(batch.identifier, identifiers)]
+
+
+def _read_cached_features(dirname: str, filename: str,
+                          enc: encoder.MultipleEncoder,
+                          stats: Optional[ReaderStats])\
+        -> Optional[Tuple[pd.DataFrame, List[Tuple[int, int, np.ndarray]]]]:
+    """
+    Copy cached features of a peak file to a feature buffer.
+
+    Parameters
+    ----------
+    dirname : str
+        The directory name of the cached features (see
+        `cache.get_features_dirname`).
+    filename : str
+        The feature buffer file name.
+    enc : encoder.MultipleEncoder
+        The MultipleEncoder used to convert spectra to features.
+    stats : Optional[ReaderStats]
+        Statistics in which reading the cached features is recorded. If None,
+        no statistics are recorded.
+
+    Returns
+    -------
+    Optional[Tuple[pd.DataFrame, List[Tuple[int, int, np.ndarray]]]]
+        Information about the cached spectra (see `_get_scans`) and the
+        positions of their features in the feature buffer (see
+        `_write_buffer`), or None if the features aren't cached.
+    """
+    if not cache.lookup(dirname):
+        return None
+    start_time = time.time()
+    with contextlib.ExitStack() as stack:
+        try:
+            scans = pd.read_parquet(os.path.join(dirname, 'scans.parquet'))
+            indptr = np.load(os.path.join(dirname, 'fragment_indptr.npy'))
+            sources = []
+            for name, shape, dtype in (
+                    ('encodings', (len(scans), enc.num_dense_features),
+                     np.float32),
+                    ('fragment_values', (int(indptr[-1]),), np.float32),
+                    ('fragment_indices', (int(indptr[-1]),), np.int32)):
+                f_in = stack.enter_context(
+                    open(os.path.join(dirname, f'{name}.npy'), 'rb'))
+                np.lib.format.read_magic(f_in)
+                array_shape, _, array_dtype = \
+                    np.lib.format.read_array_header_1_0(f_in)
+                if (array_shape != shape or array_dtype != dtype or
+                        os.fstat(f_in.fileno()).st_size - f_in.tell() <
+                        np.prod(shape) * np.dtype(dtype).itemsize):
+                    raise ValueError(f'Invalid cached array {name}')
+                sources.append(f_in)
+        except (OSError, ValueError, pa.ArrowException) as e:
+            logger.warning('Failed to read cached features %s: %s', dirname,
+                           e)
+            cache.remove(dirname)
+            return None
+        if len(scans) == 0:
+            return scans, []
+        num_values = int(indptr[-1])
+        row_start, value_start = _reserve(filename, len(scans), num_values)
+        row_size = enc.num_dense_features * np.float32().itemsize
+        with open(filename, 'r+b') as f_out:
+            f_out.seek(_buffer_header_size + row_start * row_size)
+            shard.copy_bytes(sources[0], f_out, len(scans) * row_size)
+        value_size = np.float32().itemsize + np.int32().itemsize
+        for filename_fragment, f_in, itemsize in zip(
+                _get_buffer_filenames(filename), sources[1:],
+                (np.float32().itemsize, np.int32().itemsize)):
+            with open(filename_fragment, 'r+b') as f_out:
+                f_out.seek(value_start * itemsize)
+                shard.copy_bytes(f_in, f_out, num_values * itemsize)
+    if stats is not None:
+        stats.num_yielded += len(scans)
+        stats.bytes_read += len(scans) * row_size + num_values * value_size
+        stats.read_time += time.time() - start_time
+    return scans, [(row_start, value_start, indptr)]
+
+
+def _write_cached_features(dirname: str, filename: str,
+                           enc: encoder.MultipleEncoder, scans: pd.DataFrame,
+                           positions: List[Tuple[int, int, np.ndarray]])\
+        -> None:
+    """
+    Cache the features of a peak file that were written to a feature buffer.
+
+    The cached features consist of the spectrum information, the dense
+    features, and the fragment values, column indices, and row pointers, which
+    are copied from the feature buffer in fixed-size chunks.
+
+    Parameters
+    ----------
+    dirname : str
+        The directory name of the cached features (see
+        `cache.get_features_dirname`).
+    filename : str
+        The feature buffer file name.
+    enc : encoder.MultipleEncoder
+        The MultipleEncoder used to convert spectra to features.
+    scans : pd.DataFrame
+        Information about the spectra (see `_get_scans`).
+    positions : List[Tuple[int, int, np.ndarray]]
+        The positions of the spectra's features in the feature buffer (see
+        `_write_buffer`).
+    """
+    temp_dirname = cache.get_temp_path(dirname)
+    row_size = enc.num_dense_features * np.float32().itemsize
+    indptrs, value_offset = [np.zeros(1, np.int64)], 0
+    for _, _, indptr in positions:
+        indptrs.append(np.asarray(indptr[1:], np.int64) + value_offset)
+        value_offset += int(indptr[-1])
+    try:
+        os.makedirs(temp_dirname)
+        scans.to_parquet(os.path.join(temp_dirname, 'scans.parquet'),
+                         index=False)
+        np.save(os.path.join(temp_dirname, 'fragment_indptr.npy'),
+                np.concatenate(indptrs))
+        for name, filename_in, shape, dtype, segments in (
+                ('encodings', filename,
+                 (len(scans), enc.num_dense_features), np.float32,
+                 [(_buffer_header_size + row_start * row_size,
+                   (len(indptr) - 1) * row_size)
+                  for row_start, _, indptr in positions]),
+                ('fragment_values', _get_buffer_filenames(filename)[0],
+                 (value_offset,), np.float32,
+                 [(value_start * np.float32().itemsize,
+                   int(indptr[-1]) * np.float32().itemsize)
+                  for _, value_start, indptr in positions]),
+                ('fragment_indices', _get_buffer_filenames(filename)[1],
+                 (value_offset,), np.int32,
+                 [(value_start * np.int32().itemsize,
+                   int(indptr[-1]) * np.int32().itemsize)
+                  for _, value_start, indptr in positions])):
+            with open(filename_in, 'rb') as f_in,\
+                    open(os.path.join(temp_dirname, f'{name}.npy'),
+                         'wb') as f_out:
+                np.lib.format.write_array_header_1_0(f_out, {
+                    'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                    'fortran_order': False, 'shape': shape})
+                for offset, size in segments:
+                    f_in.seek(offset)
+                    shard.copy_bytes(f_in, f_out, size)
+        cache.publish(temp_dirname, dirname)
+    except OSError as e:
+        logger.warning('Failed to cache features %s: %s', dirname, e)
+        shutil.rmtree(temp_dirname, ignore_errors=True)
+
+
+def _get_scans(batch: SpectrumBatch) -> pd.DataFrame:
+    """
+    Get information about the spectra in the given batch.
+
+    Parameters
+    ----------
+    batch : SpectrumBatch
+        The spectra.
+
+    Returns
+    -------
+    pd.DataFrame
+        A DataFrame with the scan number, precursor charge, and precursor m/z
+        of each spectrum.
+    """
+    scans = pd.DataFrame({'scan': batch.identifier,
+                          'charge': batch.precursor_charge,
+                          'mz': batch.precursor_mz})
     scans['scan'] = scans['scan'].astype(np.int64)
-    return filename, scans, file_encodings
+    scans['charge'] = scans['charge'].astype(np.int64)
+    return scans
+
+
+def _get_buffer_filenames(filename: str) -> Tuple[str, str, str]:
+    """
+    Get the file names of the temporary fragment values and indices and of
+    the reservation counters of a feature buffer.
+
+    Parameters
+    ----------
+    filename : str
+        The feature buffer file name.
+
+    Returns
+    -------
+    Tuple[str, str, str]
+        The file names of the fragment values, the fragment indices, and the
+        reservation counters.
+    """
+    return (f'{filename}.fragment_values.tmp',
+            f'{filename}.fragment_indices.tmp',
+            f'{filename}.counters.tmp')
+
+
+def _create_buffer(filename: str) -> None:
+    """
+    Create a feature buffer to which multiple processes can write features
+    concurrently.
+
+    The dense features are stored in a NumPy binary file with a fixed-size
+    header that is completed when the buffer is closed (see `_close_buffer`).
+    Processes reserve rows and fragment values in the buffer using counters
+    stored in a locked file (see `_reserve`), so writes can go to arbitrary
+    positions without further coordination and any number of buffers can be
+    written simultaneously. Sparse fragment values and indices are stored in
+    temporary files until the buffer is closed.
+
+    Parameters
+    ----------
+    filename : str
+        The feature buffer file name. Should be a NumPy binary file.
+    """
+    with open(filename, 'wb') as f_out:
+        f_out.write(bytes(_buffer_header_size))
+    filename_values, filename_indices, filename_counters = \
+        _get_buffer_filenames(filename)
+    open(filename_values, 'wb').close()
+    open(filename_indices, 'wb').close()
+    with open(filename_counters, 'wb') as f_out:
+        f_out.write(struct.pack('<qq', 0, 0))
+
+
+def _reserve(filename: str, num_rows: int, num_values: int) -> Tuple[int, int]:
+    """
+    Reserve consecutive rows and fragment values in a feature buffer.
+
+    Parameters
+    ----------
+    filename : str
+        The feature buffer file name.
+    num_rows : int
+        The number of rows to reserve.
+    num_values : int
+        The number of fragment values to reserve.
+
+    Returns
+    -------
+    Tuple[int, int]
+        The position of the first reserved row and fragment value.
+    """
+    with open(_get_buffer_filenames(filename)[2], 'r+b') as f_counters:
+        # The lock is released when the file is closed.
+        fcntl.flock(f_counters, fcntl.LOCK_EX)
+        row_start, value_start = struct.unpack('<qq', f_counters.read(16))
+        f_counters.seek(0)
+        f_counters.write(struct.pack('<qq', row_start + num_rows,
+                                     value_start + num_values))
+    return row_start, value_start
+
+
+def _write_buffer(filename: str, batch: SpectrumBatch,
+                  enc: encoder.MultipleEncoder)\
+        -> Tuple[int, int, np.ndarray]:
+    """
+    Encode the given spectra directly into a feature buffer.
+
+    Parameters
+    ----------
+    filename : str
+        The feature buffer file name.
+    batch : SpectrumBatch
+        The spectra to be encoded.
+    enc : encoder.MultipleEncoder
+        The MultipleEncoder used to convert spectra to features.
+
+    Returns
+    -------
+    Tuple[int, int, np.ndarray]
+        A tuple of length 3 containing: the first row of the spectra's dense
+        features, the position of their first fragment value, and the
+        fragment row pointers (CSR `indptr`) relative to that position.
+    """
+    row_start, _ = _reserve(filename, len(batch), 0)
+    offset = (_buffer_header_size +
+              row_start * enc.num_dense_features * np.float32().itemsize)
+    size = len(batch) * enc.num_dense_features * np.float32().itemsize
+    if size > 0:
+        # Make sure the file covers the reserved rows. Writing the final
+        # reserved byte never truncates rows reserved by other processes.
+        with open(filename, 'r+b') as f_out:
+            f_out.seek(offset + size - 1)
+            f_out.write(b'\0')
+        encodings = np.memmap(filename, np.float32, 'r+', offset,
+                              (len(batch), enc.num_dense_features))
+    else:
+        encodings = None
+    _, fragments = enc.encode_batch_split(batch, encodings)
+    if encodings is not None:
+        encodings.flush()
+        del encodings
+    _, value_start = _reserve(filename, 0, fragments.nnz)
+    for filename_fragment, values in zip(
+            _get_buffer_filenames(filename),
+            (fragments.data.astype(np.float32, copy=False),
+             fragments.indices.astype(np.int32, copy=False))):
+        with open(filename_fragment, 'r+b') as f_out:
+            f_out.seek(value_start * values.itemsize)
+            f_out.write(values.tobytes())
+    return row_start, value_start, fragments.indptr
+
+
+def _close_buffer(filename: str, enc: encoder.MultipleEncoder,
+                  positions: List[Tuple[int, int, np.ndarray]]) -> None:
+    """
+    Complete a feature buffer after all features have been written.
+
+    The final number of rows is written to the header of the dense features,
+    which are reordered first if necessary to match the given order of the
+    positions. The fragments are stored as a SciPy sparse CSR matrix (see
+    `get_fragment_filename`), which is streamed from the temporary fragment
+    files in fixed-size chunks so that memory use doesn't depend on the number
+    of features.
+
+    Parameters
+    ----------
+    filename : str
+        The feature buffer file name.
+    enc : encoder.MultipleEncoder
+        The MultipleEncoder used to convert spectra to features.
+    positions : List[Tuple[int, int, np.ndarray]]
+        The positions of all features written to the buffer (see
+        `_write_buffer`), in the order in which they should be stored.
+    """
+    num_rows = sum([len(indptr) - 1 for _, _, indptr in positions])
+    row_starts = [row_start for row_start, _, _ in positions]
+    if row_starts != sorted(row_starts):
+        row_size = enc.num_dense_features * np.float32().itemsize
+        with open(filename, 'rb') as f_in,\
+                open(f'{filename}.tmp', 'wb') as f_out:
+            f_out.write(bytes(_buffer_header_size))
+            for row_start, _, indptr in positions:
+                f_in.seek(_buffer_header_size + row_start * row_size)
+                shard.copy_bytes(f_in, f_out, (len(indptr) - 1) * row_size)
+        os.replace(f'{filename}.tmp', filename)
+    with open(filename, 'r+b') as f_out:
+        header = (f"{{'descr': '<f4', 'fortran_order': False, 'shape': "
+                  f"({num_rows}, {enc.num_dense_features}), }}")
+        header = header.ljust(_buffer_header_size - 11) + '\n'
+        f_out.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) +
+                    header.encode('latin1'))
+    # Write the fragments ordered by row in the same format as
+    # `ss.save_npz`.
+    filename_values, filename_indices, filename_counters = \
+        _get_buffer_filenames(filename)
+    shard.write_csr(
+        get_fragment_filename(filename),
+        (num_rows, len(enc.feature_names) - enc.num_dense_features),
+        [(filename_values, value_start * np.float32().itemsize,
+          int(indptr[-1]))
+         for _, value_start, indptr in positions],
+        [(filename_indices, value_start * np.int32().itemsize,
+          int(indptr[-1]))
+         for _, value_start, indptr in positions],
+        [indptr for _, _, indptr in positions], np.float32, np.int32)
+    os.remove(filename_values)
+    os.remove(filename_indices)
+    os.remove(filename_counters)
+
+
+def read_buffer(filename: str, enc: encoder.MultipleEncoder,
+                positions: List[Tuple[int, int, np.ndarray]])\
+        -> Tuple[shard.ShardedArray, ss.csr_matrix]:
+    """
+    Read features from a feature buffer that hasn't been completed yet.
+
+    Parameters
+    ----------
+    filename : str
+        The feature buffer file name.
+    enc : encoder.MultipleEncoder
+        The MultipleEncoder used to convert spectra to features.
+    positions : List[Tuple[int, int, np.ndarray]]
+        The positions of the features to read (see `_write_buffer`).
+
+    Returns
+    -------
+    Tuple[shard.ShardedArray, ss.csr_matrix]
+        The memory-mapped dense features and the sparse fragment features, in
+        the order of the given positions.
+    """
+    row_size = enc.num_dense_features * np.float32().itemsize
+    encodings = shard.ShardedArray([
+        np.memmap(filename, np.float32, 'r',
+                  _buffer_header_size + row_start * row_size,
+                  (len(indptr) - 1, enc.num_dense_features))
+        for row_start, _, indptr in positions])
+    filename_values, filename_indices, _ = _get_buffer_filenames(filename)
+    values, indices, indptrs, num_values = [], [], [np.zeros(1, np.int64)], 0
+    for _, value_start, indptr in positions:
+        values.append(np.fromfile(
+            filename_values, np.float32, int(indptr[-1]),
+            offset=value_start * np.float32().itemsize))
+        indices.append(np.fromfile(
+            filename_indices, np.int32, int(indptr[-1]),
+            offset=value_start * np.int32().itemsize))
+        indptrs.append(indptr[1:] + num_values)
+        num_values += int(indptr[-1])
+    fragments = ss.csr_matrix(
+        (np.concatenate(values), np.concatenate(indices),
+         np.concatenate(indptrs)),
+        (len(encodings), len(enc.feature_names) - enc.num_dense_features))
+    return encodings, fragments
+
+
+def _remove_buffer(filename: str) -> None:
+    """
+    Remove a feature buffer without completing it.
+
+    Parameters
+    ----------
+    filename : str
+        The feature buffer file name.
+    """
+    os.remove(filename)
+    for filename_buffer in _get_buffer_filenames(filename):
+        os.remove(filename_buffer)
 
 
 def convert_peaks_to_features(metadata_filename: str)\
@@ -75,12 +1086,15 @@ def convert_peaks_to_features(metadata_filename: str)\
     """
     Convert all peak files listed in the given metadata file to features.
 
-    Encoded spectra will be stored as NumPy binary files for each dataset in
-    the metadata. A corresponding index file for each dataset containing the
-    peak filenames, spectrum identifiers, and indexes in the NumPy binary file
-    will be stored as Parquet files.
+    Encoded spectra will be stored for each dataset in the metadata (see
+    `save_features`). A corresponding index file for each dataset containing
+    the peak filenames, spectrum identifiers, and indexes in the feature files
+    will be stored as Parquet files, as well as statistics about reading and
+    converting each peak file (see `get_stats_filename`). The index files
+    additionally identify the encoder and the versions of the peak files that
+    were used to generate the features (see `get_feature_index_keys`).
 
-    If both the NumPy binary file and the Parquet index file already exist, the
+    If both the feature files and the Parquet index file already exist, the
     corresponding dataset will _not_ be processed again.
 
     Parameters
@@ -91,19 +1105,7 @@ def convert_peaks_to_features(metadata_filename: str)\
     metadata = pd.read_parquet(metadata_filename)
     metadata = metadata.set_index(['dataset', 'filename', 'scan'])
 
-    enc = encoder.MultipleEncoder([
-        encoder.PrecursorEncoder(
-            config.num_bits_precursor_mz, config.precursor_mz_min,
-            config.precursor_mz_max, config.num_bits_precursor_mass,
-            config.precursor_mass_min, config.precursor_mass_max,
-            config.precursor_charge_max),
-        encoder.FragmentEncoder(
-            config.fragment_mz_min, config.fragment_mz_max, config.bin_size),
-        encoder.ReferenceSpectraEncoder(
-            config.ref_spectra_filename, config.fragment_mz_min,
-            config.fragment_mz_max, config.fragment_mz_tol,
-            config.num_ref_spectra)
-    ])
+    enc = get_encoder()
 
     logger.info('Convert peak files for metadata file %s', metadata_filename)
     feat_dir = os.path.join(os.environ['GLEAMS_HOME'], 'data', 'feature',
@@ -113,42 +1115,118 @@ def convert_peaks_to_features(metadata_filename: str)\
             os.makedirs(os.path.join(feat_dir))
         except OSError:
             pass
-    dataset_total = len(metadata.index.unique('dataset'))
-    for dataset_i, (dataset, metadata_dataset) in enumerate(
-            metadata.groupby('dataset', as_index=False, sort=False), 1):
+    # Convert the peak files of all datasets that haven't been processed yet
+    # in a single run.
+    feat_dir = os.path.join(os.environ['GLEAMS_HOME'], 'data', 'feature')
+    filenames, filenames_index = [], {}
+    for dataset, metadata_dataset in metadata.groupby(
+            'dataset', as_index=False, sort=False):
         # Group all encoded spectra per dataset.
-        feat_dir = os.path.join(os.environ['GLEAMS_HOME'], 'data', 'feature')
         filename_encodings = os.path.join(
             feat_dir, 'dataset', f'{dataset}.npy')
         filename_index = os.path.join(
             feat_dir, 'dataset', f'{dataset}.parquet')
         if (not os.path.isfile(filename_encodings) or
-                not os.path.isfile(filename_index)):
-            logging.info('Process dataset %s [%3d/%3d]', dataset, dataset_i,
-                         dataset_total)
-            metadata_index, encodings = [], []
-            for filename, file_scans, file_encodings in\
-                    joblib.Parallel(n_jobs=-1, backend='multiprocessing')(
-                        joblib.delayed(_peaks_to_features)
-                        (dataset, fn, md_fn, enc)
-                        for fn, md_fn in metadata_dataset.groupby(
-                            'filename', as_index=False, sort=False)):
-                if file_scans is not None and len(file_scans) > 0:
-                    metadata_index.extend([(dataset, filename, scan)
-                                           for scan in file_scans['scan']])
-                    encodings.extend(file_encodings)
-            # Store the encoded spectra in a file per dataset.
-            if len(metadata_index) > 0:
-                np.save(filename_encodings, np.vstack(encodings))
-                metadata.loc[metadata_index].reset_index().to_parquet(
-                    filename_index, index=False)
+                not os.path.isfile(get_fragment_filename(filename_encodings))
+                or not os.path.isfile(filename_index)):
+            filenames_index[filename_encodings] = dataset, filename_index
+            for filename, metadata_file in metadata_dataset.groupby(
+                    'filename', as_index=False, sort=False):
+                filenames.append((dataset, filename, metadata_file,
+                                  filename_encodings))
+    logger.info('Process %d peak files from %d datasets', len(filenames),
+                len(filenames_index))
+    # The encoded spectra are streamed to the feature files of each dataset,
+    # which are completed as soon as all of the dataset's peak files have been
+    # processed.
+    for dataset_i, (filename_encodings, file_scans, file_stats) in \
+            enumerate(map_peaks_to_features(filenames, enc), 1):
+        dataset, filename_index = filenames_index[filename_encodings]
+        logger.info('Processed dataset %s [%3d/%3d]', dataset, dataset_i,
+                    len(filenames_index))
+        file_stats.to_parquet(get_stats_filename(filename_index),
+                              index=False)
+        metadata_index = [(dataset, filename, scan)
+                          for filename, scans in file_scans
+                          for scan in scans['scan']]
+        if len(metadata_index) > 0:
+            _write_feature_index(
+                filename_index,
+                metadata.loc[metadata_index].reset_index(), enc,
+                {filename: cache.get_file_key(os.path.join(
+                    os.environ['GLEAMS_HOME'], 'data', 'peak', dataset,
+                    filename))
+                 for filename, _ in file_scans})
+        else:
+            os.remove(filename_encodings)
+            os.remove(get_fragment_filename(filename_encodings))
+
+
+def _write_feature_index(filename: str, index: pd.DataFrame,
+                         enc: encoder.MultipleEncoder,
+                         file_keys: Dict[str, str]) -> None:
+    """
+    Write the feature index of a dataset, including the keys that identify
+    the encoder and the peak files that were used to generate the features.
+
+    Parameters
+    ----------
+    filename : str
+        The feature index file name. Should be a Parquet file.
+    index : pd.DataFrame
+        The feature index, with the metadata of the spectra in the order of
+        their features.
+    enc : encoder.MultipleEncoder
+        The MultipleEncoder used to convert the spectra to features.
+    file_keys : Dict[str, str]
+        The keys of the converted peak files (see `cache.get_file_key`) by
+        peak file name.
+    """
+    table = pa.Table.from_pandas(index, preserve_index=False)
+    table = table.replace_schema_metadata({
+        **(table.schema.metadata or {}),
+        b'encoder_key': cache.get_encoder_key(enc).encode(),
+        b'file_keys': json.dumps(file_keys).encode()})
+    pq.write_table(table, filename)
+
+
+def get_feature_index_keys(filename: str)\
+        -> Tuple[Optional[str], Dict[str, str]]:
+    """
+    Get the keys that identify the encoder and the peak files that were used
+    to generate the features of a dataset (see `convert_peaks_to_features`).
+
+    Parameters
+    ----------
+    filename : str
+        The feature index file name.
+
+    Returns
+    -------
+    Tuple[Optional[str], Dict[str, str]]
+        A tuple of length 2 containing: the encoder key (see
+        `cache.get_encoder_key`), and the keys of the peak files (see
+        `cache.get_file_key`) by peak file name. The encoder key is None and
+        the peak file keys are empty if the index file doesn't contain keys.
+    """
+    metadata = pq.read_schema(filename).metadata or {}
+    encoder_key = metadata.get(b'encoder_key')
+    file_keys = metadata.get(b'file_keys')
+    return (encoder_key.decode() if encoder_key is not None else None,
+            json.loads(file_keys.decode()) if file_keys is not None else {})
 
 
 def combine_features(metadata_filename: str) -> None:
     """
-    Combine feature files for multiple datasets into a single feature file.
+    Combine feature files for multiple datasets into a sharded feature store.
+
+    The per-dataset feature files are not copied. Instead a manifest refers to
+    them in order (see `shard.write_manifest`), which can be read using
+    `load_features`. The feature indexes are combined in a single Parquet
+    file.
 
-    If the combined feature file already exists it will _not_ be recreated.
+    If the combined feature manifest already exists it will _not_ be
+    recreated.
 
     Parameters
     ----------
@@ -159,14 +1237,14 @@ def combine_features(metadata_filename: str) -> None:
     feat_dir = os.path.join(os.environ['GLEAMS_HOME'], 'data', 'feature')
     feat_filename = os.path.join(feat_dir, os.path.splitext(
         os.path.basename(metadata_filename))[0].replace('metadata', 'feature'))
-    if (os.path.isfile(f'{feat_filename}.npy') and
+    if (os.path.isfile(f'{feat_filename}{shard.manifest_ext}') and
             os.path.isfile(f'{feat_filename}.parquet')):
         return
     datasets = pd.read_parquet(
         metadata_filename, columns=['dataset'])['dataset'].unique()
     logger.info('Combine features for metadata file %s containing %d datasets',
                 metadata_filename, len(datasets))
-    encodings, indexes = [], []
+    shard_filenames, indexes = [], []
     for i, dataset in enumerate(datasets, 1):
         logger.debug('Append dataset %s [%3d/%3d]', dataset, i, len(datasets))
         dataset_encodings_filename = os.path.join(
@@ -174,11 +1252,130 @@ def combine_features(metadata_filename: str) -> None:
         dataset_index_filename = os.path.join(
             feat_dir, 'dataset', f'{dataset}.parquet')
         if (not os.path.isfile(dataset_encodings_filename) or
+                not os.path.isfile(
+                    get_fragment_filename(dataset_encodings_filename)) or
                 not os.path.isfile(dataset_index_filename)):
             logger.warning('Missing features for dataset %s, skipping...',
                            dataset)
         else:
-            encodings.append(np.load(dataset_encodings_filename))
+            shard_filenames.append(dataset_encodings_filename)
             indexes.append(pq.read_table(dataset_index_filename))
-    np.save(f'{feat_filename}.npy', np.vstack(encodings))
     pq.write_table(pa.concat_tables(indexes), f'{feat_filename}.parquet')
+    shard.write_manifest(f'{feat_filename}{shard.manifest_ext}',
+                         shard_filenames)
+
+
+def concatenate_features(filename: str, out_filename: str) -> None:
+    """
+    Concatenate sharded features into a single feature file.
+
+    The features are copied byte by byte without reading them into memory
+    (see `shard.concatenate`).
+
+    Parameters
+    ----------
+    filename : str
+        The sharded feature manifest.
+    out_filename : str
+        The concatenated dense feature file name. Should be a NumPy binary
+        file.
+    """
+    shard_filenames = shard.read_manifest(filename)
+    logger.info('Concatenate %d feature shards from manifest %s to file %s',
+                len(shard_filenames), filename, out_filename)
+    shard.concatenate(shard_filenames, out_filename)
+    shard.concatenate_csr(
+        [get_fragment_filename(shard_filename)
+         for shard_filename in shard_filenames],
+        get_fragment_filename(out_filename))
+
+
+def get_fragment_filename(filename: str) -> str:
+    """
+    Get the file name of the sparse fragment features corresponding to the
+    given dense feature file.
+
+    Parameters
+    ----------
+    filename : str
+        The dense feature file name.
+
+    Returns
+    -------
+    str
+        The sparse fragment feature file name.
+    """
+    return f'{os.path.splitext(filename)[0]}_fragment.npz'
+
+
+def get_stats_filename(filename: str) -> str:
+    """
+    Get the file name of the peak file statistics (see
+    `map_peaks_to_features`) corresponding to the given spectrum index file.
+
+    Parameters
+    ----------
+    filename : str
+        The spectrum index file name.
+
+    Returns
+    -------
+    str
+        The peak file statistics file name.
+    """
+    return f'{os.path.splitext(filename)[0]}_stats.parquet'
+
+
+def save_features(filename: str, encodings: np.ndarray,
+                  fragments: ss.csr_matrix) -> None:
+    """
+    Save encoded spectra.
+
+    Dense features (precursor and reference spectra features) are stored as a
+    NumPy binary file. Sparse fragment features are stored as a SciPy sparse
+    CSR matrix in a separate file (see `get_fragment_filename`).
+
+    Parameters
+    ----------
+    filename : str
+        The dense feature file name. Should be a NumPy binary file.
+    encodings : np.ndarray
+        The dense features with one row per spectrum.
+    fragments : ss.csr_matrix
+        The sparse fragment features with one row per spectrum.
+    """
+    np.save(filename, encodings)
+    ss.save_npz(get_fragment_filename(filename), fragments, False)
+
+
+def load_features(filename: str)\
+        -> Tuple[Union[np.ndarray, shard.ShardedArray],
+                 Union[ss.csr_matrix, shard.ShardedArray]]:
+    """
+    Load encoded spectra stored using `save_features` or combined using
+    `combine_features`.
+
+    Parameters
+    ----------
+    filename : str
+        The dense feature file name. Should be a NumPy binary file or a sharded
+        feature manifest.
+
+    Returns
+    -------
+    Tuple[Union[np.ndarray, shard.ShardedArray],
+          Union[ss.csr_matrix, shard.ShardedArray]]
+        The (memory-mapped) dense features and the sparse fragment features.
+        Sharded features are memory-mapped as ShardedArrays of which selected
+        rows are read on access.
+    """
+    if shard.is_manifest(filename):
+        shard_filenames = shard.read_manifest(filename)
+        return (shard.ShardedArray([np.load(shard_filename, mmap_mode='r')
+                                    for shard_filename in shard_filenames]),
+                shard.ShardedArray([
+                    shard.CsrShard(get_fragment_filename(shard_filename))
+                    for shard_filename in shard_filenames]))
+    else:
+        return (np.load(filename, mmap_mode='r'),
+                ss.load_npz(get_fragment_filename(filename)))
@@ -0,0 +1,626 @@
+import copy
+import json
+import logging
+import os
+import struct
+import zipfile
+from typing import IO, List, Sequence, Tuple, Union
+
+import numpy as np
+import scipy.sparse as ss
+
+
+logger = logging.getLogger('gleams')
+
+
+# File extension of sharded array manifests.
+manifest_ext = '.json'
+# Maximum number of bytes copied at once when concatenating shards.
+_chunk_size = 2 ** 22
+
+
+class CsrShard:
+    """
+    A memory-mapped SciPy sparse CSR matrix stored as an uncompressed NumPy
+    zip file (see `ss.save_npz`).
+
+    Selected rows are converted to regular sparse matrices on access, the full
+    matrix is never read into memory.
+    """
+
+    def __init__(self, filename: str):
+        """
+        Memory-map the sparse CSR matrix in the given file.
+
+        Parameters
+        ----------
+        filename : str
+            The sparse matrix file name.
+        """
+        with np.load(filename) as arrays:
+            matrix_format = arrays['format'].item()
+            if not isinstance(matrix_format, str):
+                matrix_format = matrix_format.decode('ascii')
+            if matrix_format != 'csr':
+                raise ValueError(f'Sparse matrix {filename} is not in CSR '
+                                 f'format')
+            self.shape = tuple(int(i) for i in arrays['shape'])
+        self.data = np.asarray(_memmap_npz_member(filename, 'data'))
+        self.indices = np.asarray(_memmap_npz_member(filename, 'indices'))
+        self.indptr = np.asarray(_memmap_npz_member(filename, 'indptr'))
+        self.dtype = self.data.dtype
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def get_rows(self, start: int, stop: int) -> 'CsrShard':
+        """
+        Get a memory-mapped view of consecutive rows of the sparse matrix.
+
+        Parameters
+        ----------
+        start : int
+            The first row of the view.
+        stop : int
+            The row after the last row of the view.
+
+        Returns
+        -------
+        CsrShard
+            A CsrShard with the selected rows, which shares the memory-mapped
+            values and column indices with this CsrShard.
+        """
+        view = copy.copy(self)
+        view.indptr = self.indptr[start:stop + 1]
+        view.shape = (len(view.indptr) - 1, self.shape[1])
+        return view
+
+    def __getitem__(self, idx: Union[int, np.ndarray, slice])\
+            -> ss.csr_matrix:
+        """
+        Get the given rows of the sparse matrix.
+
+        Parameters
+        ----------
+        idx : Union[int, np.ndarray, slice]
+            The index or indexes of the rows.
+
+        Returns
+        -------
+        ss.csr_matrix
+            A sparse matrix with the selected rows.
+        """
+        idx = _get_row_index(idx, self.shape[0])
+        starts = self.indptr[idx].astype(np.int64)
+        sizes = self.indptr[idx + 1] - starts
+        indptr = np.zeros(len(idx) + 1, np.int64)
+        np.cumsum(sizes, out=indptr[1:])
+        value_idx = _concatenate_ranges(starts, sizes)
+        return ss.csr_matrix(
+            (self.data[value_idx], self.indices[value_idx], indptr),
+            (len(idx), self.shape[1]))
+
+
+class ShardedArray:
+    """
+    A virtual array consisting of the rows of multiple shards.
+
+    Rows are addressed by their global position, which is mapped to a shard
+    and a position within that shard using an offset table. Shards are
+    typically memory-mapped NumPy arrays or `CsrShard`s, so only the selected
+    rows are read.
+    """
+
+    def __init__(self, shards: Sequence[Union[np.ndarray, CsrShard]]):
+        """
+        Instantiate a ShardedArray.
+
+        Parameters
+        ----------
+        shards : Sequence[Union[np.ndarray, CsrShard]]
+            The shards. All shards should have the same number of columns and
+            data type.
+        """
+        if len(shards) == 0:
+            raise ValueError('At least one shard is required')
+        self.shards = list(shards)
+        for shard in self.shards[1:]:
+            if (shard.shape[1:] != self.shards[0].shape[1:] or
+                    shard.dtype != self.shards[0].dtype):
+                raise ValueError('Incompatible shard shapes or data types')
+        # Global position of the first row of each shard, followed by the
+        # total number of rows.
+        self.offsets = np.zeros(len(self.shards) + 1, np.int64)
+        np.cumsum([shard.shape[0] for shard in self.shards],
+                  out=self.offsets[1:])
+        self.shape = (int(self.offsets[-1]), *self.shards[0].shape[1:])
+        self.dtype = self.shards[0].dtype
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, idx: Union[int, np.ndarray, slice])\
+            -> Union[np.ndarray, ss.csr_matrix]:
+        """
+        Get the given rows.
+
+        Parameters
+        ----------
+        idx : Union[int, np.ndarray, slice]
+            The index, indexes, or boolean mask of the rows.
+
+        Returns
+        -------
+        Union[np.ndarray, ss.csr_matrix]
+            The selected rows, as a NumPy array for dense shards or a sparse
+            CSR matrix for sparse shards. A slice within a single dense shard
+            returns a view on that shard.
+        """
+        if isinstance(idx, (int, np.integer)):
+            idx = int(idx) + (len(self) if idx < 0 else 0)
+            if not 0 <= idx < len(self):
+                raise IndexError(f'Index {idx} out of bounds for '
+                                 f'{len(self)} rows')
+            shard_i = int(np.searchsorted(self.offsets, idx, 'right')) - 1
+            return self.shards[shard_i][idx - self.offsets[shard_i]]
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            shard_i = int(np.searchsorted(self.offsets, start, 'right')) - 1
+            if (step == 1 and start < stop and
+                    stop <= self.offsets[shard_i + 1]):
+                return self.shards[shard_i][start - self.offsets[shard_i]:
+                                            stop - self.offsets[shard_i]]
+        idx = _get_row_index(idx, len(self))
+        # Group the rows by shard.
+        shard_idx = np.searchsorted(self.offsets, idx, 'right') - 1
+        order = np.argsort(shard_idx, kind='mergesort')
+        bounds = np.searchsorted(shard_idx[order],
+                                 np.arange(len(self.shards) + 1))
+        shard_rows = [(shard_i, order[bounds[shard_i]:bounds[shard_i + 1]])
+                      for shard_i in np.flatnonzero(bounds[1:] > bounds[:-1])]
+        if not isinstance(self.shards[0], CsrShard):
+            rows = np.empty((len(idx), *self.shape[1:]), self.dtype)
+            for shard_i, rows_i in shard_rows:
+                rows[rows_i] = self.shards[shard_i][
+                    idx[rows_i] - self.offsets[shard_i]]
+            return rows
+        else:
+            starts = np.empty(len(idx), np.int64)
+            sizes = np.empty(len(idx), np.int64)
+            for shard_i, rows_i in shard_rows:
+                local_idx = idx[rows_i] - self.offsets[shard_i]
+                starts[rows_i] = self.shards[shard_i].indptr[local_idx]
+                sizes[rows_i] = (self.shards[shard_i].indptr[local_idx + 1] -
+                                 starts[rows_i])
+            indptr = np.zeros(len(idx) + 1, np.int64)
+            np.cumsum(sizes, out=indptr[1:])
+            data = np.empty(indptr[-1], self.dtype)
+            indices = np.empty(indptr[-1], self.shards[0].indices.dtype)
+            for shard_i, rows_i in shard_rows:
+                value_idx = _concatenate_ranges(indptr[rows_i], sizes[rows_i])
+                shard_value_idx = _concatenate_ranges(starts[rows_i],
+                                                      sizes[rows_i])
+                data[value_idx] = self.shards[shard_i].data[shard_value_idx]
+                indices[value_idx] = \
+                    self.shards[shard_i].indices[shard_value_idx]
+            return ss.csr_matrix((data, indices, indptr),
+                                 (len(idx), self.shape[1]))
+
+
+def is_manifest(filename: str) -> bool:
+    """
+    Check whether the given file is a sharded array manifest.
+
+    Parameters
+    ----------
+    filename : str
+        The file name.
+
+    Returns
+    -------
+    bool
+        True if the file name has the manifest extension, False otherwise.
+    """
+    return os.path.splitext(filename)[1].lower() == manifest_ext
+
+
+def write_manifest(filename: str, shard_filenames: Sequence[str]) -> None:
+    """
+    Write a manifest that combines the given NumPy binary files in a sharded
+    array.
+
+    Only the array headers are read, the shards are not modified or copied.
+    Shard file names are stored relative to the manifest.
+
+    Parameters
+    ----------
+    filename : str
+        The manifest file name.
+    shard_filenames : Sequence[str]
+        The NumPy binary files with the rows of the sharded array, in order.
+    """
+    shards = []
+    for shard_filename in shard_filenames:
+        with open(shard_filename, 'rb') as f_in:
+            shape, dtype = _read_npy_header(f_in)
+        if len(shards) > 0 and (shape[1:] != tuple(shards[0]['shape'][1:]) or
+                                dtype.str != shards[0]['dtype']):
+            raise ValueError(f'Incompatible shape or data type of shard '
+                             f'{shard_filename}')
+        shards.append({
+            'filename': os.path.relpath(
+                shard_filename, os.path.dirname(os.path.abspath(filename))),
+            'shape': shape, 'dtype': dtype.str})
+    logger.debug('Write manifest %s with %d shards (%d rows)', filename,
+                 len(shards), sum([shard['shape'][0] for shard in shards]))
+    with open(f'{filename}.tmp', 'w') as f_out:
+        json.dump({'shards': shards}, f_out, indent=1)
+    os.replace(f'{filename}.tmp', filename)
+
+
+def read_manifest(filename: str) -> List[str]:
+    """
+    Get the shard file names from a sharded array manifest.
+
+    Parameters
+    ----------
+    filename : str
+        The manifest file name.
+
+    Returns
+    -------
+    List[str]
+        The shard file names, in order.
+
+    Raises
+    ------
+    ValueError
+        If a shard was modified after the manifest was written.
+    """
+    with open(filename) as f_in:
+        shards = json.load(f_in)['shards']
+    manifest_dir = os.path.dirname(os.path.abspath(filename))
+    shard_filenames = []
+    for shard in shards:
+        shard_filename = os.path.normpath(
+            os.path.join(manifest_dir, shard['filename']))
+        with open(shard_filename, 'rb') as f_in:
+            shape, dtype = _read_npy_header(f_in)
+        if shape != tuple(shard['shape']) or dtype.str != shard['dtype']:
+            raise ValueError(f'Shard {shard_filename} doesn\'t match manifest '
+                             f'{filename}')
+        shard_filenames.append(shard_filename)
+    return shard_filenames
+
+
+def load(filename: str) -> Union[np.ndarray, ShardedArray]:
+    """
+    Memory-map a NumPy binary file or a sharded array.
+
+    Parameters
+    ----------
+    filename : str
+        A NumPy binary file or a sharded array manifest.
+
+    Returns
+    -------
+    Union[np.ndarray, ShardedArray]
+        The memory-mapped array, or a ShardedArray consisting of memory-mapped
+        shards.
+    """
+    if is_manifest(filename):
+        return ShardedArray([np.load(shard_filename, mmap_mode='r')
+                             for shard_filename in read_manifest(filename)])
+    else:
+        return np.load(filename, mmap_mode='r')
+
+
+def concatenate(filenames: Union[str, Sequence[str]],
+                out_filename: str) -> None:
+    """
+    Concatenate the rows of multiple NumPy binary files into a single file.
+
+    The array data is copied byte by byte in fixed-size chunks, the arrays are
+    never read into memory.
+
+    Parameters
+    ----------
+    filenames : Union[str, Sequence[str]]
+        The NumPy binary files to be concatenated, or a sharded array manifest.
+    out_filename : str
+        The concatenated NumPy binary file name.
+    """
+    if isinstance(filenames, str):
+        filenames = read_manifest(filenames)
+    shapes, dtypes, offsets = [], [], []
+    for filename in filenames:
+        with open(filename, 'rb') as f_in:
+            shape, dtype = _read_npy_header(f_in)
+            offsets.append(f_in.tell())
+        if len(shapes) > 0 and (shape[1:] != shapes[0][1:] or
+                                dtype != dtypes[0]):
+            raise ValueError(f'Incompatible shape or data type of array '
+                             f'{filename}')
+        shapes.append(shape)
+        dtypes.append(dtype)
+    if len(shapes) == 0:
+        raise ValueError('At least one array is required')
+    with open(f'{out_filename}.tmp', 'wb') as f_out:
+        np.lib.format.write_array_header_1_0(f_out, {
+            'descr': np.lib.format.dtype_to_descr(dtypes[0]),
+            'fortran_order': False,
+            'shape': (sum([shape[0] for shape in shapes]), *shapes[0][1:])})
+        for filename, shape, offset in zip(filenames, shapes, offsets):
+            with open(filename, 'rb') as f_in:
+                f_in.seek(offset)
+                copy_bytes(f_in, f_out,
+                            int(np.prod(shape)) * dtypes[0].itemsize)
+    os.replace(f'{out_filename}.tmp', out_filename)
+
+
+def concatenate_csr(filenames: Sequence[str], out_filename: str) -> None:
+    """
+    Concatenate the rows of multiple SciPy sparse CSR matrices into a single
+    file.
+
+    The matrix data is copied byte by byte in fixed-size chunks, the matrices
+    are never read into memory.
+
+    Parameters
+    ----------
+    filenames : Sequence[str]
+        The sparse matrix files to be concatenated. Should be uncompressed
+        NumPy zip files (see `ss.save_npz`).
+    out_filename : str
+        The concatenated sparse matrix file name.
+    """
+    shards = [CsrShard(filename) for filename in filenames]
+    offsets = [(_get_npz_member_offset(filename, 'data')[2],
+                _get_npz_member_offset(filename, 'indices')[2])
+               for filename in filenames]
+    if len(shards) == 0:
+        raise ValueError('At least one matrix is required')
+    for filename, shard in zip(filenames[1:], shards[1:]):
+        if (shard.shape[1] != shards[0].shape[1] or
+                shard.data.dtype != shards[0].data.dtype or
+                shard.indices.dtype != shards[0].indices.dtype):
+            raise ValueError(f'Incompatible shape or data type of matrix '
+                             f'{filename}')
+    write_csr(out_filename,
+              (sum([shard.shape[0] for shard in shards]), shards[0].shape[1]),
+              [(filename, offset, len(shard.data)) for filename, shard,
+               (offset, _) in zip(filenames, shards, offsets)],
+              [(filename, offset, len(shard.indices)) for filename, shard,
+               (_, offset) in zip(filenames, shards, offsets)],
+              [shard.indptr for shard in shards], shards[0].data.dtype,
+              shards[0].indices.dtype)
+
+
+def write_csr(filename: str, shape: Tuple[int, int],
+              data: Sequence[Tuple[str, int, int]],
+              indices: Sequence[Tuple[str, int, int]],
+              indptrs: Sequence[np.ndarray], data_dtype: np.dtype,
+              indices_dtype: np.dtype) -> None:
+    """
+    Write a SciPy sparse CSR matrix from segments of rows stored on disk.
+
+    The matrix is written in the same format as `ss.save_npz`, without
+    compression. Values and column indices are copied byte by byte in
+    fixed-size chunks, so memory use doesn't depend on the size of the matrix.
+
+    Parameters
+    ----------
+    filename : str
+        The sparse matrix file name.
+    shape : Tuple[int, int]
+        The shape of the matrix.
+    data : Sequence[Tuple[str, int, int]]
+        Tuples of the file name, byte offset, and number of values of each
+        segment of values.
+    indices : Sequence[Tuple[str, int, int]]
+        Tuples of the file name, byte offset, and number of values of each
+        segment of column indices.
+    indptrs : Sequence[np.ndarray]
+        The row pointers of each segment, starting at zero.
+    data_dtype : np.dtype
+        The data type of the values.
+    indices_dtype : np.dtype
+        The data type of the column indices.
+    """
+    num_values = sum([segment[2] for segment in data])
+    with zipfile.ZipFile(f'{filename}.tmp', 'w', zipfile.ZIP_STORED,
+                         True) as f_zip:
+        for name, segments, dtype in (('data', data, np.dtype(data_dtype)),
+                                      ('indices', indices,
+                                       np.dtype(indices_dtype))):
+            with f_zip.open(f'{name}.npy', 'w', force_zip64=True) as f_out:
+                np.lib.format.write_array_header_1_0(f_out, {
+                    'descr': np.lib.format.dtype_to_descr(dtype),
+                    'fortran_order': False, 'shape': (num_values,)})
+                for segment_filename, offset, size in segments:
+                    with open(segment_filename, 'rb') as f_in:
+                        f_in.seek(offset)
+                        copy_bytes(f_in, f_out, size * dtype.itemsize)
+        with f_zip.open('indptr.npy', 'w', force_zip64=True) as f_out:
+            np.lib.format.write_array_header_1_0(f_out, {
+                'descr': np.lib.format.dtype_to_descr(np.dtype(np.int64)),
+                'fortran_order': False, 'shape': (shape[0] + 1,)})
+            f_out.write(np.zeros(1, np.int64).tobytes())
+            value_offset, chunk_rows = 0, _chunk_size // 8
+            for indptr in indptrs:
+                for start in range(1, len(indptr), chunk_rows):
+                    f_out.write((np.asarray(
+                        indptr[start:start + chunk_rows], np.int64) +
+                        value_offset).tobytes())
+                value_offset += int(indptr[-1])
+        for name, value in (('format', np.asarray(b'csr')),
+                            ('shape', np.asarray(shape, np.int64))):
+            with f_zip.open(f'{name}.npy', 'w') as f_out:
+                np.lib.format.write_array(f_out, value)
+    os.replace(f'{filename}.tmp', filename)
+
+
+def _get_row_index(idx: Union[int, np.ndarray, slice],
+                   num_rows: int) -> np.ndarray:
+    """
+    Convert an index, indexes, boolean mask, or slice to non-negative row
+    indexes.
+
+    Parameters
+    ----------
+    idx : Union[int, np.ndarray, slice]
+        The index, indexes, boolean mask, or slice of the rows.
+    num_rows : int
+        The total number of rows.
+
+    Returns
+    -------
+    np.ndarray
+        The row indexes.
+
+    Raises
+    ------
+    IndexError
+        If any of the indexes is out of bounds.
+    """
+    if isinstance(idx, slice):
+        return np.arange(*idx.indices(num_rows))
+    idx = np.atleast_1d(np.asarray(idx))
+    if idx.dtype == np.bool_:
+        if len(idx) != num_rows:
+            raise IndexError(f'Boolean index of length {len(idx)} doesn\'t '
+                             f'match {num_rows} rows')
+        return np.flatnonzero(idx)
+    idx = idx.astype(np.int64)
+    idx[idx < 0] += num_rows
+    if len(idx) > 0 and (idx.min() < 0 or idx.max() >= num_rows):
+        raise IndexError(f'Index out of bounds for {num_rows} rows')
+    return idx
+
+
+def _concatenate_ranges(starts: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    """
+    Get the concatenated indexes of multiple ranges.
+
+    Parameters
+    ----------
+    starts : np.ndarray
+        The start indexes of the ranges.
+    sizes : np.ndarray
+        The sizes of the ranges.
+
+    Returns
+    -------
+    np.ndarray
+        The indexes `starts[i]:starts[i] + sizes[i]` of all ranges `i`
+        concatenated.
+    """
+    ends = np.cumsum(sizes)
+    return (np.repeat(starts - ends + sizes, sizes) +
+            np.arange(ends[-1] if len(ends) > 0 else 0))
+
+
+def _memmap_npz_member(filename: str, name: str) -> np.ndarray:
+    """
+    Memory-map an array stored in an uncompressed NumPy zip file.
+
+    Parameters
+    ----------
+    filename : str
+        The NumPy zip file name.
+    name : str
+        The name of the array.
+
+    Returns
+    -------
+    np.ndarray
+        The read-only memory-mapped array, or an empty array.
+    """
+    shape, dtype, offset = _get_npz_member_offset(filename, name)
+    if np.prod(shape) > 0:
+        return np.memmap(filename, dtype, 'r', offset, shape)
+    else:
+        return np.empty(shape, dtype)
+
+
+def _get_npz_member_offset(filename: str, name: str)\
+        -> Tuple[Tuple[int, ...], np.dtype, int]:
+    """
+    Get the position of an array stored in an uncompressed NumPy zip file.
+
+    Parameters
+    ----------
+    filename : str
+        The NumPy zip file name.
+    name : str
+        The name of the array.
+
+    Returns
+    -------
+    Tuple[Tuple[int, ...], np.dtype, int]
+        The shape, data type, and byte offset of the array data in the file.
+
+    Raises
+    ------
+    ValueError
+        If the array is compressed.
+    """
+    with zipfile.ZipFile(filename) as f_zip:
+        info = f_zip.getinfo(f'{name}.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError(f'Array {name} in {filename} is compressed and '
+                         f'can\'t be memory-mapped')
+    with open(filename, 'rb') as f_in:
+        # Skip the zip local file header.
+        f_in.seek(info.header_offset + 26)
+        name_len, extra_len = struct.unpack('<HH', f_in.read(4))
+        f_in.seek(name_len + extra_len, os.SEEK_CUR)
+        shape, dtype = _read_npy_header(f_in)
+        return shape, dtype, f_in.tell()
+
+
+def _read_npy_header(f_in: IO) -> Tuple[Tuple[int, ...], np.dtype]:
+    """
+    Read the NumPy array header at the current position of the given file.
+
+    Parameters
+    ----------
+    f_in : IO
+        The binary file object.
+
+    Returns
+    -------
+    Tuple[Tuple[int, ...], np.dtype]
+        The shape and data type of the array.
+    """
+    version = np.lib.format.read_magic(f_in)
+    if version == (1, 0):
+        shape, fortran_order, dtype = \
+            np.lib.format.read_array_header_1_0(f_in)
+    else:
+        shape, fortran_order, dtype = \
+            np.lib.format.read_array_header_2_0(f_in)
+    if fortran_order:
+        raise ValueError('Arrays in Fortran order are not supported')
+    return shape, dtype
+
+
+def copy_bytes(f_in: IO, f_out: IO, size: int) -> None:
+    """
+    Copy the given number of bytes between files in fixed-size chunks.
+
+    Parameters
+    ----------
+    f_in : IO
+        The file object to read from, positioned at the first byte to copy.
+    f_out : IO
+        The file object to write to.
+    size : int
+        The number of bytes to copy.
+    """
+    while size > 0:
+        chunk = f_in.read(min(size, _chunk_size))
+        if len(chunk) == 0:
+            raise EOFError('Unexpected end of file')
+        f_out.write(chunk)
+        size -= len(chunk)
@@ -1,11 +1,13 @@
 import functools
 import math
+from typing import Tuple
 
 import numba as nb
 import numpy as np
 from spectrum_utils.spectrum import MsmsSpectrum
 
 from gleams import config
+from gleams.ms_io.spectrum_batch import SpectrumBatch
 
 
 @nb.njit
@@ -94,6 +96,331 @@ def preprocess(spectrum: MsmsSpectrum, mz_min, mz_max) -> MsmsSpectrum:
     return spectrum
 
 
+def preprocess_batch(batch: SpectrumBatch, mz_min, mz_max) -> SpectrumBatch:
+    """
+    Preprocess all spectra in the given batch.
+
+    Preprocessing is identical to `preprocess` for individual spectra, without
+    creating objects for the individual spectra. All preprocessing steps are
+    performed in a single pass over each spectrum's peaks, with spectra
+    processed in parallel.
+
+    Parameters
+    ----------
+    batch : SpectrumBatch
+        The spectra to be preprocessed.
+    mz_min : float
+        The minimum m/z of the peaks to retain.
+    mz_max : float
+        The maximum m/z of the peaks to retain.
+
+    Returns
+    -------
+    SpectrumBatch
+        The preprocessed spectra. Spectra of insufficient quality are marked
+        as invalid in the batch's `is_valid` mask and don't contain any peaks.
+    """
+    if batch.is_processed:
+        return batch
+
+    scaling = config.scaling
+    if scaling == 'sqrt':
+        scaling = 'root'
+    # Each spectrum's processed peaks are written at its original position in
+    # the output buffers.
+    mz = np.empty_like(batch.mz)
+    intensity = np.empty_like(batch.intensity)
+    num_peaks = np.zeros(len(batch), np.int64)
+    is_valid = np.zeros(len(batch), np.bool_)
+    _preprocess_batch(
+        batch.mz, batch.intensity, batch.offsets, batch.precursor_mz,
+        batch.precursor_charge, mz_min, mz_max, config.min_peaks,
+        config.min_mz_range,
+        (config.remove_precursor_tolerance
+         if config.remove_precursor_tolerance is not None else np.nan),
+        config.min_intensity, config.max_peaks_used,
+        scaling if scaling is not None else '', mz, intensity, num_peaks,
+        is_valid)
+    offsets = np.zeros(len(batch) + 1, np.int64)
+    np.cumsum(num_peaks, out=offsets[1:])
+    mz, intensity = _compact_peaks(mz, intensity, batch.offsets, offsets)
+
+    batch_processed = SpectrumBatch(
+        batch.identifier, batch.precursor_mz, batch.precursor_charge, mz,
+        intensity, offsets, batch.retention_time, batch.scan)
+    batch_processed.is_valid = is_valid
+    batch_processed.is_processed = True
+
+    return batch_processed
+
+
+@nb.njit(parallel=True, nogil=True)
+def _preprocess_batch(mz: np.ndarray, intensity: np.ndarray,
+                      offsets: np.ndarray, precursor_mz: np.ndarray,
+                      precursor_charge: np.ndarray, mz_min: float,
+                      mz_max: float, min_peaks: int, min_mz_range: float,
+                      remove_precursor_tolerance: float, min_intensity: float,
+                      max_peaks_used: int, scaling: str, mz_out: np.ndarray,
+                      intensity_out: np.ndarray, num_peaks_out: np.ndarray,
+                      is_valid: np.ndarray) -> None:
+    """
+    JIT helper function for `preprocess_batch`.
+
+    The result is identical to the corresponding `MsmsSpectrum` methods:
+    restricting the m/z range, removing the precursor peak, filtering
+    low-intensity peaks, and scaling and normalizing the peak intensities.
+
+    Parameters
+    ----------
+    mz : np.ndarray
+        The concatenated m/z values of the spectrum peaks.
+    intensity : np.ndarray
+        The concatenated intensities of the spectrum peaks.
+    offsets : np.ndarray
+        The start positions of each spectrum's peaks.
+    precursor_mz : np.ndarray
+        The spectrum precursor m/z values.
+    precursor_charge : np.ndarray
+        The spectrum precursor charges.
+    mz_min : float
+        The minimum m/z of the peaks to retain.
+    mz_max : float
+        The maximum m/z of the peaks to retain.
+    min_peaks : int
+        Minimum number of peaks a spectrum has to contain.
+    min_mz_range : float
+        Minimum m/z range the spectrum's peaks need to cover.
+    remove_precursor_tolerance : float
+        Fragment mass tolerance (in Dalton) around the precursor mass to
+        remove the precursor peak. If NaN, the precursor peak is not removed.
+    min_intensity : float
+        Remove peaks whose intensity is below `min_intensity` percentage of
+        the intensity of the most intense peak.
+    max_peaks_used : int
+        Only retain the `max_peaks_used` most intense peaks.
+    scaling : str
+        Method to scale the peak intensities ('root', 'log', or 'rank'), or an
+        empty string for no scaling.
+    mz_out : np.ndarray
+        Output buffer for the preprocessed m/z values. The peaks of spectrum
+        `i` are written starting at position `offsets[i]`.
+    intensity_out : np.ndarray
+        Output buffer for the preprocessed intensities. The peaks of spectrum
+        `i` are written starting at position `offsets[i]`.
+    num_peaks_out : np.ndarray
+        Output buffer for the number of preprocessed peaks per spectrum.
+    is_valid : np.ndarray
+        Output buffer for the mask indicating which spectra are valid.
+    """
+    remove_precursor = not np.isnan(remove_precursor_tolerance)
+    for i in nb.prange(len(offsets) - 1):
+        start = offsets[i]
+        # Restrict the m/z range (peaks are sorted by m/z).
+        lo, hi = start, offsets[i + 1] - 1
+        while lo <= hi and mz[lo] < mz_min:
+            lo += 1
+        while hi > start and mz[hi] > mz_max:
+            hi -= 1
+        num_peaks_out[i] = 0
+        is_valid[i] = False
+        if (hi - lo + 1 < min_peaks or hi < lo or
+                mz[hi] - mz[lo] < min_mz_range):
+            continue
+        # Remove the precursor peak while copying the peaks to the output.
+        # Precursor m/z values are checked for decreasing charges.
+        num_peaks = 0
+        pep_mass = (precursor_mz[i] - 1.0072766) * precursor_charge[i]
+        remove_charge = precursor_charge[i] if remove_precursor else 0
+        remove_mz = np.nan
+        if remove_charge > 0:
+            remove_mz = pep_mass / remove_charge + 1.0072766
+        for peak_i in range(lo, hi + 1):
+            while (remove_charge > 0 and
+                   mz[peak_i] - remove_mz > remove_precursor_tolerance):
+                remove_charge -= 1
+                if remove_charge > 0:
+                    remove_mz = pep_mass / remove_charge + 1.0072766
+            if (remove_charge > 0 and
+                    mz[peak_i] - remove_mz >= -remove_precursor_tolerance):
+                continue
+            mz_out[start + num_peaks] = mz[peak_i]
+            intensity_out[start + num_peaks] = intensity[peak_i]
+            num_peaks += 1
+        if not _check_spectrum_valid(mz_out[start:start + num_peaks],
+                                     min_peaks, min_mz_range):
+            continue
+        # Remove low-intensity peaks.
+        num_peaks = _filter_intensity(
+            mz_out[start:start + num_peaks],
+            intensity_out[start:start + num_peaks], min_intensity,
+            max_peaks_used)
+        spec_mz = mz_out[start:start + num_peaks]
+        spec_intensity = intensity_out[start:start + num_peaks]
+        if not _check_spectrum_valid(spec_mz, min_peaks, min_mz_range):
+            continue
+        # Scale and normalize the peak intensities.
+        if scaling == 'root':
+            for peak_i in range(num_peaks):
+                spec_intensity[peak_i] = np.float32(
+                    np.power(np.float64(spec_intensity[peak_i]), 1 / 2))
+        elif scaling == 'log':
+            spec_intensity[:] = (np.log1p(spec_intensity) /
+                                 np.log(2)).astype(np.float32)
+        elif scaling == 'rank':
+            spec_intensity[:] = (max_peaks_used - np.argsort(np.argsort(
+                spec_intensity)[::-1])).astype(np.float32)
+        norm = np.linalg.norm(spec_intensity)
+        for peak_i in range(num_peaks):
+            spec_intensity[peak_i] = spec_intensity[peak_i] / norm
+        num_peaks_out[i] = num_peaks
+        is_valid[i] = True
+
+
+@nb.njit
+def _filter_intensity(spectrum_mz: np.ndarray, spectrum_intensity: np.ndarray,
+                      min_intensity: float, max_num_peaks: int) -> int:
+    """
+    Retain only the most intense peaks of a spectrum, in place.
+
+    Peaks whose intensity is below `min_intensity` percentage of the
+    intensity of the most intense peak are removed, and at most the
+    `max_num_peaks` most intense peaks are retained. The intensity cutoff for
+    the most intense peaks is determined by partial sorting, with a full sort
+    only to break ties in the same way as `MsmsSpectrum.filter_intensity`.
+
+    Parameters
+    ----------
+    spectrum_mz : np.ndarray
+        The m/z values of the spectrum peaks. Retained peaks are moved to the
+        start of the array.
+    spectrum_intensity : np.ndarray
+        The intensities of the spectrum peaks. Retained peaks are moved to the
+        start of the array.
+    min_intensity : float
+        Remove peaks whose intensity is below `min_intensity` percentage of
+        the intensity of the most intense peak.
+    max_num_peaks : int
+        Only retain the `max_num_peaks` most intense peaks.
+
+    Returns
+    -------
+    int
+        The number of retained peaks.
+    """
+    num_peaks = len(spectrum_intensity)
+    min_intensity *= spectrum_intensity.max()
+    num_above = 0
+    for intens in spectrum_intensity:
+        if intens > min_intensity:
+            num_above += 1
+    cutoff, num_cutoff = -np.inf, num_peaks
+    if 0 < num_above <= max_num_peaks:
+        cutoff = min_intensity
+    elif num_above > max_num_peaks:
+        # The intensity of the `max_num_peaks`-th most intense peak.
+        cutoff = np.nextafter(
+            _select(spectrum_intensity.copy(), num_peaks - max_num_peaks),
+            -np.inf)
+        num_cutoff = 0
+        for intens in spectrum_intensity:
+            if intens > cutoff:
+                num_cutoff += 1
+    if num_cutoff > max_num_peaks or num_above == 0:
+        # Tied intensities at the cutoff.
+        mask = np.full(num_peaks, False, np.bool_)
+        intensity_idx = np.argsort(spectrum_intensity)
+        start_i = 0
+        for start_i in range(num_peaks):
+            if spectrum_intensity[intensity_idx[start_i]] > min_intensity:
+                break
+        mask[intensity_idx[max(start_i, num_peaks - max_num_peaks):]] = True
+    else:
+        mask = spectrum_intensity > cutoff
+    num_retained = 0
+    for peak_i in range(num_peaks):
+        if mask[peak_i]:
+            spectrum_mz[num_retained] = spectrum_mz[peak_i]
+            spectrum_intensity[num_retained] = spectrum_intensity[peak_i]
+            num_retained += 1
+    return num_retained
+
+
+@nb.njit
+def _select(values: np.ndarray, k: int) -> float:
+    """
+    Find the k-th smallest value by partially sorting the given array in
+    place.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        The values to be partially sorted.
+    k : int
+        The (zero-based) rank of the requested value.
+
+    Returns
+    -------
+    float
+        The k-th smallest value.
+    """
+    lo, hi = 0, len(values) - 1
+    while lo < hi:
+        pivot = values[(lo + hi) // 2]
+        i, j = lo, hi
+        while i <= j:
+            while values[i] < pivot:
+                i += 1
+            while values[j] > pivot:
+                j -= 1
+            if i <= j:
+                values[i], values[j] = values[j], values[i]
+                i += 1
+                j -= 1
+        if k <= j:
+            hi = j
+        elif k >= i:
+            lo = i
+        else:
+            break
+    return values[k]
+
+
+@nb.njit(parallel=True, nogil=True)
+def _compact_peaks(mz: np.ndarray, intensity: np.ndarray,
+                   offsets: np.ndarray, offsets_out: np.ndarray)\
+        -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Concatenate the peaks of the spectra, which start at the given offsets
+    with gaps in between.
+
+    Parameters
+    ----------
+    mz : np.ndarray
+        The m/z values of the spectrum peaks.
+    intensity : np.ndarray
+        The intensities of the spectrum peaks.
+    offsets : np.ndarray
+        The start positions of each spectrum's peaks.
+    offsets_out : np.ndarray
+        The start positions of each spectrum's peaks in the concatenated
+        peaks, followed by the total number of peaks.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        The concatenated m/z values and intensities.
+    """
+    mz_out = np.empty(offsets_out[-1], np.float32)
+    intensity_out = np.empty(offsets_out[-1], np.float32)
+    for i in nb.prange(len(offsets_out) - 1):
+        num_peaks = offsets_out[i + 1] - offsets_out[i]
+        mz_out[offsets_out[i]:offsets_out[i + 1]] = \
+            mz[offsets[i]:offsets[i] + num_peaks]
+        intensity_out[offsets_out[i]:offsets_out[i + 1]] = \
+            intensity[offsets[i]:offsets[i] + num_peaks]
+    return mz_out, intensity_out
+
+
 @functools.lru_cache(maxsize=None)
 def get_num_bins(min_mz: float, max_mz: float, bin_size: float) -> int:
     """
@@ -151,6 +478,101 @@ def to_vector(spectrum_mz: np.ndarray, spectrum_intensity: np.ndarray,
     return vector / np.linalg.norm(vector)
 
 
+@nb.njit(nogil=True)
+def to_vector_batch(mz: np.ndarray, intensity: np.ndarray,
+                    offsets: np.ndarray, min_mz: float, bin_size: float,
+                    num_bins: int, vectors: np.ndarray) -> np.ndarray:
+    """
+    Convert the given spectra to dense NumPy vectors.
+
+    Parameters
+    ----------
+    mz : np.ndarray
+        The concatenated peak m/z values of the spectra to be converted to
+        vectors.
+    intensity : np.ndarray
+        The concatenated peak intensities of the spectra to be converted to
+        vectors.
+    offsets : np.ndarray
+        The start positions of each spectrum's peaks.
+    min_mz : float
+        The minimum m/z to include in the vectors.
+    bin_size : float
+        The bin size in m/z used to divide the m/z range.
+    num_bins : int
+        The number of elements of which each vector consists.
+    vectors : np.ndarray
+        Output array with one row per spectrum and `num_bins` columns in which
+        the vectors are stored.
+
+    Returns
+    -------
+    np.ndarray
+        The binned spectrum vectors with one row per spectrum (the output
+        array).
+    """
+    for i in range(len(offsets) - 1):
+        vectors[i] = to_vector(mz[offsets[i]:offsets[i + 1]],
+                               intensity[offsets[i]:offsets[i + 1]],
+                               min_mz, bin_size, num_bins)
+    return vectors
+
+
+@nb.njit(nogil=True)
+def to_vector_batch_sparse(mz: np.ndarray, intensity: np.ndarray,
+                           offsets: np.ndarray, min_mz: float,
+                           bin_size: float, num_bins: int)\
+        -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Convert the given spectra to sparse vectors.
+
+    The sparse vectors are identical to the dense vectors produced by
+    `to_vector`.
+
+    Parameters
+    ----------
+    mz : np.ndarray
+        The concatenated peak m/z values of the spectra to be converted to
+        vectors.
+    intensity : np.ndarray
+        The concatenated peak intensities of the spectra to be converted to
+        vectors.
+    offsets : np.ndarray
+        The start positions of each spectrum's peaks.
+    min_mz : float
+        The minimum m/z to include in the vectors.
+    bin_size : float
+        The bin size in m/z used to divide the m/z range.
+    num_bins : int
+        The number of elements of which each vector consists.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, np.ndarray]
+        The binned spectrum vectors in CSR format: the values, the bin indexes
+        of the values, and the start positions of each vector's values.
+    """
+    indptr = np.zeros(len(offsets), np.int64)
+    # Each peak contributes to at most one non-zero bin.
+    indices = np.empty(offsets[-1], np.int32)
+    values = np.empty(offsets[-1], np.float32)
+    for i in range(len(offsets) - 1):
+        spec_mz = mz[offsets[i]:offsets[i + 1]]
+        vector = to_vector(spec_mz, intensity[offsets[i]:offsets[i + 1]],
+                           min_mz, bin_size, num_bins)
+        # Peaks are sorted by m/z, so the bins are visited in order.
+        nnz, bin_prev = indptr[i], -1
+        for peak_mz in spec_mz:
+            bin_idx = int((peak_mz - min_mz) / bin_size)
+            if bin_idx != bin_prev:
+                indices[nnz] = bin_idx
+                values[nnz] = vector[bin_idx]
+                nnz += 1
+                bin_prev = bin_idx
+        indptr[i + 1] = nnz
+    return values[:indptr[-1]], indices[:indptr[-1]], indptr
+
+
 @nb.njit
 def dot(mz: np.ndarray, intensity: np.ndarray, mz_other: np.ndarray,
         intensity_other: np.ndarray, fragment_mz_tol: float) -> float:
@@ -217,3 +639,381 @@ def dot(mz: np.ndarray, intensity: np.ndarray, mz_other: np.ndarray,
                 peaks_used_other.add(peak_other_i)
 
     return score
+
+
+def get_peak_index(mz: np.ndarray, intensity: np.ndarray,
+                   offsets: np.ndarray, fragment_mz_tol: float)\
+        -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, float, int]:
+    """
+    Build an inverted index of the peaks of multiple spectra by m/z bin.
+
+    The peaks of all spectra are sorted by m/z and grouped in bins with a
+    width of twice the fragment m/z tolerance, so all peaks within the fragment
+    m/z tolerance of a given m/z can be found in three consecutive bins. Peaks
+    of the same spectrum retain their relative order.
+
+    Parameters
+    ----------
+    mz : np.ndarray
+        The concatenated m/z values of the spectra.
+    intensity : np.ndarray
+        The concatenated intensity values of the spectra.
+    offsets : np.ndarray
+        The start positions of each spectrum's peaks.
+    fragment_mz_tol : float
+        The fragment m/z tolerance that will be used to match peaks with the
+        indexed peaks.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, float, int]
+        A tuple of length 6 containing: the sorted peak m/z values, the
+        corresponding peak intensities, the corresponding spectrum indexes,
+        the start positions of each m/z bin in the sorted peaks followed by
+        the total number of peaks, the m/z bin width, and the number of
+        indexed spectra.
+    """
+    mz = np.asarray(mz, np.float32)
+    num_spectra = len(offsets) - 1
+    spectrum_i = np.repeat(np.arange(num_spectra, dtype=np.int32),
+                           np.diff(offsets))
+    order = np.lexsort((np.arange(len(mz)), mz))
+    index_mz = mz[order]
+    bin_size = 2 * fragment_mz_tol
+    bins = (index_mz.astype(np.float64) / bin_size).astype(np.int64)
+    num_bins = bins[-1] + 1 if len(bins) > 0 else 0
+    bin_offsets = np.searchsorted(bins, np.arange(num_bins + 1)).astype(
+        np.int64)
+    return (index_mz, np.asarray(intensity, np.float32)[order],
+            spectrum_i[order], bin_offsets, bin_size, num_spectra)
+
+
+@nb.njit
+def dot_index(mz: np.ndarray, intensity: np.ndarray, index_mz: np.ndarray,
+              index_intensity: np.ndarray, index_spectrum: np.ndarray,
+              bin_offsets: np.ndarray, bin_size: float, num_spectra: int,
+              fragment_mz_tol: float) -> np.ndarray:
+    """
+    Compute the dot products between a spectrum and all spectra in a peak
+    index.
+
+    Note: Spectrum intensities should be normalized prior to computing the dot
+    product.
+
+    Parameters
+    ----------
+    mz : np.ndarray
+        The spectrum's m/z values.
+    intensity : np.ndarray
+        The spectrum's intensity values.
+    index_mz, index_intensity, index_spectrum, bin_offsets, bin_size,
+    num_spectra
+        The peak index of the other spectra (see `get_peak_index`).
+    fragment_mz_tol : float
+        The fragment m/z tolerance used to match peaks in both spectra with
+        each other.
+
+    Returns
+    -------
+    np.ndarray
+        The dot products with each of the indexed spectra.
+    """
+    scores = np.empty(num_spectra, np.float32)
+    dot_many(mz, intensity, index_mz, index_intensity, index_spectrum,
+             bin_offsets, bin_size, num_spectra, fragment_mz_tol, scores,
+             get_dot_scratch(len(mz), index_mz, bin_offsets, num_spectra))
+    return scores
+
+
+@nb.njit(parallel=True, nogil=True)
+def dot_index_batch(mz: np.ndarray, intensity: np.ndarray,
+                    offsets: np.ndarray, index_mz: np.ndarray,
+                    index_intensity: np.ndarray, index_spectrum: np.ndarray,
+                    bin_offsets: np.ndarray, bin_size: float,
+                    num_spectra: int, fragment_mz_tol: float,
+                    scores: np.ndarray) -> np.ndarray:
+    """
+    Compute the dot products between all spectra and all spectra in a peak
+    index.
+
+    Spectra are processed in parallel in chunks, with scratch buffers
+    allocated once per chunk.
+
+    Note: Spectrum intensities should be normalized prior to computing the dot
+    product.
+
+    Parameters
+    ----------
+    mz : np.ndarray
+        The concatenated m/z values of the spectra.
+    intensity : np.ndarray
+        The concatenated intensity values of the spectra.
+    offsets : np.ndarray
+        The start positions of each spectrum's peaks.
+    index_mz, index_intensity, index_spectrum, bin_offsets, bin_size,
+    num_spectra
+        The peak index of the other spectra (see `get_peak_index`).
+    fragment_mz_tol : float
+        The fragment m/z tolerance used to match peaks in both spectra with
+        each other.
+    scores : np.ndarray
+        Output array with one row per spectrum and one column per indexed
+        spectrum in which the dot products are stored.
+
+    Returns
+    -------
+    np.ndarray
+        The dot products with one row per spectrum and one column per indexed
+        spectrum (the output array).
+    """
+    num_query = len(offsets) - 1
+    chunk_size = 256
+    for chunk_i in nb.prange((num_query + chunk_size - 1) // chunk_size):
+        start = chunk_i * chunk_size
+        stop = min(start + chunk_size, num_query)
+        max_num_peaks = 0
+        for i in range(start, stop):
+            max_num_peaks = max(max_num_peaks, offsets[i + 1] - offsets[i])
+        scratch = get_dot_scratch(max_num_peaks, index_mz, bin_offsets,
+                                  num_spectra)
+        for i in range(start, stop):
+            dot_many(mz[offsets[i]:offsets[i + 1]],
+                     intensity[offsets[i]:offsets[i + 1]], index_mz,
+                     index_intensity, index_spectrum, bin_offsets, bin_size,
+                     num_spectra, fragment_mz_tol, scores[i], scratch)
+    return scores
+
+
+# Maximum depth of the partition stack when sorting peak matches.
+_max_sort_stack = 100
+
+
+@nb.njit
+def get_dot_scratch(max_num_peaks: int, index_mz: np.ndarray,
+                    bin_offsets: np.ndarray, num_spectra: int)\
+        -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray,
+                 np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Allocate scratch buffers to compute dot products with spectra in a peak
+    index using `dot_many`.
+
+    The scratch buffers can be reused for all spectra with at most the given
+    number of peaks, but should not be shared between threads.
+
+    Parameters
+    ----------
+    max_num_peaks : int
+        The maximum number of peaks of the spectra to be compared.
+    index_mz, bin_offsets, num_spectra
+        The peak index of the other spectra (see `get_peak_index`).
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray,
+          np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+        The scratch buffers to be passed to `dot_many`.
+    """
+    # Every peak can match at most all indexed peaks in three consecutive
+    # bins.
+    num_bins = len(bin_offsets) - 1
+    max_window = 0
+    for bin_i in range(num_bins + 1):
+        max_window = max(max_window,
+                         bin_offsets[min(bin_i + 2, num_bins)] -
+                         bin_offsets[max(bin_i - 1, 0)])
+    max_num_matches = max_num_peaks * max_window
+    return (np.zeros(num_spectra + 1, np.int64),
+            np.zeros(num_spectra, np.int64),
+            np.zeros(max_num_matches, np.int64),
+            np.zeros(max_num_matches, np.int64),
+            np.zeros(max_num_matches, np.float32),
+            np.zeros(max_num_matches, np.int64),
+            np.zeros(2 * _max_sort_stack, np.int64),
+            np.zeros(len(index_mz), np.bool_),
+            np.zeros(max_num_peaks, np.bool_))
+
+
+@nb.njit(nogil=True)
+def dot_many(mz: np.ndarray, intensity: np.ndarray, index_mz: np.ndarray,
+             index_intensity: np.ndarray, index_spectrum: np.ndarray,
+             bin_offsets: np.ndarray, bin_size: float, num_spectra: int,
+             fragment_mz_tol: float, scores: np.ndarray,
+             scratch: Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray,
+                            np.ndarray, np.ndarray, np.ndarray, np.ndarray,
+                            np.ndarray]) -> None:
+    """
+    Compute the dot products between a spectrum and all spectra in a peak
+    index without allocating memory.
+
+    Candidate peak matches with all indexed spectra are found in a single
+    sweep over the spectrum's peaks, after which the peaks are assigned to
+    each other per indexed spectrum. Results are identical to calling `dot`
+    with each indexed spectrum as the first spectrum.
+
+    Note: Spectrum intensities should be normalized prior to computing the dot
+    product.
+
+    Parameters
+    ----------
+    mz : np.ndarray
+        The spectrum's m/z values.
+    intensity : np.ndarray
+        The spectrum's intensity values.
+    index_mz, index_intensity, index_spectrum, bin_offsets, bin_size,
+    num_spectra
+        The peak index of the other spectra (see `get_peak_index`).
+    fragment_mz_tol : float
+        The fragment m/z tolerance used to match peaks in both spectra with
+        each other.
+    scores : np.ndarray
+        Output array in which the dot products with each of the indexed
+        spectra are stored.
+    scratch : Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray,
+                    np.ndarray, np.ndarray, np.ndarray, np.ndarray,
+                    np.ndarray]
+        Scratch buffers for spectra with at most as many peaks as the given
+        spectrum (see `get_dot_scratch`).
+    """
+    (group_offsets, group_pos, match_index, match_peak, match_scores,
+     match_order, sort_stack, peaks_used_index, peaks_used) = scratch
+    num_peaks, num_bins = len(mz), len(bin_offsets) - 1
+    if num_peaks > len(peaks_used):
+        raise ValueError('Insufficient scratch space for the number of peaks')
+    # Count the matching peaks with each indexed spectrum.
+    group_offsets[:] = 0
+    for peak_i in range(num_peaks):
+        bin_i = int(mz[peak_i] / bin_size)
+        for index_i in range(bin_offsets[min(max(bin_i - 1, 0), num_bins)],
+                             bin_offsets[min(bin_i + 2, num_bins)]):
+            if abs(index_mz[index_i] - mz[peak_i]) <= fragment_mz_tol:
+                group_offsets[index_spectrum[index_i] + 1] += 1
+    for spectrum_i in range(num_spectra):
+        group_offsets[spectrum_i + 1] += group_offsets[spectrum_i]
+        group_pos[spectrum_i] = group_offsets[spectrum_i]
+    # Store the matching peaks grouped by indexed spectrum.
+    for peak_i in range(num_peaks):
+        bin_i = int(mz[peak_i] / bin_size)
+        for index_i in range(bin_offsets[min(max(bin_i - 1, 0), num_bins)],
+                             bin_offsets[min(bin_i + 2, num_bins)]):
+            if abs(index_mz[index_i] - mz[peak_i]) <= fragment_mz_tol:
+                spectrum_i = index_spectrum[index_i]
+                match_index[group_pos[spectrum_i]] = index_i
+                match_peak[group_pos[spectrum_i]] = peak_i
+                group_pos[spectrum_i] += 1
+    # Assign the peaks to each other per indexed spectrum.
+    for spectrum_i in range(num_spectra):
+        start, stop = group_offsets[spectrum_i], group_offsets[spectrum_i + 1]
+        if stop - start == 0:
+            scores[spectrum_i] = 0
+            continue
+        # Order the peak matches by the indexed spectrum's peaks first, as
+        # encountered when computing the dot product directly.
+        for match_i in range(start + 1, stop):
+            index_i, peak_i = match_index[match_i], match_peak[match_i]
+            insert_i = match_i
+            while (insert_i > start and
+                   (match_index[insert_i - 1] > index_i or
+                    (match_index[insert_i - 1] == index_i and
+                     match_peak[insert_i - 1] > peak_i))):
+                match_index[insert_i] = match_index[insert_i - 1]
+                match_peak[insert_i] = match_peak[insert_i - 1]
+                insert_i -= 1
+            match_index[insert_i] = index_i
+            match_peak[insert_i] = peak_i
+        for match_i in range(start, stop):
+            match_scores[match_i] = (index_intensity[match_index[match_i]] *
+                                     intensity[match_peak[match_i]])
+        # Use the most prominent peak matches to compute the score (sort in
+        # descending order).
+        _argsort(match_scores[start:stop], match_order[start:stop],
+                 sort_stack)
+        score = 0.
+        for order_i in range(stop - 1, start - 1, -1):
+            match_i = start + match_order[order_i]
+            index_i, peak_i = match_index[match_i], match_peak[match_i]
+            if not peaks_used_index[index_i] and not peaks_used[peak_i]:
+                score += match_scores[match_i]
+                # Make sure these peaks are not used anymore.
+                peaks_used_index[index_i] = True
+                peaks_used[peak_i] = True
+        scores[spectrum_i] = score
+        for match_i in range(start, stop):
+            peaks_used_index[match_index[match_i]] = False
+            peaks_used[match_peak[match_i]] = False
+
+
+@nb.njit(nogil=True)
+def _argsort(values: np.ndarray, order: np.ndarray,
+             stack: np.ndarray) -> None:
+    """
+    Sort the given values in ascending order without allocating memory.
+
+    This is the same quicksort as NumPy's `argsort` in Numba-compiled code, so
+    that ties are ordered identically.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        The values to be sorted.
+    order : np.ndarray
+        Output array in which the indexes that sort the values are stored.
+    stack : np.ndarray
+        Scratch buffer for the partition stack, with space for two elements
+        per partition.
+    """
+    for i in range(len(values)):
+        order[i] = i
+    if len(values) < 2:
+        return
+    stack[0], stack[1] = 0, len(values) - 1
+    num_stack = 1
+    while num_stack > 0:
+        num_stack -= 1
+        low, high = stack[2 * num_stack], stack[2 * num_stack + 1]
+        # Partition until it becomes more efficient to do an insertion sort.
+        while high - low >= 15:
+            if num_stack >= len(stack) // 2:
+                raise ValueError('Insufficient scratch space for sorting')
+            # Median of three pivot.
+            mid = (low + high) >> 1
+            if values[order[mid]] < values[order[low]]:
+                order[low], order[mid] = order[mid], order[low]
+            if values[order[high]] < values[order[mid]]:
+                order[high], order[mid] = order[mid], order[high]
+            if values[order[mid]] < values[order[low]]:
+                order[low], order[mid] = order[mid], order[low]
+            pivot = values[order[mid]]
+            order[high], order[mid] = order[mid], order[high]
+            i, j = low, high - 1
+            while True:
+                while i < high and values[order[i]] < pivot:
+                    i += 1
+                while j >= low and pivot < values[order[j]]:
+                    j -= 1
+                if i >= j:
+                    break
+                order[i], order[j] = order[j], order[i]
+                i += 1
+                j -= 1
+            order[i], order[high] = order[high], order[i]
+            # Push the largest partition on the stack.
+            if high - i > i - low:
+                if high > i:
+                    stack[2 * num_stack] = i + 1
+                    stack[2 * num_stack + 1] = high
+                    num_stack += 1
+                high = i - 1
+            else:
+                if i > low:
+                    stack[2 * num_stack] = low
+                    stack[2 * num_stack + 1] = i - 1
+                    num_stack += 1
+                low = i + 1
+        # Insertion sort.
+        for i in range(low + 1, high + 1):
+            k = order[i]
+            j = i
+            while j > low and values[k] < values[order[j - 1]]:
+                order[j] = order[j - 1]
+                j -= 1
+            order[j] = k
@@ -0,0 +1,439 @@
+import functools
+import io
+import os
+import struct
+import tarfile
+import zipfile
+from typing import Dict, IO, Optional, Tuple
+
+
+# Separator between the archive file name and the member name in archive
+# member paths, e.g. "dataset.tar.gz!/run/file.mzML".
+member_sep = '!/'
+
+
+def split(filename: str) -> Tuple[Optional[str], str]:
+    """
+    Split an archive member path in the archive file name and the member name.
+
+    Parameters
+    ----------
+    filename : str
+        The file name, which is either a regular file name or an archive member
+        path of the form "{archive}!/{member}".
+
+    Returns
+    -------
+    Tuple[Optional[str], str]
+        A tuple of the archive file name and the member name, or None and the
+        given file name if it isn't an archive member path.
+    """
+    archive, sep, member = filename.partition(member_sep)
+    return (archive, member) if sep else (None, filename)
+
+
+def is_member(filename: str) -> bool:
+    """
+    Check whether the given file name is an archive member path.
+
+    Parameters
+    ----------
+    filename : str
+        The file name.
+
+    Returns
+    -------
+    bool
+        True if the file name refers to a member of a tar or zip archive,
+        False if it refers to a regular file.
+    """
+    return member_sep in filename
+
+
+def isfile(filename: str) -> bool:
+    """
+    Check whether the given regular file or archive member exists.
+
+    Parameters
+    ----------
+    filename : str
+        The file name or archive member path.
+
+    Returns
+    -------
+    bool
+        True if the file or archive member exists, False otherwise.
+    """
+    archive, member = split(filename)
+    if archive is None:
+        return os.path.isfile(filename)
+    try:
+        return member in _get_members(archive)
+    except (OSError, tarfile.TarError, zipfile.BadZipFile):
+        return False
+
+
+def getsize(filename: str) -> int:
+    """
+    Get the (uncompressed) size of the given regular file or archive member.
+
+    Parameters
+    ----------
+    filename : str
+        The file name or archive member path.
+
+    Returns
+    -------
+    int
+        The file size in bytes.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the file or archive member doesn't exist.
+    """
+    archive, member = split(filename)
+    if archive is None:
+        return os.path.getsize(filename)
+    return _get_member(archive, member)[0]
+
+
+def is_seekable(filename: str) -> bool:
+    """
+    Check whether the given regular file or archive member can be read
+    efficiently from arbitrary offsets.
+
+    Parameters
+    ----------
+    filename : str
+        The file name or archive member path.
+
+    Returns
+    -------
+    bool
+        True for regular files and for members that are stored uncompressed in
+        uncompressed archives, False for other archive members.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the file or archive member doesn't exist.
+    """
+    archive, member = split(filename)
+    if archive is None:
+        return True
+    return _get_member(archive, member)[1]
+
+
+def stat(filename: str) -> os.stat_result:
+    """
+    Get the status of the given regular file, or of the archive containing the
+    given archive member.
+
+    Parameters
+    ----------
+    filename : str
+        The file name or archive member path.
+
+    Returns
+    -------
+    os.stat_result
+        The file status, of which the size and modification time change when
+        the file or archive is modified.
+    """
+    return os.stat(split(filename)[0] or filename)
+
+
+def get_sidecar_filename(filename: str, ext: str) -> str:
+    """
+    Get the name of a file stored next to the given regular file or archive
+    member, such as its spectrum store.
+
+    Parameters
+    ----------
+    filename : str
+        The file name or archive member path.
+    ext : str
+        The extension of the sidecar file.
+
+    Returns
+    -------
+    str
+        The sidecar file name. For archive members the sidecar file is stored
+        next to the archive, e.g. "dataset.tar!run!file.mzML{ext}" for member
+        path "dataset.tar!/run/file.mzML".
+    """
+    archive, member = split(filename)
+    if archive is None:
+        return f'{filename}{ext}'
+    return f'{archive}!{member.replace("/", "!")}{ext}'
+
+
+def open(filename: str) -> IO:
+    """
+    Open the given regular file or archive member for binary reading.
+
+    Archive members are read directly from the archive without extracting
+    them. Members that are stored uncompressed in uncompressed tar or zip
+    archives support efficient random access, other members are decompressed
+    while reading, so that seeking backwards or far ahead is slow.
+
+    Parameters
+    ----------
+    filename : str
+        The file name or archive member path.
+
+    Returns
+    -------
+    IO
+        The binary file object. Closing it also closes the archive.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the file or archive member doesn't exist.
+    """
+    archive, member = split(filename)
+    if archive is None:
+        return io.open(filename, 'rb')
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as f_zip:
+            try:
+                info = f_zip.getinfo(member)
+            except KeyError:
+                raise FileNotFoundError(f'No member {member} in {archive}')
+            if info.compress_type != zipfile.ZIP_STORED:
+                # The member keeps the archive file open after the ZipFile is
+                # closed.
+                return f_zip.open(info)
+        with io.open(archive, 'rb') as f_in:
+            # Skip the zip local file header.
+            f_in.seek(info.header_offset + 26)
+            name_len, extra_len = struct.unpack('<HH', f_in.read(4))
+        return io.BufferedReader(_FileSlice(
+            archive, info.header_offset + 30 + name_len + extra_len,
+            info.file_size))
+    f_tar = tarfile.open(archive, 'r:*')
+    try:
+        # Iterate over the members instead of using `getmember`, which would
+        # read the full (compressed) archive to find the last occurrence.
+        info = f_tar.next()
+        while info is not None and info.name != member:
+            info = f_tar.next()
+        if info is None or not info.isfile():
+            raise FileNotFoundError(f'No member {member} in {archive}')
+        if not _is_compressed(archive):
+            f_tar.close()
+            return io.BufferedReader(_FileSlice(archive, info.offset_data,
+                                                info.size))
+        return ClosingFile(f_tar.extractfile(info), f_tar)
+    except BaseException:
+        f_tar.close()
+        raise
+
+
+def _get_member(archive: str, member: str) -> Tuple[int, bool]:
+    """
+    Get information about the given archive member.
+
+    Parameters
+    ----------
+    archive : str
+        The tar or zip archive file name.
+    member : str
+        The member name.
+
+    Returns
+    -------
+    Tuple[int, bool]
+        The member's uncompressed size and whether it can be read from
+        arbitrary offsets.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the archive or member doesn't exist.
+    """
+    try:
+        return _get_members(archive)[member]
+    except KeyError:
+        raise FileNotFoundError(f'No member {member} in {archive}')
+
+
+def _get_members(archive: str) -> Dict[str, Tuple[int, bool]]:
+    """
+    Get information about the regular file members of the given archive.
+
+    Listing the members of a compressed tar archive requires decompressing the
+    full archive, so the member information is cached for as long as the
+    archive isn't modified.
+
+    Parameters
+    ----------
+    archive : str
+        The tar or zip archive file name.
+
+    Returns
+    -------
+    Dict[str, Tuple[int, bool]]
+        A dictionary of the member names and their uncompressed size and
+        whether they can be read from arbitrary offsets.
+    """
+    archive_stat = os.stat(archive)
+    return _list_members(archive, archive_stat.st_size,
+                         archive_stat.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=None)
+def _list_members(archive: str, size: int, mtime: int)\
+        -> Dict[str, Tuple[int, bool]]:
+    """
+    List the regular file members of the given archive (see `_get_members`).
+
+    Parameters
+    ----------
+    archive : str
+        The tar or zip archive file name.
+    size : int
+        The archive size, to invalidate the cache when the archive changes.
+    mtime : int
+        The archive modification time, to invalidate the cache when the
+        archive changes.
+
+    Returns
+    -------
+    Dict[str, Tuple[int, bool]]
+        A dictionary of the member names and their uncompressed size and
+        whether they can be read from arbitrary offsets.
+    """
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as f_zip:
+            return {info.filename: (info.file_size,
+                                    info.compress_type == zipfile.ZIP_STORED)
+                    for info in f_zip.infolist() if not info.is_dir()}
+    seekable = not _is_compressed(archive)
+    with tarfile.open(archive, 'r:*') as f_tar:
+        return {info.name: (info.size, seekable)
+                for info in f_tar if info.isfile()}
+
+
+def _is_compressed(archive: str) -> bool:
+    """
+    Check whether the given tar archive is compressed.
+
+    Parameters
+    ----------
+    archive : str
+        The tar archive file name.
+
+    Returns
+    -------
+    bool
+        True if the archive is GZIP, BZIP2, or LZMA compressed, False
+        otherwise.
+    """
+    with io.open(archive, 'rb') as f_in:
+        magic = f_in.read(6)
+    return (magic.startswith(b'\x1f\x8b') or magic.startswith(b'BZh') or
+            magic == b'\xfd7zXZ\x00')
+
+
+class ClosingFile:
+    """
+    Binary file object wrapper that additionally closes other resources
+    (e.g. the archive or the compressed stream that it's read from) when it's
+    closed.
+    """
+
+    def __init__(self, source: IO, *resources):
+        """
+        Wrap a binary file object.
+
+        Parameters
+        ----------
+        source : IO
+            The binary file object.
+        resources
+            The resources that are closed after the file object is closed.
+        """
+        self.source = source
+        self.resources = resources
+
+    def close(self) -> None:
+        try:
+            self.source.close()
+        finally:
+            for resource in self.resources:
+                resource.close()
+
+    def __getattr__(self, name):
+        return getattr(self.source, name)
+
+    def __iter__(self):
+        return iter(self.source)
+
+    def __enter__(self) -> 'ClosingFile':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class _FileSlice(io.RawIOBase):
+    """
+    Read-only raw file object for a byte range of a file, such as an
+    uncompressed archive member.
+    """
+
+    def __init__(self, filename: str, offset: int, size: int):
+        """
+        Open a byte range of a file.
+
+        Parameters
+        ----------
+        filename : str
+            The file name.
+        offset : int
+            The start of the byte range in the file.
+        size : int
+            The size of the byte range.
+        """
+        super().__init__()
+        self._f_in = io.open(filename, 'rb', buffering=0)
+        self._offset = offset
+        self._size = size
+        self._pos = 0
+        self.name = filename
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, pos: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            pos += self._pos
+        elif whence == io.SEEK_END:
+            pos += self._size
+        if pos < 0:
+            raise ValueError(f'Negative seek position {pos}')
+        self._pos = pos
+        return self._pos
+
+    def readinto(self, buffer) -> int:
+        size = max(0, min(len(buffer), self._size - self._pos))
+        if size == 0:
+            return 0
+        self._f_in.seek(self._offset + self._pos)
+        num_read = self._f_in.readinto(memoryview(buffer)[:size])
+        self._pos += num_read
+        return num_read
+
+    def close(self) -> None:
+        if not self.closed:
+            self._f_in.close()
+        super().close()
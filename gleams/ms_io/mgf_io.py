@@ -1,19 +1,34 @@
+import itertools
 import logging
-from typing import Dict, IO, Iterator, Sequence, Union
+import re
+from typing import Dict, IO, Iterator, Optional, Sequence, Union
 
-from pyteomics import mgf
+import numpy as np
 from spectrum_utils.spectrum import MsmsSpectrum
 
+from gleams.ms_io import spectrum_index
+from gleams.ms_io.reader_stats import ReaderStats
+
 
 logger = logging.getLogger('gleams')
 
 
-def get_spectra(source: Union[IO, str], scan_nrs: Sequence[int] = None)\
-        -> Iterator[MsmsSpectrum]:
+# Number of bytes read from the MGF file at once.
+_chunk_size = 2 ** 24
+_begin_ions, _end_ions = b'BEGIN IONS', b'END IONS'
+_comments = b'#;!/'
+_charge_split = re.compile(r'\s*(?:,|\band\b|\s)\s*')
+
+
+def get_spectra(source: Union[IO, str], scan_nrs: Sequence[int] = None,
+                stats: ReaderStats = None) -> Iterator[MsmsSpectrum]:
     """
     Get the MS/MS spectra from the given MGF file, optionally filtering by
     scan number.
 
+    The scan number of an MGF spectrum is its position in the file, which is
+    stored in the spectrum's `scan` attribute.
+
     Parameters
     ----------
     source : Union[IO, str]
@@ -22,59 +37,282 @@ def get_spectra(source: Union[IO, str], scan_nrs: Sequence[int] = None)\
     scan_nrs : Sequence[int]
         Only read spectra with the given scan numbers. If `None`, no filtering
         on scan number is performed.
+    stats : ReaderStats
+        Statistics in which skipped spectra are recorded. If `None`, no
+        statistics are recorded.
 
     Returns
     -------
     Iterator[MsmsSpectrum]
         An iterator over the requested spectra in the given file.
     """
-    with mgf.MGF(source) as f_in:
-        # Iterate over a subset of spectra filtered by scan number.
-        if scan_nrs is not None:
-            def spectrum_it():
-                for scan_nr, spectrum_dict in enumerate(f_in):
-                    if scan_nr in scan_nrs:
-                        yield spectrum_dict
-        # Or iterate over all MS/MS spectra.
-        else:
-            def spectrum_it():
-                yield from f_in
-
-        for spectrum in spectrum_it():
+    if scan_nrs is not None:
+        scan_nrs = set(scan_nrs)
+    f_in = open(source, 'rb') if isinstance(source, str) else source
+    try:
+        header_params = None
+        for scan_nr, (header, block) in enumerate(_get_blocks(f_in)):
+            if header_params is None:
+                header_params = _parse_params(header)
+            # Iterate over a subset of spectra filtered by scan number.
+            if scan_nrs is not None and scan_nr not in scan_nrs:
+                continue
             try:
-                yield _parse_spectrum(spectrum)
+                spectrum = _parse_spectrum(block, header_params)
+                spectrum.scan = scan_nr
+                yield spectrum
             except ValueError as e:
-                pass
-                # logger.warning(f'Failed to read spectrum '
-                #                f'{spectrum["params"]["title"]}: %s', e)
+                if stats is not None:
+                    stats.skip(str(e))
+    finally:
+        if f_in is not source:
+            f_in.close()
+
+
+def get_spectra_at(source: IO, offsets: Sequence[int],
+                   min_peaks: int = None, stats: ReaderStats = None,
+                   scan_nrs: Sequence[int] = None)\
+        -> Iterator[MsmsSpectrum]:
+    """
+    Get the MS/MS spectra starting at the given byte offsets in the MGF file.
+
+    Parameters
+    ----------
+    source : IO
+        The binary MGF file object from which the spectra are read.
+    offsets : Sequence[int]
+        The byte offsets at which the requested spectra start, as specified in
+        the file's spectrum index, in increasing order.
+    min_peaks : int
+        Skip spectra with fewer peaks. Parsing stops as soon as the peak list
+        is known to be too short. If None, no filtering on the number of peaks
+        is performed.
+    stats : ReaderStats
+        Statistics in which skipped spectra are recorded. If `None`, no
+        statistics are recorded.
+    scan_nrs : Sequence[int]
+        The scan numbers (i.e. positions in the file) of the spectra at the
+        given offsets, as specified in the file's spectrum index, which are
+        stored in the spectra's `scan` attribute. If `None`, the scan numbers
+        are unknown.
+
+    Returns
+    -------
+    Iterator[MsmsSpectrum]
+        An iterator over the requested spectra in the given file.
+    """
+    source.seek(0)
+    header_params = _parse_params(
+        next(_get_blocks(source, 2 ** 16), (b'', b''))[0])
+    if scan_nrs is None:
+        scan_nrs = itertools.repeat(-1)
+    for scan_nr, element in zip(scan_nrs, spectrum_index.read_elements(
+            source, offsets, _end_ions)):
+        if not element.endswith(_end_ions):
+            if stats is not None:
+                stats.skip('Incomplete spectrum')
+            continue
+        try:
+            spectrum = _parse_spectrum(
+                element[len(_begin_ions):-len(_end_ions)], header_params,
+                min_peaks)
+            if spectrum is not None:
+                spectrum.scan = scan_nr
+                yield spectrum
+            elif stats is not None:
+                stats.skip('Too few peaks')
+        except ValueError as e:
+            if stats is not None:
+                stats.skip(str(e))
+
+
+def _get_blocks(f_in: IO, chunk_size: int = _chunk_size)\
+        -> Iterator[Sequence[bytes]]:
+    """
+    Split an MGF file into the text blocks of its individual spectra.
+
+    The file is read in large chunks and scanned for `BEGIN IONS`/`END IONS`
+    delimiters, without any per-line processing.
+
+    Parameters
+    ----------
+    f_in : IO
+        The MGF file object. Can be opened in binary or in text mode.
+    chunk_size : int
+        The number of bytes to read at once.
+
+    Returns
+    -------
+    Iterator[Sequence[bytes]]
+        An iterator of tuples consisting of the file header (i.e. the text
+        preceding the first spectrum) and the text between the `BEGIN IONS`
+        and `END IONS` delimiters of each spectrum.
+    """
+    buffer, header = b'', None
+    while True:
+        chunk = f_in.read(chunk_size)
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        buffer += chunk
+        start = 0
+        while True:
+            begin = buffer.find(_begin_ions, start)
+            if begin == -1:
+                break
+            end = buffer.find(_end_ions, begin)
+            if end == -1:
+                break
+            if header is None:
+                header = buffer[:begin]
+            yield header, buffer[begin + len(_begin_ions):end]
+            start = end + len(_end_ions)
+        buffer = buffer[start:]
+        if not chunk:
+            break
+
+
+def _parse_params(text: bytes) -> Dict[str, str]:
+    """
+    Parse the `KEY=value` parameter lines in the given MGF text.
 
+    Parameters
+    ----------
+    text : bytes
+        The MGF text.
 
-def _parse_spectrum(spectrum_dict: Dict) -> MsmsSpectrum:
+    Returns
+    -------
+    Dict[str, str]
+        A dictionary with the lowercase parameter keys and their values.
     """
-    Parse the Pyteomics spectrum dict.
+    params = {}
+    for line in text.split(b'\n'):
+        line = line.strip()
+        if line and line[0] not in _comments and b'=' in line:
+            key, value = line.decode().split('=', 1)
+            params[key.lower()] = value.strip()
+    return params
+
+
+def _parse_peaks(text: bytes) -> np.ndarray:
+    """
+    Parse an MGF peak list.
+
+    Peak lists with only m/z and intensity columns are converted to floats in
+    bulk. Otherwise the peak list is parsed line by line, ignoring additional
+    columns.
 
     Parameters
     ----------
-    spectrum_dict : Dict
-        The Pyteomics spectrum dict to be parsed.
+    text : bytes
+        The MGF peak list text.
 
     Returns
     -------
-    MsmsSpectrum
-        The parsed spectrum.
+    np.ndarray
+        A 2D array with the m/z values and intensities in its two columns.
     """
-    identifier = spectrum_dict['params']['title']
+    first_line = text.lstrip().split(b'\n', 1)[0]
+    if len(first_line.split()) == 2:
+        try:
+            peaks = np.array(text.split(), np.float64)
+            if len(peaks) % 2 == 0:
+                return peaks.reshape((-1, 2))
+        except ValueError:
+            pass
+    peaks = []
+    for line in text.split(b'\n'):
+        line = line.strip()
+        if line and line[0] not in _comments:
+            values = line.split()
+            if len(values) > 1:
+                peaks.append((float(values[0]), float(values[1])))
+    return np.asarray(peaks, np.float64).reshape((-1, 2))
+
 
-    mz_array = spectrum_dict['m/z array']
-    intensity_array = spectrum_dict['intensity array']
-    retention_time = float(spectrum_dict['params']['rtinseconds'])
+def _parse_charge(charge: str) -> Optional[int]:
+    """
+    Parse an MGF precursor charge string (e.g. "2+", "-3", or "2+ and 3+").
+
+    Parameters
+    ----------
+    charge : str
+        The MGF precursor charge string.
+
+    Returns
+    -------
+    Optional[int]
+        The (first) precursor charge, or None if no charge is specified.
+    """
+    charge = _charge_split.split(charge.strip(), 1)[0]
+    if not charge:
+        return None
+    elif charge[-1] in '+-':
+        charge = charge[-1] + charge[:-1]
+    return int(charge)
 
-    precursor_mz = float(spectrum_dict['params']['pepmass'][0])
-    if 'charge' in spectrum_dict['params']:
-        precursor_charge = int(spectrum_dict['params']['charge'][0])
+
+def _parse_spectrum(block: bytes, header_params: Dict[str, str],
+                    min_peaks: int = None) -> Optional[MsmsSpectrum]:
+    """
+    Parse the text block of a single spectrum.
+
+    The spectrum parameters are validated before its peak list is parsed.
+
+    Parameters
+    ----------
+    block : bytes
+        The MGF text between the `BEGIN IONS` and `END IONS` delimiters.
+    header_params : Dict[str, str]
+        Parameters specified in the file header, which apply to all spectra.
+    min_peaks : int
+        The minimum number of peaks. If None, there's no minimum.
+
+    Returns
+    -------
+    Optional[MsmsSpectrum]
+        The parsed spectrum, or None if it has fewer than the minimum number of
+        peaks.
+
+    Raises
+    ------
+    ValueError: The spectrum can't be parsed correctly:
+        - Unknown precursor charge.
+    """
+    # Parameters precede the peak list, so the peaks start at the line
+    # following the final parameter.
+    peaks_start = block.rfind(b'=')
+    if peaks_start != -1:
+        peaks_start = block.find(b'\n', peaks_start) + 1 or len(block)
     else:
+        peaks_start = 0
+    params = {**header_params, **_parse_params(block[:peaks_start])}
+
+    identifier = params['title']
+
+    retention_time = float(params['rtinseconds'])
+
+    pepmass = params['pepmass'].split()
+    precursor_mz = float(pepmass[0])
+    precursor_charge = None
+    if len(pepmass) == 3:
+        precursor_charge = _parse_charge(pepmass[2])
+    elif 'charge' in params:
+        precursor_charge = _parse_charge(params['charge'])
+    if precursor_charge is None:
         raise ValueError('Unknown precursor charge')
 
+    # Each peak takes up at least one line.
+    if (min_peaks is not None and
+            block.count(b'\n', peaks_start) + 1 < min_peaks):
+        return None
+    peaks = _parse_peaks(block[peaks_start:])
+    if min_peaks is not None and len(peaks) < min_peaks:
+        return None
+
+    mz_array = peaks[:, 0]
+    intensity_array = peaks[:, 1]
+
     spectrum = MsmsSpectrum(str(identifier), precursor_mz, precursor_charge,
                             mz_array, intensity_array, None, retention_time)
 
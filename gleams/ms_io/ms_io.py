@@ -1,26 +1,108 @@
+import collections
 import gzip
+import itertools
 import logging
 import lzma
 import os
-from typing import Iterator, Sequence
+import threading
+import time
+from typing import IO, Iterator, Optional, Sequence, Tuple
 
+import numpy as np
+import pandas as pd
 from spectrum_utils.spectrum import MsmsSpectrum
 
+from gleams.ms_io import archive_io
 from gleams.ms_io import mgf_io
 from gleams.ms_io import mzml_io
 from gleams.ms_io import mzxml_io
+from gleams.ms_io import spectrum_index
+from gleams.ms_io import store_io
+from gleams.ms_io.reader_stats import ReaderStats, StatsFile
+from gleams.ms_io.spectrum_batch import SpectrumBatch
+from gleams.ms_io.spectrum_filter import SpectrumFilter
 
 logger = logging.getLogger('gleams')
 
 
-def get_spectra(filename: str, scan_nrs: Sequence[int] = None)\
-        -> Iterator[MsmsSpectrum]:
+def get_spectra(filename: str, scan_nrs: Sequence[int] = None,
+                part: Tuple[int, int] = None, prefetch: int = 0,
+                prefetch_bytes: int = None,
+                spectrum_filter: SpectrumFilter = None,
+                stats: ReaderStats = None) -> Iterator[MsmsSpectrum]:
     """
     Get the MS/MS spectra from the given file, optionally filtering by scan
     number.
 
-    Supported file formats are mzML, mzXML, and MS2. Files can optionally be
-    GZIP or LZMA compressed.
+    Supported file formats are mzML, mzXML, and MGF. Files can optionally be
+    GZIP or LZMA compressed. Additionally, spectrum stores (extension ".spec",
+    see `store_io.convert`) are read directly by memory-mapping.
+
+    Peak files inside tar or zip archives are read directly from the archive,
+    without extracting them, by specifying archive member paths of the form
+    "{archive}!/{member}" (e.g. "dataset.tar.gz!/run/file.mzML"). The file
+    format is determined by the member name. Members that are stored
+    uncompressed in uncompressed archives are read as efficiently as regular
+    files, other members are decompressed while reading.
+
+    When filtering by scan number or by a spectrum filter, the requested
+    spectra are read directly using the file's (persistent) spectrum index.
+    The scan number, precursor m/z, and precursor charge criteria are
+    evaluated on the index, and the number of peaks on the spectrum headers,
+    so that the peaks of rejected spectra are never decoded.
+
+    Large files can be read concurrently in multiple parts. The file's
+    spectrum index is used to split the requested spectra in consecutive byte
+    ranges with (roughly) equal numbers of spectra. Reading all parts in order
+    gives the same spectra as reading the full file at once.
+
+    Optionally the spectra are read, decompressed, and parsed ahead by a
+    background thread while the caller processes the previous spectra, which
+    hides the I/O latency of slow (e.g. network) file systems and compressed
+    files.
+
+    Parameters
+    ----------
+    filename : str
+        The file name from which to read the spectra.
+    scan_nrs : Sequence[int]
+        Only read spectra with the given scan numbers. If `None`, no filtering
+        on scan number is performed.
+    part : Tuple[int, int]
+        Only read part `i` of `k` parts of the requested spectra, specified as
+        a tuple `(i, k)`. If `None`, all requested spectra are read.
+    prefetch : int
+        The maximum number of spectra that are read ahead by a background
+        thread. If 0, spectra are only read when requested.
+    prefetch_bytes : int
+        The maximum total size (in bytes) of the peaks of the spectra that are
+        read ahead. If `None`, only the number of spectra is limited.
+    spectrum_filter : SpectrumFilter
+        Only read spectra that satisfy the filter's criteria, which are checked
+        before the spectra's peaks are decoded. If `None`, no additional
+        filtering is performed.
+    stats : ReaderStats
+        Statistics in which the number of returned and skipped spectra, the
+        number of bytes read, and the read and parse times are recorded. If
+        `None`, no statistics are recorded.
+
+    Returns
+    -------
+    Iterator[MsmsSpectrum]
+        An iterator over the requested spectra in the given file.
+    """
+    spectra = _get_spectra(filename, scan_nrs, part, spectrum_filter, stats)
+    if prefetch > 0:
+        spectra = _prefetch(spectra, prefetch, prefetch_bytes)
+    yield from spectra
+
+
+def _get_spectra(filename: str, scan_nrs: Sequence[int] = None,
+                 part: Tuple[int, int] = None,
+                 spectrum_filter: SpectrumFilter = None,
+                 stats: ReaderStats = None) -> Iterator[MsmsSpectrum]:
+    """
+    Read the MS/MS spectra from the given file (see `get_spectra`).
 
     Parameters
     ----------
@@ -29,6 +111,17 @@ def get_spectra(filename: str, scan_nrs: Sequence[int] = None)\
     scan_nrs : Sequence[int]
         Only read spectra with the given scan numbers. If `None`, no filtering
         on scan number is performed.
+    part : Tuple[int, int]
+        Only read part `i` of `k` parts of the requested spectra, specified as
+        a tuple `(i, k)`. If `None`, all requested spectra are read.
+    spectrum_filter : SpectrumFilter
+        Only read spectra that satisfy the filter's criteria, which are checked
+        before the spectra's peaks are decoded. If `None`, no additional
+        filtering is performed.
+    stats : ReaderStats
+        Statistics in which the number of returned and skipped spectra, the
+        number of bytes read, and the read and parse times are recorded. If
+        `None`, no statistics are recorded.
 
     Returns
     -------
@@ -36,20 +129,17 @@ def get_spectra(filename: str, scan_nrs: Sequence[int] = None)\
         An iterator over the requested spectra in the given file.
     """
     basename, ext = os.path.splitext(filename.lower())
-    # Unzip if necessary.
-    close = False
-    if ext == '.gz':
-        source = gzip.open(filename)
-        close = True
-        ext = os.path.splitext(basename)[1]
-    elif ext == '.xz':
-        source = lzma.open(filename)
-        close = True
+    compressed_ext = ext
+    if ext in ('.gz', '.xz'):
         ext = os.path.splitext(basename)[1]
-    else:
-        source = filename
 
-    if ext == '.mgf':
+    if ext == '.spec':
+        for spec in _get_store_batch(filename, scan_nrs, part,
+                                     spectrum_filter, stats).to_spectra():
+            spec.is_processed = False
+            yield spec
+        return
+    elif ext == '.mgf':
         spectrum_io = mgf_io
     elif ext == '.mzml':
         spectrum_io = mzml_io
@@ -58,10 +148,403 @@ def get_spectra(filename: str, scan_nrs: Sequence[int] = None)\
     else:
         raise ValueError(f'Unknown spectrum file type with extension "{ext}"')
 
-    for spec in spectrum_io.get_spectra(
-            source, sorted(set(scan_nrs)) if scan_nrs is not None else None):
-        spec.is_processed = False
-        yield spec
-
-    if close:
+    if stats is None:
+        stats = ReaderStats(filename)
+    # The time spent in this generator, excluding the time spent by the
+    # caller between spectra, consists of the read time (including
+    # decompression) and the parse time.
+    reader_time, read_time = 0., stats.read_time
+    start_time = time.time()
+    source = StatsFile(_open(filename, compressed_ext), stats)
+    try:
+        if scan_nrs is None and part is None and spectrum_filter is None:
+            spectra = spectrum_io.get_spectra(source, stats=stats)
+        else:
+            # Use the file's spectrum index to directly read the requested
+            # spectra in the order in which they occur in the file.
+            index = spectrum_index.get_index(filename, source, ext[1:])
+            offsets = spectrum_index.get_offsets(index, scan_nrs,
+                                                 spectrum_filter)
+            if part is not None:
+                offsets = np.array_split(offsets, part[1])[part[0]]
+            min_peaks = (spectrum_filter.min_peaks
+                         if spectrum_filter is not None else None)
+            if spectrum_io is mgf_io:
+                # MGF spectra don't specify their scan number (i.e. their
+                # position in the file), so it's taken from the index.
+                spectra = mgf_io.get_spectra_at(
+                    source, offsets, min_peaks, stats,
+                    index['scan'].values[np.searchsorted(
+                        index['offset'].values, offsets)])
+            else:
+                spectra = spectrum_io.get_spectra_at(
+                    source, offsets, min_peaks, stats)
+        for spec in spectra:
+            spec.is_processed = False
+            stats.num_yielded += 1
+            reader_time += time.time() - start_time
+            yield spec
+            start_time = time.time()
+        reader_time += time.time() - start_time
+    finally:
         source.close()
+        stats.parse_time += reader_time - (stats.read_time - read_time)
+
+
+def get_spectrum_batch(filename: str, scan_nrs: Sequence[int] = None,
+                       part: Tuple[int, int] = None,
+                       spectrum_filter: SpectrumFilter = None,
+                       stats: ReaderStats = None) -> SpectrumBatch:
+    """
+    Get the MS/MS spectra from the given file as a SpectrumBatch, optionally
+    filtering by scan number.
+
+    Spectra from spectrum stores are read without creating individual spectrum
+    objects.
+
+    Parameters
+    ----------
+    filename : str
+        The file name from which to read the spectra.
+    scan_nrs : Sequence[int]
+        Only read spectra with the given scan numbers. If `None`, no filtering
+        on scan number is performed.
+    part : Tuple[int, int]
+        Only read part `i` of `k` parts of the requested spectra, specified as
+        a tuple `(i, k)` (see `get_spectra`). If `None`, all requested spectra
+        are read.
+    spectrum_filter : SpectrumFilter
+        Only read spectra that satisfy the filter's criteria, which are checked
+        before the spectra's peaks are decoded (see
+        `get_spectra`). If `None`, no additional
+        filtering is performed.
+    stats : ReaderStats
+        Statistics in which the spectra that were read are recorded (see
+        `get_spectra`). If `None`, no statistics are recorded.
+
+    Returns
+    -------
+    SpectrumBatch
+        The requested spectra in the given file.
+    """
+    if filename.lower().endswith('.spec'):
+        return _get_store_batch(filename, scan_nrs, part, spectrum_filter,
+                                stats)
+    else:
+        return SpectrumBatch.from_spectra(get_spectra(
+            filename, scan_nrs, part, spectrum_filter=spectrum_filter,
+            stats=stats))
+
+
+def get_spectrum_batches(filename: str, scan_nrs: Sequence[int] = None,
+                         part: Tuple[int, int] = None, batch_size: int = 2**14,
+                         prefetch: int = 0, prefetch_bytes: int = None,
+                         spectrum_filter: SpectrumFilter = None,
+                         stats: ReaderStats = None)\
+        -> Iterator[SpectrumBatch]:
+    """
+    Get the MS/MS spectra from the given file as consecutive SpectrumBatches
+    of a fixed size, optionally filtering by scan number.
+
+    Spectra can be read ahead by a background thread while the caller
+    processes the previous batch (see `get_spectra`).
+
+    Parameters
+    ----------
+    filename : str
+        The file name from which to read the spectra.
+    scan_nrs : Sequence[int]
+        Only read spectra with the given scan numbers. If `None`, no filtering
+        on scan number is performed.
+    part : Tuple[int, int]
+        Only read part `i` of `k` parts of the requested spectra, specified as
+        a tuple `(i, k)` (see `get_spectra`). If `None`, all requested spectra
+        are read.
+    batch_size : int
+        The maximum number of spectra per batch.
+    prefetch : int
+        The maximum number of spectra that are read ahead by a background
+        thread. If 0, spectra are only read when requested. Spectrum stores
+        are always read directly.
+    prefetch_bytes : int
+        The maximum total size (in bytes) of the peaks of the spectra that are
+        read ahead. If `None`, only the number of spectra is limited.
+    spectrum_filter : SpectrumFilter
+        Only read spectra that satisfy the filter's criteria, which are checked
+        before the spectra's peaks are decoded (see
+        `get_spectra`). If `None`, no additional
+        filtering is performed.
+    stats : ReaderStats
+        Statistics in which the spectra that were read are recorded (see
+        `get_spectra`). If `None`, no statistics are recorded.
+
+    Returns
+    -------
+    Iterator[SpectrumBatch]
+        An iterator over batches of the requested spectra in the given file.
+    """
+    if filename.lower().endswith('.spec'):
+        batch = _get_store_batch(filename, scan_nrs, part, spectrum_filter,
+                                 stats)
+        for start in range(0, len(batch), batch_size):
+            yield batch[start:start + batch_size]
+        return
+    spectra = get_spectra(filename, scan_nrs, part, prefetch, prefetch_bytes,
+                          spectrum_filter, stats)
+    try:
+        while True:
+            batch = SpectrumBatch.from_spectra(
+                itertools.islice(spectra, batch_size))
+            if len(batch) == 0:
+                break
+            yield batch
+    finally:
+        spectra.close()
+
+
+def _get_store_batch(filename: str, scan_nrs: Optional[Sequence[int]],
+                     part: Optional[Tuple[int, int]],
+                     spectrum_filter: Optional[SpectrumFilter],
+                     stats: Optional[ReaderStats]) -> SpectrumBatch:
+    """
+    Get the MS/MS spectra from the given spectrum store as a SpectrumBatch
+    (see `store_io.get_spectrum_batch`), recording the read in the given
+    statistics.
+
+    Parameters
+    ----------
+    filename : str
+        The spectrum store file name.
+    scan_nrs : Optional[Sequence[int]]
+        Only read spectra with the given scan numbers.
+    part : Optional[Tuple[int, int]]
+        Only read part `i` of `k` parts of the requested spectra.
+    spectrum_filter : Optional[SpectrumFilter]
+        Only read spectra that satisfy the filter's criteria.
+    stats : Optional[ReaderStats]
+        Statistics in which the spectra that were read are recorded.
+
+    Returns
+    -------
+    SpectrumBatch
+        The requested spectra in the given file.
+
+    Raises
+    ------
+    ValueError
+        If the spectrum store is an archive member, which can't be
+        memory-mapped.
+    """
+    if archive_io.is_member(filename):
+        raise ValueError('Spectrum stores inside archives can\'t be '
+                         'memory-mapped')
+    start_time = time.time()
+    batch = store_io.get_spectrum_batch(filename, scan_nrs, part,
+                                        spectrum_filter)
+    if stats is not None:
+        stats.read_time += time.time() - start_time
+        stats.bytes_read += batch.mz.nbytes + batch.intensity.nbytes
+        stats.num_yielded += len(batch)
+    return batch
+
+
+def get_spectrum_info(filename: str) -> Optional[pd.DataFrame]:
+    """
+    Get the scan numbers and precursor information of the MS/MS spectra in
+    the given file, without reading their peaks.
+
+    The information is read from the file's persistent spectrum index (which
+    is built if it doesn't exist yet), or directly from spectrum stores.
+
+    Parameters
+    ----------
+    filename : str
+        The peak file name.
+
+    Returns
+    -------
+    Optional[pd.DataFrame]
+        A DataFrame with columns "scan", "precursor_mz", and
+        "precursor_charge" in the order in which the spectra occur in the
+        file, or None if the file type can't be indexed.
+    """
+    basename, ext = os.path.splitext(filename.lower())
+    compressed_ext = ext
+    if ext in ('.gz', '.xz'):
+        ext = os.path.splitext(basename)[1]
+    if ext == '.spec':
+        arrays = store_io.read_arrays(filename)
+        return pd.DataFrame({'scan': arrays['scan'],
+                             'precursor_mz': arrays['precursor_mz'],
+                             'precursor_charge': arrays['precursor_charge']})
+    elif ext in ('.mgf', '.mzml', '.mzxml'):
+        with _open(filename, compressed_ext) as source:
+            index = spectrum_index.get_index(filename, source, ext[1:])
+        # Include spectra with an unknown MS level (see
+        # `spectrum_index.get_offsets`).
+        index = index[index['ms_level'].isin((0, 2))]
+        return index[['scan', 'precursor_mz', 'precursor_charge']]\
+            .reset_index(drop=True)
+    else:
+        return None
+
+
+def get_file_format(filename: str) -> str:
+    """
+    Get the format of the given peak file from its file extension, ignoring
+    GZIP or LZMA compression.
+
+    Parameters
+    ----------
+    filename : str
+        The peak file name or archive member path.
+
+    Returns
+    -------
+    str
+        The (lowercase) file format without the leading dot, e.g. "mgf",
+        "mzml", "mzxml", or "spec".
+    """
+    basename, ext = os.path.splitext(filename.lower())
+    if ext in ('.gz', '.xz'):
+        ext = os.path.splitext(basename)[1]
+    return ext[1:]
+
+
+def build_index(filename: str) -> None:
+    """
+    Build the persistent spectrum index of the given file, if it doesn't
+    exist yet.
+
+    Building the index upfront avoids that multiple processes index the same
+    file simultaneously when reading it in parts concurrently (see
+    `get_spectra`). Spectrum stores don't require an index.
+
+    Parameters
+    ----------
+    filename : str
+        The peak file name.
+    """
+    basename, ext = os.path.splitext(filename.lower())
+    compressed_ext = ext
+    if ext in ('.gz', '.xz'):
+        ext = os.path.splitext(basename)[1]
+    if ext in ('.mgf', '.mzml', '.mzxml'):
+        with _open(filename, compressed_ext) as source:
+            spectrum_index.get_index(filename, source, ext[1:])
+
+
+def _open(filename: str, compressed_ext: str) -> IO:
+    """
+    Open the given peak file for binary reading, decompressing it if
+    necessary.
+
+    Parameters
+    ----------
+    filename : str
+        The peak file name or archive member path (see `get_spectra`).
+    compressed_ext : str
+        The (lowercase) file extension, which indicates GZIP (".gz") or LZMA
+        (".xz") compression.
+
+    Returns
+    -------
+    IO
+        The binary file object.
+    """
+    if not archive_io.is_member(filename):
+        if compressed_ext == '.gz':
+            return gzip.open(filename)
+        elif compressed_ext == '.xz':
+            return lzma.open(filename)
+        else:
+            return open(filename, 'rb')
+    member = archive_io.open(filename)
+    try:
+        # The decompressed stream doesn't close the member that it reads.
+        if compressed_ext == '.gz':
+            return archive_io.ClosingFile(gzip.open(member), member)
+        elif compressed_ext == '.xz':
+            return archive_io.ClosingFile(lzma.open(member), member)
+        else:
+            return member
+    except BaseException:
+        member.close()
+        raise
+
+
+def _prefetch(spectra: Iterator[MsmsSpectrum], max_spectra: int,
+              max_bytes: int = None) -> Iterator[MsmsSpectrum]:
+    """
+    Read spectra ahead in a background thread.
+
+    The background thread stores the spectra in a bounded queue, from which
+    they are returned in their original order. Exceptions raised while reading
+    the spectra are re-raised after all preceding spectra have been returned.
+
+    Parameters
+    ----------
+    spectra : Iterator[MsmsSpectrum]
+        The spectrum generator, which is exclusively advanced (and finally
+        closed) by the background thread.
+    max_spectra : int
+        The maximum number of spectra in the queue.
+    max_bytes : int
+        The maximum total size (in bytes) of the peaks of the spectra in the
+        queue. A single spectrum that exceeds this size is still queued. If
+        `None`, only the number of spectra is limited.
+
+    Returns
+    -------
+    Iterator[MsmsSpectrum]
+        An iterator over the given spectra.
+    """
+    queue, queue_bytes = collections.deque(), 0
+    done, stop, error = False, False, None
+    condition = threading.Condition()
+
+    def read():
+        nonlocal queue_bytes, done, error
+        try:
+            for spec in spectra:
+                size = spec.mz.nbytes + spec.intensity.nbytes
+                with condition:
+                    while (not stop and len(queue) > 0 and
+                           (len(queue) >= max_spectra or
+                            (max_bytes is not None and
+                             queue_bytes + size > max_bytes))):
+                        condition.wait()
+                    if stop:
+                        break
+                    queue.append((spec, size))
+                    queue_bytes += size
+                    condition.notify()
+        except Exception as e:
+            error = e
+        finally:
+            spectra.close()
+            with condition:
+                done = True
+                condition.notify()
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    try:
+        while True:
+            with condition:
+                while len(queue) == 0 and not done:
+                    condition.wait()
+                if len(queue) > 0:
+                    spec, size = queue.popleft()
+                    queue_bytes -= size
+                    condition.notify()
+                elif error is not None:
+                    raise error
+                else:
+                    break
+            yield spec
+    finally:
+        with condition:
+            stop = True
+            condition.notify()
+        reader.join()
@@ -1,16 +1,20 @@
 import logging
 from typing import Dict, IO, Iterator, Sequence, Union
 
+from lxml import etree
 from lxml.etree import LxmlError
 from pyteomics import mzxml
 from spectrum_utils.spectrum import MsmsSpectrum
 
+from gleams.ms_io import spectrum_index
+from gleams.ms_io.reader_stats import ReaderStats
+
 
 logger = logging.getLogger('gleams')
 
 
-def get_spectra(source: Union[IO, str], scan_nrs: Sequence[int] = None)\
-        -> Iterator[MsmsSpectrum]:
+def get_spectra(source: Union[IO, str], scan_nrs: Sequence[int] = None,
+                stats: ReaderStats = None) -> Iterator[MsmsSpectrum]:
     """
     Get the MS/MS spectra from the given mzXML file, optionally filtering by
     scan number.
@@ -23,13 +27,17 @@ def get_spectra(source: Union[IO, str], scan_nrs: Sequence[int] = None)\
     scan_nrs : Sequence[int]
         Only read spectra with the given scan numbers. If `None`, no filtering
         on scan number is performed.
+    stats : ReaderStats
+        Statistics in which skipped spectra are recorded. If `None`, no
+        statistics are recorded.
 
     Returns
     -------
     Iterator[MsmsSpectrum]
         An iterator over the requested spectra in the given file.
     """
-    with mzxml.MzXML(source) as f_in:
+    # Only use the offset index for random access to specific spectra.
+    with mzxml.MzXML(source, use_index=scan_nrs is not None) as f_in:
         # Iterate over a subset of spectra filtered by scan number.
         if scan_nrs is not None:
             def spectrum_it():
@@ -47,11 +55,65 @@ def get_spectra(source: Union[IO, str], scan_nrs: Sequence[int] = None)\
                 try:
                     yield _parse_spectrum(spectrum)
                 except ValueError as e:
-                    pass
-                    # logger.warning(f'Failed to read spectrum %s: %s',
-                    #                spectrum['id'], e)
+                    if stats is not None:
+                        stats.skip(str(e))
         except LxmlError as e:
             logger.warning('Failed to read file %s: %s', source, e)
+            if stats is not None:
+                stats.skip('Invalid XML (remaining spectra not read)')
+
+
+def get_spectra_at(source: IO, offsets: Sequence[int],
+                   min_peaks: int = None, stats: ReaderStats = None)\
+        -> Iterator[MsmsSpectrum]:
+    """
+    Get the MS/MS spectra starting at the given byte offsets in the mzXML
+    file.
+
+    Parameters
+    ----------
+    source : IO
+        The binary mzXML file object from which the spectra are read.
+    offsets : Sequence[int]
+        The byte offsets at which the requested spectra start, as specified in
+        the file's spectrum index, in increasing order.
+    min_peaks : int
+        Skip spectra with fewer peaks, as specified by the spectrum element's
+        attributes, without decoding their peaks. If None, no filtering on the
+        number of peaks is performed.
+    stats : ReaderStats
+        Statistics in which skipped spectra are recorded. If `None`, no
+        statistics are recorded.
+
+    Returns
+    -------
+    Iterator[MsmsSpectrum]
+        An iterator over the requested spectra in the given file.
+    """
+    parser = etree.XMLParser(remove_comments=True, huge_tree=True)
+    source.seek(0)
+    with mzxml.MzXML(source, use_index=False) as f_in:
+        for offset, element in zip(offsets, spectrum_index.read_elements(
+                source, offsets, b'</scan>')):
+            if min_peaks is not None:
+                num_peaks = spectrum_index.get_num_peaks(element, 'mzxml')
+                if num_peaks is not None and num_peaks < min_peaks:
+                    if stats is not None:
+                        stats.skip('Too few peaks')
+                    continue
+            try:
+                element = etree.fromstring(element, parser)
+                # Pyteomics has no public method to convert a single
+                # spectrum element, hence the version pin in setup.py.
+                yield _parse_spectrum(f_in._get_info_smart(element))
+            except ValueError as e:
+                if stats is not None:
+                    stats.skip(str(e))
+            except LxmlError as e:
+                logger.warning('Failed to read spectrum at offset %d in file '
+                               '%s: %s', offset, source, e)
+                if stats is not None:
+                    stats.skip('Invalid XML')
 
 
 def _parse_spectrum(spectrum_dict: Dict) -> MsmsSpectrum:
@@ -92,6 +154,7 @@ def _parse_spectrum(spectrum_dict: Dict) -> MsmsSpectrum:
 
     spectrum = MsmsSpectrum(str(scan_nr), precursor_mz, precursor_charge,
                             mz_array, intensity_array, None, retention_time)
+    spectrum.scan = scan_nr
     spectrum.activation = activation
 
     return spectrum
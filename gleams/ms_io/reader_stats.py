@@ -0,0 +1,129 @@
+import collections
+import time
+from typing import Dict, IO, Union
+
+
+class ReaderStats:
+    """
+    Statistics about reading the spectra from a peak file.
+
+    Spectra that are excluded using the file's spectrum index (see
+    `SpectrumFilter`) are never read and aren't included in the statistics.
+    """
+
+    def __init__(self, filename: str = None):
+        """
+        Instantiate empty ReaderStats.
+
+        Parameters
+        ----------
+        filename : str
+            The peak file name.
+        """
+        self.filename = filename
+        self.num_yielded = 0
+        self.skipped = collections.Counter()
+        self.bytes_read = 0
+        self.read_time = 0.
+        self.parse_time = 0.
+
+    @property
+    def num_seen(self) -> int:
+        """
+        Get the number of spectra that were read.
+
+        Returns
+        -------
+        int
+            The number of spectra that were either returned or skipped.
+        """
+        return self.num_yielded + sum(self.skipped.values())
+
+    def skip(self, reason: str, count: int = 1) -> None:
+        """
+        Record skipped spectra.
+
+        Parameters
+        ----------
+        reason : str
+            The reason why the spectra were skipped.
+        count : int
+            The number of skipped spectra.
+        """
+        self.skipped[reason] += count
+
+    def update(self, other: 'ReaderStats') -> None:
+        """
+        Add the statistics of another read, e.g. of a different part of the
+        same peak file.
+
+        Parameters
+        ----------
+        other : ReaderStats
+            The statistics to be added.
+        """
+        self.num_yielded += other.num_yielded
+        self.skipped.update(other.skipped)
+        self.bytes_read += other.bytes_read
+        self.read_time += other.read_time
+        self.parse_time += other.parse_time
+
+    def to_dict(self) -> Dict[str, Union[str, int, float]]:
+        """
+        Convert the statistics to a flat dictionary.
+
+        Returns
+        -------
+        Dict[str, Union[str, int, float]]
+            The statistics, with a separate "skipped: <reason>" entry for each
+            reason why spectra were skipped.
+        """
+        return {'filename': self.filename,
+                'spectra_seen': self.num_seen,
+                'spectra_yielded': self.num_yielded,
+                'spectra_skipped': self.num_seen - self.num_yielded,
+                **{f'skipped: {reason}': count
+                   for reason, count in sorted(self.skipped.items())},
+                'bytes_read': self.bytes_read,
+                'read_time': self.read_time,
+                'parse_time': self.parse_time}
+
+
+class StatsFile:
+    """
+    Binary file object wrapper that records the number of bytes read and the
+    time spent reading (and decompressing).
+    """
+
+    def __init__(self, source: IO, stats: ReaderStats):
+        """
+        Wrap a binary file object.
+
+        Parameters
+        ----------
+        source : IO
+            The binary file object.
+        stats : ReaderStats
+            The statistics in which the reads are recorded.
+        """
+        self.source = source
+        self.stats = stats
+
+    def read(self, size: int = -1) -> bytes:
+        start_time = time.time()
+        data = self.source.read(size)
+        self.stats.read_time += time.time() - start_time
+        self.stats.bytes_read += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.source, name)
+
+    def __iter__(self):
+        return iter(self.source)
+
+    def __enter__(self) -> 'StatsFile':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.source.close()
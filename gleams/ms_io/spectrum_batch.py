@@ -0,0 +1,195 @@
+from typing import Iterable, Iterator, Tuple, Union
+
+import numba as nb
+import numpy as np
+from spectrum_utils.spectrum import MsmsSpectrum
+
+
+class SpectrumBatch:
+    """
+    A batch of spectra stored as flat arrays.
+
+    The peaks of all spectra are concatenated in single m/z and intensity
+    arrays, with the peaks of spectrum `i` at positions
+    `offsets[i]:offsets[i + 1]`. Peaks of each spectrum are sorted by m/z.
+    Per-spectrum information is stored in separate arrays with one element per
+    spectrum.
+    """
+
+    def __init__(self, identifier: np.ndarray, precursor_mz: np.ndarray,
+                 precursor_charge: np.ndarray, mz: np.ndarray,
+                 intensity: np.ndarray, offsets: np.ndarray,
+                 retention_time: np.ndarray = None, scan: np.ndarray = None):
+        """
+        Instantiate a SpectrumBatch.
+
+        Parameters
+        ----------
+        identifier : np.ndarray
+            The spectrum identifiers.
+        precursor_mz : np.ndarray
+            The precursor m/z values.
+        precursor_charge : np.ndarray
+            The precursor charges.
+        mz : np.ndarray
+            The concatenated m/z values of the spectrum peaks.
+        intensity : np.ndarray
+            The concatenated intensities of the spectrum peaks.
+        offsets : np.ndarray
+            The start positions of each spectrum's peaks in the m/z and
+            intensity arrays, followed by the total number of peaks.
+        retention_time : np.ndarray
+            The retention times. If None, the retention times are unknown
+            (NaN).
+        scan : np.ndarray
+            The scan numbers of the spectra in the file from which they were
+            read (see `ms_io.get_spectra`). If None, the scan numbers are
+            unknown (-1).
+        """
+        self.identifier = np.asarray(identifier)
+        self.precursor_mz = np.asarray(precursor_mz)
+        self.precursor_charge = np.asarray(precursor_charge)
+        self.mz = np.asarray(mz, np.float32)
+        self.intensity = np.asarray(intensity, np.float32)
+        self.offsets = np.asarray(offsets, np.int64)
+        self.retention_time = (
+            np.asarray(retention_time) if retention_time is not None else
+            np.full(len(self.identifier), np.nan))
+        self.scan = (np.asarray(scan, np.int64) if scan is not None else
+                     np.full(len(self.identifier), -1, np.int64))
+        self.is_valid = np.ones(len(self.identifier), np.bool_)
+        self.is_processed = False
+
+    def __len__(self) -> int:
+        return len(self.identifier)
+
+    def __getitem__(self, idx: Union[np.ndarray, slice]) -> 'SpectrumBatch':
+        """
+        Select a subset of the spectra in the batch.
+
+        Parameters
+        ----------
+        idx : Union[np.ndarray, slice]
+            The indexes or boolean mask of the spectra to be selected.
+
+        Returns
+        -------
+        SpectrumBatch
+            A new SpectrumBatch containing only the selected spectra.
+        """
+        idx = np.arange(len(self))[idx]
+        mz, intensity, offsets = _take_peaks(self.mz, self.intensity,
+                                             self.offsets, idx)
+        batch = SpectrumBatch(
+            self.identifier[idx], self.precursor_mz[idx],
+            self.precursor_charge[idx], mz, intensity, offsets,
+            self.retention_time[idx], self.scan[idx])
+        batch.is_valid = self.is_valid[idx]
+        batch.is_processed = self.is_processed
+        return batch
+
+    def get_peaks(self, i: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Get the peaks of the spectrum at the given position in the batch.
+
+        Parameters
+        ----------
+        i : int
+            The position of the spectrum in the batch.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            The m/z values and intensities of the spectrum's peaks.
+        """
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return self.mz[start:stop], self.intensity[start:stop]
+
+    @classmethod
+    def from_spectra(cls, spectra: Iterable[MsmsSpectrum]) -> 'SpectrumBatch':
+        """
+        Combine the given spectra in a SpectrumBatch.
+
+        Parameters
+        ----------
+        spectra : Iterable[MsmsSpectrum]
+            The spectra to be combined. Their scan numbers are taken from
+            their `scan` attribute, which is set by the spectrum readers (see
+            `ms_io.get_spectra`).
+
+        Returns
+        -------
+        SpectrumBatch
+            A SpectrumBatch containing the given spectra.
+        """
+        spectra = list(spectra)
+        offsets = np.zeros(len(spectra) + 1, np.int64)
+        np.cumsum([len(spec.mz) for spec in spectra], out=offsets[1:])
+        return cls(
+            np.asarray([spec.identifier for spec in spectra], np.str_),
+            np.asarray([spec.precursor_mz for spec in spectra], np.float64),
+            np.asarray([spec.precursor_charge for spec in spectra], np.int64),
+            np.concatenate([spec.mz for spec in spectra] or [[]]),
+            np.concatenate([spec.intensity for spec in spectra] or [[]]),
+            offsets,
+            np.asarray([spec.retention_time
+                        if spec.retention_time is not None else np.nan
+                        for spec in spectra], np.float64),
+            np.asarray([getattr(spec, 'scan', -1) for spec in spectra],
+                       np.int64))
+
+    def to_spectra(self) -> Iterator[MsmsSpectrum]:
+        """
+        Convert the spectra in the batch to individual spectrum objects.
+
+        Returns
+        -------
+        Iterator[MsmsSpectrum]
+            An iterator over the spectra in the batch.
+        """
+        for i in range(len(self)):
+            spec = MsmsSpectrum(
+                str(self.identifier[i]), float(self.precursor_mz[i]),
+                int(self.precursor_charge[i]), *self.get_peaks(i), None,
+                float(self.retention_time[i]))
+            spec.scan = int(self.scan[i])
+            spec.is_valid = bool(self.is_valid[i])
+            spec.is_processed = self.is_processed
+            yield spec
+
+
+@nb.njit
+def _take_peaks(mz: np.ndarray, intensity: np.ndarray, offsets: np.ndarray,
+                idx: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Gather the peaks of the spectra at the given positions.
+
+    Parameters
+    ----------
+    mz : np.ndarray
+        The concatenated m/z values of the spectrum peaks.
+    intensity : np.ndarray
+        The concatenated intensities of the spectrum peaks.
+    offsets : np.ndarray
+        The start positions of each spectrum's peaks.
+    idx : np.ndarray
+        The positions of the spectra to be gathered.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, np.ndarray]
+        The concatenated m/z values, intensities, and offsets of the peaks of
+        the gathered spectra.
+    """
+    offsets_take = np.zeros(len(idx) + 1, np.int64)
+    for i in range(len(idx)):
+        offsets_take[i + 1] = (offsets_take[i] + offsets[idx[i] + 1] -
+                               offsets[idx[i]])
+    mz_take = np.empty(offsets_take[-1], np.float32)
+    intensity_take = np.empty(offsets_take[-1], np.float32)
+    for i in range(len(idx)):
+        start, stop = offsets[idx[i]], offsets[idx[i] + 1]
+        mz_take[offsets_take[i]:offsets_take[i + 1]] = mz[start:stop]
+        intensity_take[offsets_take[i]:offsets_take[i + 1]] = \
+            intensity[start:stop]
+    return mz_take, intensity_take, offsets_take
@@ -0,0 +1,142 @@
+from typing import Iterable, Optional
+
+import numpy as np
+
+
+class SpectrumFilter:
+    """
+    Criteria that spectra have to satisfy to be read from a peak file.
+
+    The criteria only use information that is available in the spectrum
+    headers (or in the file's spectrum index), so that the peaks of spectra
+    that don't satisfy the criteria don't need to be decoded. Unknown header
+    values (NaN precursor m/z, precursor charge 0 or None) satisfy all
+    criteria, spectra with an unknown precursor charge are subsequently
+    rejected by the spectrum readers.
+    """
+
+    def __init__(self, scan_nrs: Iterable[int] = None, min_charge: int = None,
+                 max_charge: int = None, min_mz: float = None,
+                 max_mz: float = None, min_peaks: int = None):
+        """
+        Instantiate a SpectrumFilter.
+
+        Parameters
+        ----------
+        scan_nrs : Iterable[int]
+            Only accept spectra with the given scan numbers. If None, no
+            filtering on scan number is performed.
+        min_charge : int
+            The minimum precursor charge. If None, there's no minimum.
+        max_charge : int
+            The maximum precursor charge. If None, there's no maximum.
+        min_mz : float
+            The minimum precursor m/z. If None, there's no minimum.
+        max_mz : float
+            The maximum precursor m/z. If None, there's no maximum.
+        min_peaks : int
+            The minimum number of (unprocessed) peaks. If None, there's no
+            minimum.
+        """
+        self.scan_nrs = (frozenset(int(scan_nr) for scan_nr in scan_nrs)
+                         if scan_nrs is not None else None)
+        self.min_charge = min_charge
+        self.max_charge = max_charge
+        self.min_mz = min_mz
+        self.max_mz = max_mz
+        self.min_peaks = min_peaks
+
+    def accepts(self, scan_nr: Optional[int] = None,
+                precursor_mz: Optional[float] = None,
+                precursor_charge: Optional[int] = None,
+                num_peaks: Optional[int] = None) -> bool:
+        """
+        Check whether a spectrum satisfies the criteria based on its header
+        information.
+
+        Parameters
+        ----------
+        scan_nr : Optional[int]
+            The spectrum's scan number, or None if not checked.
+        precursor_mz : Optional[float]
+            The spectrum's precursor m/z, or None if not checked.
+        precursor_charge : Optional[int]
+            The spectrum's precursor charge, or None if not checked.
+        num_peaks : Optional[int]
+            The spectrum's number of peaks, or None if not checked.
+
+        Returns
+        -------
+        bool
+            False if any of the specified information violates the criteria,
+            True otherwise.
+        """
+        if (scan_nr is not None and self.scan_nrs is not None and
+                scan_nr not in self.scan_nrs):
+            return False
+        if precursor_mz is not None and (
+                (self.min_mz is not None and precursor_mz < self.min_mz) or
+                (self.max_mz is not None and precursor_mz > self.max_mz)):
+            return False
+        if precursor_charge and (
+                (self.min_charge is not None and
+                 precursor_charge < self.min_charge) or
+                (self.max_charge is not None and
+                 precursor_charge > self.max_charge)):
+            return False
+        if (num_peaks is not None and self.min_peaks is not None and
+                num_peaks < self.min_peaks):
+            return False
+        return True
+
+    def get_mask(self, scan_nrs: np.ndarray = None,
+                 precursor_mz: np.ndarray = None,
+                 precursor_charge: np.ndarray = None,
+                 num_peaks: np.ndarray = None) -> np.ndarray:
+        """
+        Check which of multiple spectra satisfy the criteria based on their
+        header information.
+
+        Parameters
+        ----------
+        scan_nrs : np.ndarray
+            The spectra's scan numbers, or None if not checked.
+        precursor_mz : np.ndarray
+            The spectra's precursor m/z values, or None if not checked.
+        precursor_charge : np.ndarray
+            The spectra's precursor charges, or None if not checked.
+        num_peaks : np.ndarray
+            The spectra's numbers of peaks, or None if not checked.
+
+        Returns
+        -------
+        np.ndarray
+            A boolean mask indicating which spectra satisfy the criteria. At
+            least one of the arrays needs to be specified to determine the
+            number of spectra.
+        """
+        num_spectra = len(next(values for values in (
+            scan_nrs, precursor_mz, precursor_charge, num_peaks)
+            if values is not None))
+        mask = np.ones(num_spectra, np.bool_)
+        if scan_nrs is not None and self.scan_nrs is not None:
+            mask &= np.isin(np.asarray(scan_nrs, np.int64),
+                            np.fromiter(self.scan_nrs, np.int64,
+                                        len(self.scan_nrs)))
+        if precursor_mz is not None:
+            precursor_mz = np.asarray(precursor_mz, np.float64)
+            if self.min_mz is not None:
+                mask &= ~(precursor_mz < self.min_mz)
+            if self.max_mz is not None:
+                mask &= ~(precursor_mz > self.max_mz)
+        if precursor_charge is not None:
+            precursor_charge = np.asarray(precursor_charge, np.int64)
+            if self.min_charge is not None:
+                mask &= ((precursor_charge == 0) |
+                         (precursor_charge >= self.min_charge))
+            if self.max_charge is not None:
+                mask &= ((precursor_charge == 0) |
+                         (precursor_charge <= self.max_charge))
+        if num_peaks is not None and self.min_peaks is not None:
+            mask &= np.asarray(num_peaks) >= self.min_peaks
+        return mask
@@ -0,0 +1,385 @@
+import hashlib
+import logging
+import os
+import re
+from typing import IO, Iterator, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from gleams import config
+from gleams.ms_io import archive_io
+from gleams.ms_io import mgf_io
+from gleams.ms_io.spectrum_filter import SpectrumFilter
+
+
+logger = logging.getLogger('gleams')
+
+
+# Number of bytes read from the peak file at once.
+_chunk_size = 2 ** 24
+
+_mzml_id = re.compile(rb'\sid="[^"]*?scan=(\d+)')
+_mzml_cv_param = re.compile(rb'<cvParam\s[^>]*>')
+_mzml_accession = re.compile(rb'accession="([^"]*)"')
+_mzml_value = re.compile(rb'value="([^"]*)"')
+_mzxml_num = re.compile(rb'\snum="(\d+)"')
+_mzxml_ms_level = re.compile(rb'\smsLevel="(\d+)"')
+_mzxml_precursor = re.compile(rb'<precursorMz([^>]*)>\s*([^<\s]+)')
+_mzxml_charge = re.compile(rb'precursorCharge="(\d+)"')
+_mzml_num_peaks = re.compile(rb'\sdefaultArrayLength="(\d+)"')
+_mzxml_num_peaks = re.compile(rb'\speaksCount="(\d+)"')
+
+
+def get_index(filename: str, source: IO, file_type: str)\
+        -> Optional[pd.DataFrame]:
+    """
+    Get the index of all spectra in the given peak file.
+
+    The index contains for each spectrum its scan number, byte offset, MS
+    level, precursor m/z, and precursor charge (0 if unknown). For MGF files
+    the scan number is the spectrum's position in the file.
+
+    The index is stored in a Parquet file in `config.spectrum_index_dir`,
+    which is reused as long as the size and modification time of the peak
+    file (or of the archive that contains it) don't change.
+
+    Parameters
+    ----------
+    filename : str
+        The peak file name or archive member path.
+    source : IO
+        The (decompressed) binary peak file object. The index is built by
+        reading the file object from its current position onwards.
+    file_type : str
+        The peak file type, either "mgf", "mzml", or "mzxml".
+
+    Returns
+    -------
+    Optional[pd.DataFrame]
+        A DataFrame with columns "scan", "offset", "ms_level", "precursor_mz",
+        and "precursor_charge", sorted by offset, or None if the spectra in the
+        peak file can't be indexed.
+    """
+    index_filename = _get_index_filename(filename)
+    stat = archive_io.stat(filename)
+    file_key = {b'size': str(stat.st_size).encode(),
+                b'mtime': str(stat.st_mtime_ns).encode()}
+    if os.path.isfile(index_filename):
+        try:
+            index = pq.read_table(index_filename)
+            metadata = index.schema.metadata or {}
+            if all(metadata.get(key) == value
+                   for key, value in file_key.items()):
+                return index.to_pandas()
+        except (OSError, pa.ArrowException) as e:
+            logger.warning('Failed to read index file %s: %s',
+                           index_filename, e)
+    logger.debug('Index spectra in file %s', filename)
+    if file_type == 'mgf':
+        index_it = _index_mgf(source)
+    elif file_type == 'mzml':
+        index_it = _index_mzml(source)
+    elif file_type == 'mzxml':
+        index_it = _index_mzxml(source)
+    else:
+        return None
+    index = pd.DataFrame.from_records(
+        list(index_it), columns=['scan', 'offset', 'ms_level',
+                                 'precursor_mz', 'precursor_charge'])
+    index = index.astype({'scan': np.int64, 'offset': np.int64,
+                          'ms_level': np.int8, 'precursor_mz': np.float64,
+                          'precursor_charge': np.int8})
+    try:
+        os.makedirs(config.spectrum_index_dir, exist_ok=True)
+        table = pa.Table.from_pandas(index, preserve_index=False)
+        pq.write_table(table.replace_schema_metadata(file_key),
+                       index_filename)
+    except (OSError, pa.ArrowException) as e:
+        logger.warning('Failed to save index file %s: %s', index_filename, e)
+    return index
+
+
+def _get_index_filename(filename: str) -> str:
+    """
+    Get the name of the index file of the given peak file.
+
+    Parameters
+    ----------
+    filename : str
+        The peak file name or archive member path.
+
+    Returns
+    -------
+    str
+        The index file name in `config.spectrum_index_dir`, consisting of the
+        peak file's base name and a hash of its full path, e.g.
+        "file.mzML.{hash}.idx.parquet" for peak file "/data/file.mzML" or for
+        archive member path "/data/dataset.tar!/run/file.mzML".
+    """
+    path_hash = hashlib.sha1(
+        os.path.abspath(filename).encode()).hexdigest()[:16]
+    return os.path.join(config.spectrum_index_dir,
+                        f'{os.path.basename(filename)}.{path_hash}'
+                        f'.idx.parquet')
+
+
+def get_offsets(index: pd.DataFrame, scan_nrs: Sequence[int] = None,
+                spectrum_filter: SpectrumFilter = None) -> np.ndarray:
+    """
+    Get the byte offsets of the MS/MS spectra with the given scan numbers.
+
+    Spectra with an unknown MS level are included as well.
+
+    Parameters
+    ----------
+    index : pd.DataFrame
+        The peak file index as returned by `get_index`.
+    scan_nrs : Sequence[int]
+        The scan numbers of the requested spectra. Scan numbers that are not
+        present in the index are ignored. If `None`, the offsets of all MS/MS
+        spectra are returned.
+    spectrum_filter : SpectrumFilter
+        Only return the offsets of spectra that satisfy the filter's scan
+        number, precursor m/z, and precursor charge criteria. If `None`, no
+        additional filtering is performed.
+
+    Returns
+    -------
+    np.ndarray
+        The byte offsets of the requested spectra in increasing order.
+    """
+    mask = index['ms_level'].isin((0, 2)).values
+    if scan_nrs is not None:
+        mask = mask & index['scan'].isin(scan_nrs).values
+    if spectrum_filter is not None:
+        mask = mask & spectrum_filter.get_mask(
+            index['scan'].values, index['precursor_mz'].values,
+            index['precursor_charge'].values)
+    return np.sort(index['offset'].values[mask])
+
+
+def read_elements(source: IO, offsets: Sequence[int], end: bytes)\
+        -> Iterator[bytes]:
+    """
+    Read the text of the spectrum elements starting at the given byte
+    offsets.
+
+    The file is only read forward, text that was read beyond the end of an
+    element is reused for the next element. This avoids seeking backwards,
+    which requires decompressing compressed files from the start again.
+
+    Parameters
+    ----------
+    source : IO
+        The binary peak file object.
+    offsets : Sequence[int]
+        The byte offsets at which the elements start, in increasing order.
+    end : bytes
+        The elements' closing tag.
+
+    Returns
+    -------
+    Iterator[bytes]
+        An iterator of the element texts up to and including the closing
+        tag, or up to the end of the file for incomplete elements.
+    """
+    buffer, buffer_offset = b'', None
+    for offset in offsets:
+        if (buffer_offset is not None and
+                buffer_offset <= offset <= buffer_offset + len(buffer)):
+            buffer = buffer[offset - buffer_offset:]
+        else:
+            source.seek(offset)
+            buffer = b''
+        buffer_offset = offset
+        search_start = 0
+        while True:
+            end_i = buffer.find(end, search_start)
+            if end_i != -1:
+                yield buffer[:end_i + len(end)]
+                break
+            chunk = source.read(2 ** 16)
+            if not chunk:
+                yield buffer
+                break
+            search_start = max(0, len(buffer) - len(end) + 1)
+            buffer += chunk
+
+
+def get_num_peaks(element: bytes, file_type: str) -> Optional[int]:
+    """
+    Get the number of peaks of a spectrum from the attributes of its element
+    start tag, without decoding its peaks.
+
+    Parameters
+    ----------
+    element : bytes
+        The spectrum element text.
+    file_type : str
+        The peak file type, either "mzml" or "mzxml".
+
+    Returns
+    -------
+    Optional[int]
+        The number of peaks, or None if unknown.
+    """
+    regex = _mzml_num_peaks if file_type == 'mzml' else _mzxml_num_peaks
+    num_peaks = regex.search(element, 0, element.find(b'>') + 1)
+    return int(num_peaks.group(1)) if num_peaks is not None else None
+
+
+def _scan(source: IO, start: bytes, ends: Tuple[bytes, ...])\
+        -> Iterator[Tuple[int, bytes]]:
+    """
+    Scan a file for text blocks starting with the given start token.
+
+    Parameters
+    ----------
+    source : IO
+        The binary file object.
+    start : bytes
+        The token that marks the start of a block.
+    ends : Tuple[bytes, ...]
+        Tokens that mark the end of a block. The block ends at the first
+        occurrence of any of these tokens.
+
+    Returns
+    -------
+    Iterator[Tuple[int, bytes]]
+        An iterator of tuples with the byte offset of each block and the block
+        text (excluding the end token).
+    """
+    buffer, buffer_offset = b'', 0
+    while True:
+        chunk = source.read(_chunk_size)
+        buffer += chunk
+        pos = 0
+        while True:
+            begin = buffer.find(start, pos)
+            if begin == -1:
+                break
+            stops = [stop for stop in (buffer.find(end, begin + len(start))
+                                       for end in ends) if stop != -1]
+            if not stops and chunk:
+                break
+            stop = min(stops) if stops else len(buffer)
+            yield buffer_offset + begin, buffer[begin:stop]
+            pos = stop
+        cut = (begin if begin != -1 else
+               max(pos, len(buffer) - len(start) + 1))
+        buffer, buffer_offset = buffer[cut:], buffer_offset + cut
+        if not chunk:
+            break
+
+
+def _index_mgf(source: IO)\
+        -> Iterator[Tuple[int, int, int, float, int]]:
+    """
+    Index the spectra in an MGF file.
+
+    Parameters
+    ----------
+    source : IO
+        The binary MGF file object.
+
+    Returns
+    -------
+    Iterator[Tuple[int, int, int, float, int]]
+        An iterator of (scan number, byte offset, MS level, precursor m/z,
+        precursor charge) tuples.
+    """
+    header_params = None
+    for scan_nr, (offset, block) in enumerate(
+            _scan(source, mgf_io._begin_ions, (mgf_io._end_ions,))):
+        if header_params is None:
+            # Parameters in the file header apply to all spectra.
+            pos = source.tell()
+            source.seek(0)
+            header_params = mgf_io._parse_params(source.read(offset))
+            source.seek(pos)
+        params = {**header_params, **mgf_io._parse_params(block)}
+        pepmass = params.get('pepmass', 'nan').split()
+        charge = (pepmass[2] if len(pepmass) == 3 else
+                  params.get('charge', ''))
+        try:
+            charge = mgf_io._parse_charge(charge) or 0
+        except ValueError:
+            charge = 0
+        yield scan_nr, offset, 2, float(pepmass[0]), charge
+
+
+def _index_mzml(source: IO)\
+        -> Iterator[Tuple[int, int, int, float, int]]:
+    """
+    Index the spectra in an mzML file.
+
+    Only the spectrum headers are inspected, binary data arrays are skipped.
+
+    Parameters
+    ----------
+    source : IO
+        The binary mzML file object.
+
+    Returns
+    -------
+    Iterator[Tuple[int, int, int, float, int]]
+        An iterator of (scan number, byte offset, MS level, precursor m/z,
+        precursor charge) tuples.
+    """
+    for offset, header in _scan(source, b'<spectrum ',
+                                (b'<binaryDataArrayList', b'</spectrum>')):
+        scan_nr = _mzml_id.search(header)
+        if scan_nr is None:
+            continue
+        ms_level, precursor_mz, charge = 0, np.nan, 0
+        for cv_param in _mzml_cv_param.findall(header):
+            accession = _mzml_accession.search(cv_param)
+            value = _mzml_value.search(cv_param)
+            if accession is None or value is None:
+                continue
+            accession, value = accession.group(1), value.group(1)
+            if accession == b'MS:1000511':
+                ms_level = int(value)
+            elif accession == b'MS:1000744' and np.isnan(precursor_mz):
+                precursor_mz = float(value)
+            elif accession == b'MS:1000041' and charge == 0:
+                charge = int(value)
+            elif accession == b'MS:1000633' and charge == 0:
+                charge = int(value)
+        yield int(scan_nr.group(1)), offset, ms_level, precursor_mz, charge
+
+
+def _index_mzxml(source: IO)\
+        -> Iterator[Tuple[int, int, int, float, int]]:
+    """
+    Index the spectra in an mzXML file.
+
+    Only the scan headers are inspected, peak data is skipped.
+
+    Parameters
+    ----------
+    source : IO
+        The binary mzXML file object.
+
+    Returns
+    -------
+    Iterator[Tuple[int, int, int, float, int]]
+        An iterator of (scan number, byte offset, MS level, precursor m/z,
+        precursor charge) tuples.
+    """
+    for offset, header in _scan(source, b'<scan ', (b'<peaks', b'</scan>')):
+        scan_nr = _mzxml_num.search(header)
+        if scan_nr is None:
+            continue
+        ms_level = _mzxml_ms_level.search(header)
+        ms_level = int(ms_level.group(1)) if ms_level is not None else 0
+        precursor_mz, charge = np.nan, 0
+        precursor = _mzxml_precursor.search(header)
+        if precursor is not None:
+            precursor_mz = float(precursor.group(2))
+            charge = _mzxml_charge.search(precursor.group(1))
+            charge = int(charge.group(1)) if charge is not None else 0
+        yield int(scan_nr.group(1)), offset, ms_level, precursor_mz, charge
@@ -0,0 +1,356 @@
+import collections
+import itertools
+import logging
+import os
+import shutil
+import tempfile
+from typing import Dict, IO, Iterable, Iterator, Sequence, Tuple
+
+import numpy as np
+from spectrum_utils.spectrum import MsmsSpectrum
+
+from gleams.ms_io import archive_io
+from gleams.ms_io.spectrum_batch import SpectrumBatch
+from gleams.ms_io.spectrum_filter import SpectrumFilter
+
+
+logger = logging.getLogger('gleams')
+
+
+# Arrays in a spectrum store: per-spectrum information and concatenated peaks
+# with CSR-style offsets.
+_fields = ('scan', 'identifier', 'precursor_mz', 'precursor_charge',
+           'retention_time', 'offsets', 'mz', 'intensity')
+# Byte alignment of the arrays in the spectrum store.
+_alignment = 64
+# Number of spectra that are written to a spectrum store at once.
+_batch_size = 2**14
+
+
+def convert(peak_filename: str, store_filename: str = None) -> str:
+    """
+    Convert a peak file to a spectrum store.
+
+    The spectrum store is a single binary file containing the spectra as
+    contiguous NumPy arrays, which can be read by memory-mapping without any
+    parsing. If the spectrum store already exists and is more recent than the
+    peak file it will _not_ be recreated.
+
+    The spectra keep the scan numbers of the peak file (see
+    `ms_io.get_spectra`), so that spectra are selected by the same scan
+    numbers from the peak file and from its spectrum store.
+
+    Parameters
+    ----------
+    peak_filename : str
+        The peak file name. Any file supported by `ms_io.get_spectra` can be
+        converted, including peak files inside archives.
+    store_filename : str
+        The spectrum store file name. If None, the compression extension of the
+        peak file (if any) is replaced by ".spec", or ".spec" is appended
+        otherwise (e.g. "run.mzML.gz" is converted to "run.mzML.spec").
+        Spectrum stores of peak files inside archives are stored next to the
+        archive (e.g. "dataset.tar!/run.mzML" is converted to
+        "dataset.tar!run.mzML.spec").
+
+    Returns
+    -------
+    str
+        The spectrum store file name.
+    """
+    # Avoid circular import.
+    from gleams.ms_io import ms_io
+    if store_filename is None:
+        basename, ext = os.path.splitext(peak_filename)
+        if ext.lower() not in ('.gz', '.xz'):
+            basename = peak_filename
+        store_filename = archive_io.get_sidecar_filename(basename, '.spec')
+    if (not os.path.isfile(store_filename) or
+            os.path.getmtime(store_filename) <
+            archive_io.stat(peak_filename).st_mtime):
+        logger.debug('Convert peak file %s to spectrum store %s',
+                     peak_filename, store_filename)
+        write_spectra(store_filename, ms_io.get_spectra(peak_filename))
+    return store_filename
+
+
+def write_spectra(filename: str, spectra: Iterable[MsmsSpectrum]) -> None:
+    """
+    Write the given spectra to a spectrum store.
+
+    Peaks are buffered on disk, so memory usage doesn't depend on the number of
+    spectra.
+
+    Parameters
+    ----------
+    filename : str
+        The spectrum store file name.
+    spectra : Iterable[MsmsSpectrum]
+        The spectra to be written.
+    """
+    spectra = iter(spectra)
+    with SpectrumStoreWriter(filename) as writer:
+        while True:
+            batch = SpectrumBatch.from_spectra(
+                itertools.islice(spectra, _batch_size))
+            if len(batch) == 0:
+                break
+            writer.write(batch)
+
+
+class SpectrumStoreWriter:
+    """
+    Incrementally write batches of spectra to a spectrum store.
+
+    Peaks are buffered on disk, so memory usage doesn't depend on the number of
+    spectra. The spectrum store is created when the writer is closed. If the
+    writer is used as a context manager and an exception occurs, no spectrum
+    store is created.
+    """
+
+    def __init__(self, filename: str):
+        """
+        Instantiate a SpectrumStoreWriter.
+
+        Parameters
+        ----------
+        filename : str
+            The spectrum store file name.
+        """
+        self.filename = filename
+        self._arrays = collections.defaultdict(list)
+        self._num_peaks = 0
+        self._f_mz = tempfile.TemporaryFile()
+        self._f_intensity = tempfile.TemporaryFile()
+
+    def write(self, batch: SpectrumBatch) -> None:
+        """
+        Write the spectra in the given batch.
+
+        Parameters
+        ----------
+        batch : SpectrumBatch
+            The spectra to be written.
+        """
+        self._arrays['scan'].append(np.asarray(batch.scan, np.int64))
+        self._arrays['identifier'].append(
+            np.asarray(batch.identifier, np.str_))
+        self._arrays['precursor_mz'].append(
+            np.asarray(batch.precursor_mz, np.float64))
+        self._arrays['precursor_charge'].append(
+            np.asarray(batch.precursor_charge, np.int8))
+        self._arrays['retention_time'].append(
+            np.asarray(batch.retention_time, np.float64))
+        self._arrays['offsets'].append(
+            batch.offsets[1:] - batch.offsets[0] + self._num_peaks)
+        start, stop = batch.offsets[0], batch.offsets[-1]
+        self._f_mz.write(batch.mz[start:stop].tobytes())
+        self._f_intensity.write(batch.intensity[start:stop].tobytes())
+        self._num_peaks += int(stop - start)
+
+    def close(self) -> None:
+        """
+        Create the spectrum store from the written spectra.
+        """
+        try:
+            arrays = {}
+            for field, dtype in (('scan', np.int64),
+                                 ('identifier', np.str_),
+                                 ('precursor_mz', np.float64),
+                                 ('precursor_charge', np.int8),
+                                 ('retention_time', np.float64)):
+                arrays[field] = (np.concatenate(self._arrays[field])
+                                 if len(self._arrays[field]) > 0 else
+                                 np.empty(0, dtype))
+            arrays['offsets'] = np.concatenate(
+                [np.zeros(1, np.int64)] + self._arrays['offsets'])
+            # For spectra with unknown scan numbers, use their numeric
+            # identifiers or otherwise their positions in the spectrum store.
+            if np.any(arrays['scan'] < 0):
+                if all(identifier.isdigit()
+                       for identifier in arrays['identifier']):
+                    arrays['scan'] = arrays['identifier'].astype(np.int64)
+                else:
+                    arrays['scan'] = np.arange(len(arrays['identifier']),
+                                               dtype=np.int64)
+            arrays['mz'], arrays['intensity'] = self._f_mz, self._f_intensity
+            with open(f'{self.filename}.tmp', 'wb') as f_out:
+                np.save(f_out, np.asarray(_fields))
+                for field in _fields:
+                    f_out.write(b'\x00' * (-f_out.tell() % _alignment))
+                    array = arrays[field]
+                    if isinstance(array, np.ndarray):
+                        np.save(f_out, array)
+                    else:
+                        np.lib.format.write_array_header_1_0(f_out, {
+                            'descr': np.lib.format.dtype_to_descr(
+                                np.dtype(np.float32)),
+                            'fortran_order': False,
+                            'shape': (self._num_peaks,)})
+                        array.seek(0)
+                        shutil.copyfileobj(array, f_out)
+            os.replace(f'{self.filename}.tmp', self.filename)
+        finally:
+            self.discard()
+
+    def discard(self) -> None:
+        """
+        Discard the written spectra without creating the spectrum store.
+        """
+        self._f_mz.close()
+        self._f_intensity.close()
+        self._arrays.clear()
+
+    def __enter__(self) -> 'SpectrumStoreWriter':
+        return self
+
+    def __exit__(self, exc_type, *args) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+def read_arrays(filename: str) -> Dict[str, np.ndarray]:
+    """
+    Memory-map the arrays in the given spectrum store.
+
+    Parameters
+    ----------
+    filename : str
+        The spectrum store file name.
+
+    Returns
+    -------
+    Dict[str, np.ndarray]
+        A dictionary of read-only arrays: "scan", "identifier",
+        "precursor_mz", "precursor_charge", and "retention_time" contain
+        per-spectrum information, "mz" and "intensity" contain the
+        concatenated peaks of all spectra, with the peaks of spectrum `i` at
+        positions `offsets[i]:offsets[i + 1]`.
+    """
+    arrays = {}
+    with open(filename, 'rb') as f_in:
+        fields = np.load(f_in)
+        for field in fields:
+            f_in.seek(-f_in.tell() % _alignment, os.SEEK_CUR)
+            shape, dtype = _read_array_header(f_in)
+            if np.prod(shape) > 0:
+                arrays[field] = np.memmap(filename, dtype, 'r', f_in.tell(),
+                                          shape)
+            else:
+                arrays[field] = np.empty(shape, dtype)
+            f_in.seek(int(np.prod(shape)) * dtype.itemsize, os.SEEK_CUR)
+    return arrays
+
+
+def _read_array_header(f_in: IO):
+    """
+    Read the NumPy array header at the current position of the given file.
+
+    Parameters
+    ----------
+    f_in : IO
+        The binary file object.
+
+    Returns
+    -------
+    Tuple[Tuple[int, ...], np.dtype]
+        The shape and data type of the array.
+    """
+    version = np.lib.format.read_magic(f_in)
+    if version == (1, 0):
+        shape, _, dtype = np.lib.format.read_array_header_1_0(f_in)
+    else:
+        shape, _, dtype = np.lib.format.read_array_header_2_0(f_in)
+    return shape, dtype
+
+
+def get_spectrum_batch(source: str, scan_nrs: Sequence[int] = None,
+                       part: Tuple[int, int] = None,
+                       spectrum_filter: SpectrumFilter = None)\
+        -> SpectrumBatch:
+    """
+    Get the MS/MS spectra from the given spectrum store as a SpectrumBatch,
+    optionally filtering by scan number.
+
+    Without filtering the SpectrumBatch directly references the memory-mapped
+    arrays of the spectrum store.
+
+    Parameters
+    ----------
+    source : str
+        The spectrum store file name.
+    scan_nrs : Sequence[int]
+        Only read spectra with the given scan numbers. If `None`, no filtering
+        on scan number is performed.
+    part : Tuple[int, int]
+        Only read part `i` of `k` consecutive parts with (roughly) equal
+        numbers of the requested spectra, specified as a tuple `(i, k)`. If
+        `None`, all requested spectra are read.
+    spectrum_filter : SpectrumFilter
+        Only read spectra that satisfy the filter's criteria. If `None`, no
+        additional filtering is performed.
+
+    Returns
+    -------
+    SpectrumBatch
+        The requested spectra in the given file.
+    """
+    arrays = read_arrays(source)
+    batch = SpectrumBatch(
+        arrays['identifier'], arrays['precursor_mz'],
+        arrays['precursor_charge'], arrays['mz'], arrays['intensity'],
+        arrays['offsets'], arrays['retention_time'], arrays['scan'])
+    mask = None
+    if scan_nrs is not None:
+        mask = np.isin(arrays['scan'], np.asarray(list(scan_nrs), np.int64))
+    if spectrum_filter is not None:
+        filter_mask = spectrum_filter.get_mask(
+            arrays['scan'], arrays['precursor_mz'],
+            arrays['precursor_charge'], np.diff(arrays['offsets']))
+        mask = filter_mask if mask is None else mask & filter_mask
+    if mask is not None:
+        batch = batch[mask]
+    if part is not None:
+        batch = batch[np.array_split(np.arange(len(batch)), part[1])[part[0]]]
+    return batch
+
+
+def get_spectra(source: str, scan_nrs: Sequence[int] = None,
+                part: Tuple[int, int] = None,
+                spectrum_filter: SpectrumFilter = None)\
+        -> Iterator[MsmsSpectrum]:
+    """
+    Get the MS/MS spectra from the given spectrum store, optionally filtering
+    by scan number.
+
+    Parameters
+    ----------
+    source : str
+        The spectrum store file name.
+    scan_nrs : Sequence[int]
+        Only read spectra with the given scan numbers. If `None`, no filtering
+        on scan number is performed.
+    part : Tuple[int, int]
+        Only read part `i` of `k` consecutive parts with (roughly) equal
+        numbers of the requested spectra, specified as a tuple `(i, k)`. If
+        `None`, all requested spectra are read.
+    spectrum_filter : SpectrumFilter
+        Only read spectra that satisfy the filter's criteria. If `None`, no
+        additional filtering is performed.
+
+    Returns
+    -------
+    Iterator[MsmsSpectrum]
+        An iterator over the requested spectra in the given file.
+    """
+    return get_spectrum_batch(source, scan_nrs, part,
+                              spectrum_filter).to_spectra()
+
+
+if __name__ == '__main__':
+    import sys
+    logging.basicConfig(level=logging.DEBUG)
+    for peak_filename in sys.argv[1:]:
+        convert(peak_filename)
@@ -1,10 +1,13 @@
 import logging
 import math
-from typing import List, Tuple
+from typing import List, Tuple, Union
 
 import numpy as np
+import scipy.sparse as ss
 from keras.utils import Sequence
 
+from gleams.feature import feature, shard
+
 
 logger = logging.getLogger('gleams')
 
@@ -13,7 +16,7 @@ class PairSequence(Sequence):
 
     def __init__(self, filename_feat: str,
                  filename_pairs_pos: str, filename_pairs_neg: str,
-                 batch_size: int, feature_split: Tuple[int, int],
+                 batch_size: int, num_precursor_features: int,
                  max_num_pairs: int = None, shuffle: bool = True):
         """
         Initialize the PairSequence generator.
@@ -25,7 +28,9 @@ class PairSequence(Sequence):
         Parameters
         ----------
         filename_feat : str
-            A NumPy binary file containing the encoded spectrum features.
+            A NumPy binary file or sharded feature manifest containing the
+            encoded spectrum features, with the corresponding sparse fragment
+            features stored alongside (see `feature.load_features`).
         filename_pairs_pos : str
             The file name of the positive pair indexes. Comma-separated file
             with feature/spectrum indexes corresponding to the metadata file.
@@ -35,17 +40,16 @@ class PairSequence(Sequence):
         batch_size : int
             The (maximum) size of each batch. Batch sizes can sometimes be
             smaller than this maximum size in case of missing feature vectors.
-        feature_split : Tuple[int, int]
-            Indexes on which the feature vectors are split into individual
-            inputs to the separate parts of the neural network (precursor
-            features, fragment features, reference spectra features).
+        num_precursor_features : int
+            The number of precursor features, which precede the reference
+            spectra features in the dense feature vectors.
         max_num_pairs : int
             Maximum number of pairs to include.
         shuffle : bool
             Whether to shuffle the order of the batches at the beginning of
             each epoch.
         """
-        self.features = np.load(filename_feat, mmap_mode='r')
+        self.features, self.fragments = feature.load_features(filename_feat)
 
         pairs_pos = np.load(filename_pairs_pos, mmap_mode='r')
         pairs_neg = np.load(filename_pairs_neg, mmap_mode='r')
@@ -60,7 +64,7 @@ class PairSequence(Sequence):
         self.pairs_neg = pairs_neg[idx_neg]
 
         self.batch_size = batch_size
-        self.feature_split = feature_split
+        self.num_precursor_features = num_precursor_features
         self.shuffle = shuffle
         self.epoch_count = 0
 
@@ -97,14 +101,16 @@ class PairSequence(Sequence):
                                          (idx + 1) * self.batch_size // 2]
         batch_pairs = np.vstack((batch_pairs_pos, batch_pairs_neg))
 
-        batch_x1 = self.features[batch_pairs[:, 0]]
-        batch_x2 = self.features[batch_pairs[:, 1]]
+        batch_x1 = _split_features_to_input(
+            self.features[batch_pairs[:, 0]],
+            self.fragments[batch_pairs[:, 0]], self.num_precursor_features)
+        batch_x2 = _split_features_to_input(
+            self.features[batch_pairs[:, 1]],
+            self.fragments[batch_pairs[:, 1]], self.num_precursor_features)
         batch_y = np.hstack((np.ones(len(batch_pairs_pos), np.uint8),
                              np.zeros(len(batch_pairs_neg), np.uint8)))
 
-        return ([*_split_features_to_input(batch_x1, *self.feature_split),
-                 *_split_features_to_input(batch_x2, *self.feature_split)],
-                batch_y)
+        return [*batch_x1, *batch_x2], batch_y
 
     def on_epoch_end(self):
         self.epoch_count += 1
@@ -117,26 +123,29 @@ class PairSequence(Sequence):
 
 class EncodingsSequence(Sequence):
 
-    def __init__(self, encodings: List[np.ndarray], batch_size: int,
-                 feature_split: Tuple[int, int]):
+    def __init__(self, encodings: Union[np.ndarray, shard.ShardedArray],
+                 fragments: Union[ss.csr_matrix, shard.ShardedArray],
+                 batch_size: int, num_precursor_features: int):
         """
         Initialize the EncodingsSequence generator.
 
         Parameters
         ----------
-        encodings : List[np.ndarray]
-            A list of encodings as a single NumPy array.
+        encodings : Union[np.ndarray, shard.ShardedArray]
+            The dense encodings (precursor and reference spectra features).
+        fragments : Union[ss.csr_matrix, shard.ShardedArray]
+            The sparse fragment encodings.
         batch_size : int
             The (maximum) size of each batch. Batch sizes can sometimes be
             smaller than this maximum size in case of missing feature vectors.
-        feature_split : Tuple[int, int]
-            Indexes on which the feature vectors are split into individual
-            inputs to the separate parts of the neural network (precursor
-            features, fragment features, reference spectra features).
+        num_precursor_features : int
+            The number of precursor features, which precede the reference
+            spectra features in the dense feature vectors.
         """
         self.encodings = encodings
+        self.fragments = fragments
         self.batch_size = batch_size
-        self.feature_split = feature_split
+        self.num_precursor_features = num_precursor_features
 
     def __len__(self) -> int:
         """
@@ -165,31 +174,35 @@ class EncodingsSequence(Sequence):
             A batch of encodings consisting of three NumPy arrays for the three
             input elements of the neural network.
         """
+        batch_slice = slice(idx * self.batch_size, (idx + 1) * self.batch_size)
         return list(_split_features_to_input(
-            self.encodings[idx * self.batch_size:(idx + 1) * self.batch_size],
-            *self.feature_split))
+            self.encodings[batch_slice], self.fragments[batch_slice],
+            self.num_precursor_features))
 
 
-def _split_features_to_input(x: List[np.ndarray], idx1: int, idx2: int)\
+def _split_features_to_input(x: np.ndarray, x_fragment: ss.csr_matrix,
+                             num_precursor_features: int)\
         -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
-    Convert individual features to arrays corresponding to the three inputs for
-    the neural network.
+    Convert features to arrays corresponding to the three inputs for the
+    neural network.
 
     Parameters
     ----------
-    x : List[np.ndarray]
-        List of feature arrays.
-    idx1 : int
-        First index to split the feature arrays.
-    idx2 : int
-        Second index to split the feature arrays.
+    x : np.ndarray
+        Dense feature arrays consisting of precursor features followed by
+        reference spectra features.
+    x_fragment : ss.csr_matrix
+        Sparse fragment features, which are converted to dense arrays.
+    num_precursor_features : int
+        The number of precursor features.
 
     Returns
     -------
     Tuple[np.ndarray, np.ndarray, np.ndarray]
-        The features are split in three arrays according to the two split
-        indexes.
+        The precursor features, fragment features, and reference spectra
+        features.
     """
     x = np.asarray(x)
-    return x[:, :idx1], x[:, idx1:idx2], x[:, idx2:]
+    return (x[:, :num_precursor_features], x_fragment.toarray(),
+            x[:, num_precursor_features:])
@@ -0,0 +1,565 @@
+import concurrent.futures
+import logging
+import os
+from typing import Dict, Optional, Tuple, Union
+
+import h5py
+import numba as nb
+import numpy as np
+import scipy.sparse as ss
+import threadpoolctl
+
+from gleams import config
+from gleams.feature import shard
+
+
+logger = logging.getLogger('gleams')
+
+
+# Layers of the embedder model (see `embedder.Embedder._build_embedder_model`).
+_precursor_layers = ('precursor_dense_32', 'precursor_dense_5')
+# Number of convolutional layers in each fragment block. Each block ends with
+# a max pooling layer with pool size 1 and stride 2.
+_fragment_blocks = (2, 2, 3, 3, 3)
+_ref_spectra_layers = ('ref_spectra_dense_750', 'ref_spectra_output')
+_output_layer = 'output'
+
+# SELU activation constants (Klambauer et al. 2017).
+_selu_alpha = 1.6732632423543772848170429916717
+_selu_scale = 1.0507009873554804934193349852946
+
+
+class NumpyEmbedder:
+    """
+    A spectrum embedder that runs a trained GLEAMS embedder model on the CPU
+    using NumPy and Numba, without requiring TensorFlow or Keras.
+
+    The weights are read from the model file written by `Embedder.save`, and
+    the output is equivalent to `Embedder.embed` up to floating-point
+    rounding.
+    """
+
+    def __init__(self, num_precursor_features: int, num_fragment_features: int,
+                 num_ref_spectra_features: int,
+                 filename: str = 'gleams.hdf5',
+                 num_threads: Optional[int] = None):
+        """
+        Instantiate the NumpyEmbedder based on the given number of input
+        features.
+
+        Parameters
+        ----------
+        num_precursor_features : int
+            The number of input precursor features.
+        num_fragment_features : int
+            The number of input fragment features.
+        num_ref_spectra_features : int
+            The number of input reference spectra features.
+        filename : str
+            Filename of the trained Keras model.
+        num_threads : Optional[int]
+            The number of threads to embed spectra, or None to use the
+            configured number of threads (see `config.inference_threads`) or
+            all CPUs.
+        """
+        self.num_precursor_features = num_precursor_features
+        self.num_fragment_features = num_fragment_features
+        self.num_ref_spectra_features = num_ref_spectra_features
+        self.filename = filename
+        self.num_threads = (num_threads or config.inference_threads or
+                            os.cpu_count())
+
+        self.weights = None
+        self.backgrounds = None
+
+    def load(self) -> None:
+        """
+        Read the stored weights of the embedder model.
+
+        Raises
+        ------
+        ValueError
+            If the stored weights don't match the embedder model with the
+            given number of input features.
+        """
+        weights = _read_weights(self.filename)
+        layers = [*_precursor_layers,
+                  *[_get_fragment_layer(block_i, conv_i)
+                    for block_i, num_convs in enumerate(_fragment_blocks, 1)
+                    for conv_i in range(1, num_convs + 1)],
+                  *_ref_spectra_layers, _output_layer]
+        missing = [layer for layer in layers if layer not in weights]
+        if len(missing) > 0:
+            raise ValueError(f'No weights for layers {", ".join(missing)} in '
+                             f'model file {self.filename}')
+        self.weights = {layer: weights[layer] for layer in layers}
+        fragment_length, fragment_channels = self.num_fragment_features, 1
+        for block_i, num_convs in enumerate(_fragment_blocks, 1):
+            for conv_i in range(1, num_convs + 1):
+                kernel, _ = self.weights[_get_fragment_layer(block_i, conv_i)]
+                fragment_length -= kernel.shape[0] - 1
+                fragment_channels = kernel.shape[2]
+            fragment_length = (fragment_length - 1) // 2 + 1
+        num_inputs = {
+            _precursor_layers[0]: self.num_precursor_features,
+            _ref_spectra_layers[0]: self.num_ref_spectra_features,
+            _output_layer: (self.weights[_precursor_layers[-1]][0].shape[1] +
+                            fragment_length * fragment_channels +
+                            self.weights[_ref_spectra_layers[-1]][0].shape[1]),
+            _get_fragment_layer(1, 1): 1}
+        for layer, num_input in num_inputs.items():
+            kernel_shape = self.weights[layer][0].shape
+            if kernel_shape[-2] != num_input:
+                raise ValueError(f'Layer {layer} in model file {self.filename}'
+                                 f' has kernel shape {kernel_shape}, '
+                                 f'incompatible with {num_input} inputs')
+        # Output of each fragment convolutional layer at positions where its
+        # input window is identical to that of an all-zero fragment input.
+        self.backgrounds, background = {}, np.zeros(1, np.float32)
+        for block_i, num_convs in enumerate(_fragment_blocks, 1):
+            for conv_i in range(1, num_convs + 1):
+                layer = _get_fragment_layer(block_i, conv_i)
+                kernel, bias = self.weights[layer]
+                background = _dense_selu(
+                    background.reshape(1, -1), kernel.sum(axis=0), bias)[0]
+                self.backgrounds[layer] = background
+        logger.debug('Loaded the embedder model weights from file %s',
+                     self.filename)
+
+    def embed(self, encodings: Union[np.ndarray, shard.ShardedArray],
+              fragments: Union[ss.csr_matrix, shard.CsrShard,
+                               shard.ShardedArray]) -> np.ndarray:
+        """
+        Transform samples using the embedder model.
+
+        Batches of samples (see `config.inference_batch_size`) are embedded
+        simultaneously by multiple threads, which each use a single BLAS
+        thread to avoid oversubscribing the CPUs. Only the samples of the
+        batches that are being embedded are read.
+
+        The sparse fragment encodings are not converted to dense arrays.
+        Instead, the first fragment convolutional layers are only evaluated
+        at positions where their input differs from that of an all-zero
+        fragment input (see `config.inference_sparse_max_fraction`).
+
+        Parameters
+        ----------
+        encodings : Union[np.ndarray, shard.ShardedArray]
+            The dense encodings (precursor and reference spectra features).
+        fragments : Union[ss.csr_matrix, shard.CsrShard, shard.ShardedArray]
+            The sparse fragment encodings.
+
+        Returns
+        -------
+        np.ndarray
+            The embeddings of the given samples.
+        """
+        if self.weights is None:
+            raise ValueError("The embedder model hasn't been loaded yet")
+        batch_starts = range(0, len(encodings), config.inference_batch_size)
+        with threadpoolctl.threadpool_limits(1, 'blas'), \
+                concurrent.futures.ThreadPoolExecutor(
+                    self.num_threads) as executor:
+            embeddings = list(executor.map(
+                lambda batch_start: self._embed_batch(
+                    encodings, fragments,
+                    slice(batch_start,
+                          batch_start + config.inference_batch_size)),
+                batch_starts))
+        if len(embeddings) == 0:
+            return np.zeros(
+                (0, self.weights[_output_layer][0].shape[1]), np.float32)
+        return np.vstack(embeddings)
+
+    def _embed_batch(self, encodings: Union[np.ndarray, shard.ShardedArray],
+                     fragments: Union[ss.csr_matrix, shard.CsrShard,
+                                      shard.ShardedArray],
+                     batch_slice: slice) -> np.ndarray:
+        """
+        Embed a batch of samples.
+
+        Parameters
+        ----------
+        encodings : Union[np.ndarray, shard.ShardedArray]
+            The dense encodings (precursor and reference spectra features).
+        fragments : Union[ss.csr_matrix, shard.CsrShard, shard.ShardedArray]
+            The sparse fragment encodings.
+        batch_slice : slice
+            The samples in the batch.
+
+        Returns
+        -------
+        np.ndarray
+            The embeddings of the samples in the batch.
+        """
+        x = np.asarray(encodings[batch_slice], np.float32)
+        precursor = x[:, :self.num_precursor_features]
+        for layer in _precursor_layers:
+            precursor = _dense_selu(precursor, *self.weights[layer])
+        fragment = fragments[batch_slice]
+        # Positions of the fragment layer outputs that differ from the layer's
+        # background output, or None if the layer outputs are dense.
+        mask = None
+        for block_i, num_convs in enumerate(_fragment_blocks, 1):
+            for conv_i in range(1, num_convs + 1):
+                layer = _get_fragment_layer(block_i, conv_i)
+                # The max pooling layer after the final convolutional layer of
+                # each block only retains every second position, so the
+                # convolution is only evaluated at those positions.
+                stride = 2 if conv_i == num_convs else 1
+                if ss.issparse(fragment):
+                    if config.inference_sparse_max_fraction > 0:
+                        fragment, mask = _sparse_conv1d_selu(
+                            fragment, *self.weights[layer],
+                            self.backgrounds[layer], stride)
+                        continue
+                    fragment = fragment.toarray().astype(np.float32,
+                                                         copy=False)
+                    fragment = fragment.reshape(len(fragment), -1, 1)
+                if mask is not None:
+                    fragment, mask = _masked_conv1d_selu(
+                        fragment, mask, *self.weights[layer],
+                        self.backgrounds[layer], stride,
+                        config.inference_sparse_max_fraction)
+                else:
+                    fragment = _conv1d_selu(fragment, *self.weights[layer],
+                                            stride)
+        fragment = fragment.reshape(len(fragment), -1)
+        ref_spectra = x[:, self.num_precursor_features:]
+        for layer in _ref_spectra_layers:
+            ref_spectra = _dense_selu(ref_spectra, *self.weights[layer])
+        return _dense_selu(np.hstack([precursor, fragment, ref_spectra]),
+                           *self.weights[_output_layer])
+
+
+def _get_fragment_layer(block_i: int, conv_i: int) -> str:
+    """
+    Get the name of a convolutional layer in the fragment blocks.
+
+    Parameters
+    ----------
+    block_i : int
+        The fragment block (one-based).
+    conv_i : int
+        The convolutional layer in the fragment block (one-based).
+
+    Returns
+    -------
+    str
+        The layer name.
+    """
+    return f'fragment_block_{block_i}_conv_{conv_i}'
+
+
+def _read_weights(filename: str) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """
+    Read the weights of all layers from a Keras HDF5 model or weights file.
+
+    Parameters
+    ----------
+    filename : str
+        The model file name.
+
+    Returns
+    -------
+    Dict[str, Tuple[np.ndarray, np.ndarray]]
+        A dictionary of the layer names and their kernel and bias.
+    """
+    weights = {}
+    with h5py.File(filename, 'r') as f_in:
+        # Full models store their weights in a separate group.
+        if 'layer_names' not in f_in.attrs and 'model_weights' in f_in:
+            f_in = f_in['model_weights']
+        for layer in f_in.attrs['layer_names']:
+            layer = layer.decode('utf8') if isinstance(layer, bytes) else layer
+            group = f_in[layer]
+            weight_names = [name.decode('utf8') if isinstance(name, bytes)
+                            else name for name in group.attrs['weight_names']]
+            if len(weight_names) == 2:
+                weights[layer] = (np.asarray(group[weight_names[0]],
+                                             np.float32),
+                                  np.asarray(group[weight_names[1]],
+                                             np.float32))
+    return weights
+
+
+def _dense_selu(x: np.ndarray, kernel: np.ndarray, bias: np.ndarray)\
+        -> np.ndarray:
+    """
+    Evaluate a fully-connected layer with SELU activation.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        The input array with shape (batch size, input dimension).
+    kernel : np.ndarray
+        The kernel with shape (input dimension, output dimension).
+    bias : np.ndarray
+        The bias with shape (output dimension,).
+
+    Returns
+    -------
+    np.ndarray
+        The output array with shape (batch size, output dimension).
+    """
+    out = np.dot(x, kernel)
+    _bias_selu(out, bias)
+    return out
+
+
+def _conv1d_selu(x: np.ndarray, kernel: np.ndarray, bias: np.ndarray,
+                 stride: int) -> np.ndarray:
+    """
+    Evaluate a one-dimensional convolutional layer without padding and with
+    SELU activation.
+
+    The convolution is computed as a single matrix multiplication of the
+    input windows at all output positions with the kernel.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        The input array with shape (batch size, length, input channels).
+    kernel : np.ndarray
+        The kernel with shape (kernel size, input channels, filters).
+    bias : np.ndarray
+        The bias with shape (filters,).
+    stride : int
+        The distance between consecutive output positions.
+
+    Returns
+    -------
+    np.ndarray
+        The output array with shape (batch size, output length, filters).
+    """
+    kernel_size, channels, filters = kernel.shape
+    windows = _get_windows(x, kernel_size, stride)
+    batch_size, out_length = windows.shape[:2]
+    out = np.dot(windows.reshape(batch_size * out_length,
+                                 kernel_size * channels),
+                 kernel.reshape(kernel_size * channels, filters))
+    _bias_selu(out, bias)
+    return out.reshape(batch_size, out_length, filters)
+
+
+def _masked_conv1d_selu(x: np.ndarray, mask: np.ndarray, kernel: np.ndarray,
+                        bias: np.ndarray, background: np.ndarray,
+                        stride: int, max_fraction: float)\
+        -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Evaluate a one-dimensional convolutional layer without padding and with
+    SELU activation (see `_conv1d_selu`) on an input that is identical to the
+    background input of the layer at all positions that are not masked.
+
+    Output positions whose input window doesn't contain any masked positions
+    are equal to the layer's background output, so the convolution is only
+    evaluated at the remaining positions. If the fraction of remaining
+    positions exceeds the given maximum fraction, the convolution is
+    evaluated at all positions instead.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        The input array with shape (batch size, length, input channels).
+    mask : np.ndarray
+        Boolean array with shape (batch size, length) indicating the input
+        positions that differ from the background input.
+    kernel : np.ndarray
+        The kernel with shape (kernel size, input channels, filters).
+    bias : np.ndarray
+        The bias with shape (filters,).
+    background : np.ndarray
+        The background output with shape (filters,).
+    stride : int
+        The distance between consecutive output positions.
+    max_fraction : float
+        The maximum fraction of output positions at which the convolution is
+        evaluated selectively.
+
+    Returns
+    -------
+    Tuple[np.ndarray, Optional[np.ndarray]]
+        The output array with shape (batch size, output length, filters), and
+        a boolean array with shape (batch size, output length) indicating the
+        output positions that differ from the background output, or None if
+        the convolution was evaluated at all positions.
+    """
+    kernel_size, channels, filters = kernel.shape
+    mask = _get_windows(mask[:, :, np.newaxis], kernel_size, stride)\
+        .any(axis=(2, 3))
+    batch_i, position_i = np.nonzero(mask)
+    if len(batch_i) > max_fraction * mask.size:
+        return _conv1d_selu(x, kernel, bias, stride), None
+    out = np.empty((*mask.shape, filters), np.float32)
+    out[:] = background
+    out[batch_i, position_i] = _dense_selu(
+        _get_windows(x, kernel_size, stride)[batch_i, position_i]
+        .reshape(len(batch_i), kernel_size * channels),
+        kernel.reshape(kernel_size * channels, filters), bias)
+    return out, mask
+
+
+def _sparse_conv1d_selu(x: ss.csr_matrix, kernel: np.ndarray,
+                        bias: np.ndarray, background: np.ndarray,
+                        stride: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Evaluate a one-dimensional convolutional layer with a single input
+    channel without padding and with SELU activation (see `_conv1d_selu`) on
+    a sparse input.
+
+    The convolution is only evaluated at output positions whose input window
+    contains non-zero input values, by scattering the kernel responses of the
+    non-zero input values. All other output positions are equal to the
+    layer's background output (i.e. its output for an all-zero input).
+
+    Parameters
+    ----------
+    x : ss.csr_matrix
+        The input matrix with shape (batch size, length).
+    kernel : np.ndarray
+        The kernel with shape (kernel size, 1, filters).
+    bias : np.ndarray
+        The bias with shape (filters,).
+    background : np.ndarray
+        The background output with shape (filters,).
+    stride : int
+        The distance between consecutive output positions.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        The output array with shape (batch size, output length, filters), and
+        a boolean array with shape (batch size, output length) indicating the
+        output positions that differ from the background output.
+    """
+    out_length = (x.shape[1] - kernel.shape[0]) // stride + 1
+    out = np.empty((x.shape[0], out_length, kernel.shape[2]), np.float32)
+    mask = np.zeros((x.shape[0], out_length), np.bool_)
+    _sparse_conv1d_selu_nb(
+        x.indptr, x.indices, x.data.astype(np.float32, copy=False),
+        kernel[:, 0, :], bias, background, stride, out, mask)
+    return out, mask
+
+
+@nb.njit(nogil=True)
+def _sparse_conv1d_selu_nb(indptr: np.ndarray, indices: np.ndarray,
+                           data: np.ndarray, kernel: np.ndarray,
+                           bias: np.ndarray, background: np.ndarray,
+                           stride: int, out: np.ndarray,
+                           mask: np.ndarray) -> None:
+    """
+    JIT helper function for `_sparse_conv1d_selu`.
+
+    Parameters
+    ----------
+    indptr : np.ndarray
+        The CSR row pointers of the input matrix.
+    indices : np.ndarray
+        The CSR column indices of the input matrix.
+    data : np.ndarray
+        The CSR values of the input matrix.
+    kernel : np.ndarray
+        The kernel with shape (kernel size, filters).
+    bias : np.ndarray
+        The bias with shape (filters,).
+    background : np.ndarray
+        The background output with shape (filters,).
+    stride : int
+        The distance between consecutive output positions.
+    out : np.ndarray
+        The output array with shape (batch size, output length, filters).
+    mask : np.ndarray
+        All-False boolean array with shape (batch size, output length), which
+        is set to True for the output positions that differ from the
+        background output.
+    """
+    for i in range(len(indptr) - 1):
+        # Scatter the kernel responses of the non-zero input values.
+        for j in range(indptr[i], indptr[i + 1]):
+            for k in range(kernel.shape[0]):
+                position = indices[j] - k
+                if position < 0 or position % stride != 0:
+                    continue
+                position //= stride
+                if position >= out.shape[1]:
+                    continue
+                if not mask[i, position]:
+                    mask[i, position] = True
+                    out[i, position] = bias
+                for f in range(kernel.shape[1]):
+                    out[i, position, f] += data[j] * kernel[k, f]
+        for position in range(out.shape[1]):
+            if mask[i, position]:
+                for f in range(out.shape[2]):
+                    out[i, position, f] = _selu(out[i, position, f])
+            else:
+                out[i, position] = background
+
+
+def _get_windows(x: np.ndarray, kernel_size: int, stride: int) -> np.ndarray:
+    """
+    Get a read-only view of the input windows of a one-dimensional
+    convolution without padding.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        The input array with shape (batch size, length, input channels).
+    kernel_size : int
+        The length of the windows.
+    stride : int
+        The distance between consecutive windows.
+
+    Returns
+    -------
+    np.ndarray
+        The windows with shape (batch size, output length, kernel size, input
+        channels).
+    """
+    batch_size, length, channels = x.shape
+    x = np.ascontiguousarray(x)
+    return np.lib.stride_tricks.as_strided(
+        x, (batch_size, (length - kernel_size) // stride + 1, kernel_size,
+            channels),
+        (x.strides[0], stride * x.strides[1], x.strides[1], x.strides[2]),
+        writeable=False)
+
+
+@nb.njit(nogil=True)
+def _bias_selu(x: np.ndarray, bias: np.ndarray) -> None:
+    """
+    Add the bias and apply the SELU activation function in-place.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        The layer output with shape (batch size, output dimension).
+    bias : np.ndarray
+        The bias with shape (output dimension,).
+    """
+    for i in range(x.shape[0]):
+        for j in range(x.shape[1]):
+            x[i, j] = _selu(x[i, j] + bias[j])
+
+
+@nb.njit(nogil=True)
+def _selu(x: np.float32) -> np.float32:
+    """
+    Apply the SELU activation function.
+
+    The activation is computed in single precision without branches, which
+    allows loops over it to be vectorized.
+
+    Parameters
+    ----------
+    x : np.float32
+        The input value.
+
+    Returns
+    -------
+    np.float32
+        The activated value.
+    """
+    negative = (np.float32(_selu_scale * _selu_alpha) *
+                (np.exp(min(x, np.float32(0))) - np.float32(1)))
+    return np.float32(_selu_scale) * x if x > np.float32(0) else negative
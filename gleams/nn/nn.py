@@ -1,27 +1,24 @@
+import collections
 import logging
+import multiprocessing
 import os
-from typing import List
+from typing import Dict, List, Optional, Tuple, Union
 
-import joblib
 import numpy as np
 import pandas as pd
 import pyarrow as pa
 import pyarrow.parquet as pq
-from keras import backend as K
+import scipy.sparse as ss
 
 from gleams import config
-from gleams.feature import encoder, feature
-from gleams.nn import data_generator, embedder
+from gleams.feature import cache, encoder, feature, shard
+from gleams.ms_io import ms_io
+from gleams.nn import inference
 
 
 logger = logging.getLogger('gleams')
 
 
-def _get_feature_split():
-    return (config.num_precursor_features,
-            config.num_precursor_features + config.num_fragment_features)
-
-
 def train_nn(filename_model: str, filename_feat_train: str,
              filename_train_pairs_pos: str, filename_train_pairs_neg: str,
              filename_feat_val: str, filename_val_pairs_pos: str,
@@ -34,18 +31,24 @@ def train_nn(filename_model: str, filename_feat_train: str,
     filename_model : str
         The file name where the model will be saved.
     filename_feat_train : str
-        The file name of the training NumPy binary feature file.
+        The file name of the training NumPy binary feature file or sharded
+        feature manifest.
     filename_train_pairs_pos : str
         The file name of the positive training pair indexes.
     filename_train_pairs_neg : str
         The file name of the negative training pair indexes.
     filename_feat_val : str
-        The file name of the validation NumPy binary feature file.
+        The file name of the validation NumPy binary feature file or sharded
+        feature manifest.
     filename_val_pairs_pos : str
         The file name of the positive validation pair indexes.
     filename_val_pairs_neg : str
         The file name of the negative validation pair indexes.
     """
+    # Keras is only imported when it's used, so that spectra can be embedded
+    # without TensorFlow (see `embed`).
+    from gleams.nn import data_generator, embedder
+
     # Build the embedder model.
     model_dir = os.path.dirname(filename_model)
     if not os.path.isdir(model_dir):
@@ -71,11 +74,12 @@ def train_nn(filename_model: str, filename_feat_train: str,
                     num_gpus)
     train_generator = data_generator.PairSequence(
         filename_feat_train, filename_train_pairs_pos,
-        filename_train_pairs_neg, batch_size, _get_feature_split(),
+        filename_train_pairs_neg, batch_size, config.num_precursor_features,
         config.max_num_pairs_train)
     val_generator = data_generator.PairSequence(
         filename_feat_val, filename_val_pairs_pos, filename_val_pairs_neg,
-        batch_size, _get_feature_split(), config.max_num_pairs_val, False)
+        batch_size, config.num_precursor_features, config.max_num_pairs_val,
+        False)
     emb.train(train_generator, steps_per_epoch, config.num_epochs,
               val_generator)
 
@@ -89,6 +93,29 @@ def embed(metadata_filename: str, model_filename: str) -> None:
     """
     Embed all spectra in the peak directory using the given GLEAMS model.
 
+    Statistics about reading and converting the peak files are stored for
+    each dataset next to the embeddings (see `feature.get_stats_filename`).
+    The features of peak files that were converted before with the same
+    preprocessing and encoder settings are read from the feature cache (see
+    `feature.map_peaks_to_features`). Additionally, if features for a dataset
+    were already generated for training (see
+    `feature.convert_peaks_to_features`) with the same encoder from peak files
+    that didn't change since, those features are read directly from the
+    memory-mapped feature files and only the remaining spectra in the peak
+    files are converted to features.
+
+    Converting the peak files and embedding their spectra are overlapped: a
+    single GLEAMS model embeds the features of each peak file as soon as it
+    has been converted, while the worker processes continue converting the
+    remaining peak files (see `feature.map_peaks_to_features`).
+
+    Spectra are embedded using Keras on the available GPUs, or on the CPU
+    using NumPy without requiring TensorFlow (see `config.inference_engine`
+    and `inference.NumpyEmbedder`). When spectra are embedded on the CPU, the
+    CPUs are divided between the feature conversion worker processes and the
+    embedding threads (see `config.inference_feature_processes` and
+    `config.inference_threads`).
+
     Parameters
     ----------
     metadata_filename : str
@@ -105,103 +132,552 @@ def embed(metadata_filename: str, model_filename: str) -> None:
     metadata = pd.read_parquet(
         metadata_filename, columns=['dataset', 'filename']).drop_duplicates()
 
-    enc = encoder.MultipleEncoder([
-        encoder.PrecursorEncoder(
-            config.num_bits_precursor_mz, config.precursor_mz_min,
-            config.precursor_mz_max, config.num_bits_precursor_mass,
-            config.precursor_mass_min, config.precursor_mass_max,
-            config.precursor_charge_max),
-        encoder.FragmentEncoder(
-            config.fragment_mz_min, config.fragment_mz_max, config.bin_size),
-        encoder.ReferenceSpectraEncoder(
-            config.ref_spectra_filename, config.fragment_mz_min,
-            config.fragment_mz_max, config.fragment_mz_tol,
-            config.num_ref_spectra)
-    ])
+    enc = feature.get_encoder()
 
-    num_gpus = embedder._get_num_gpus()
-    if num_gpus == 0:
-        raise RuntimeError('No GPU found')
-    batch_size = config.batch_size * num_gpus
+    num_gpus = _get_num_gpus()
+    num_processes, num_threads = _get_num_workers(num_gpus)
+    if num_gpus > 0:
+        logger.info('Embed spectra using Keras on %d GPUs', num_gpus)
+    else:
+        logger.info('Embed spectra using NumPy on %d CPU threads, with %d '
+                    'feature conversion processes', num_threads,
+                    num_processes)
+    # The feature conversion worker processes are forked, which isn't safe
+    # after TensorFlow has initialized the GPUs, so they're started before
+    # TensorFlow is used in this process.
+    feature.get_worker_pool(enc, num_processes)
 
     logger.info('Embed all peak files for metadata file %s', metadata_filename)
-    dataset_total = metadata['dataset'].nunique()
-    for dataset_i, (dataset, peak_filenames) in enumerate(
-            metadata.groupby('dataset', sort=False)['filename'], 1):
+    # Convert the peak files of all datasets that haven't been embedded yet
+    # in a single run.
+    filenames, filenames_embedding, reused_features = [], {}, {}
+    for dataset, peak_filenames in metadata.groupby(
+            'dataset', sort=False)['filename']:
         filename_scans = os.path.join(embed_dir, f'{dataset}.parquet')
         filename_embedding = os.path.join(embed_dir, f'{dataset}.npy')
         if (os.path.isfile(filename_scans) and
                 os.path.isfile(filename_embedding)):
             continue
-        logger.info('Process dataset %s [%3d/%3d] (%d files)', dataset,
-                    dataset_i, dataset_total, len(peak_filenames))
-        peak_filenames_chunked = np.array_split(
-            peak_filenames, max(1, len(peak_filenames) // 1000))
-        scans = []
-        for i, chunk_filenames in enumerate(peak_filenames_chunked):
-            encodings = []
-            for filename, file_scans, file_encodings in joblib.Parallel(
-                    n_jobs=-1)(
-                        joblib.delayed(feature._peaks_to_features)
-                        (dataset, filename, None, enc)
-                        for filename in chunk_filenames):
-                if file_scans is not None and len(file_scans) > 0:
-                    file_scans['dataset'] = dataset
-                    file_scans['filename'] = filename
-                    scans.append(file_scans)
-                    encodings.extend(file_encodings)
-            if len(encodings) > 0:
-                _embed_and_save(
-                    encodings, batch_size, model_filename,
-                    filename_embedding.replace('.npy', f'_{i}.npy'))
-        if len(scans) > 0:
-            scans = pd.concat(scans, ignore_index=True, sort=False, copy=False)
-            scans[['dataset', 'filename', 'scan', 'charge', 'mz']].to_parquet(
-                filename_scans, index=False)
-            # Merge all temporary embeddings into a single file.
-            embeddings = [np.load(filename_embedding.replace(
-                              '.npy', f'_{i}.npy'), mmap_mode='r')
-                          for i in range(len(peak_filenames_chunked))]
-            np.save(filename_embedding, np.vstack(embeddings))
-            for i in range(len(peak_filenames_chunked)):
-                os.remove(filename_embedding.replace('.npy', f'_{i}.npy'))
-
-
-def _embed_and_save(encodings: List[np.ndarray], batch_size: int,
-                    model_filename: str, filename: str) -> None:
-    """
-    Embed the given encodings and save them as a NumPy file.
+        filename_encodings = filename_embedding.replace(
+            '.npy', '_encodings.npy')
+        filenames_embedding[filename_encodings] = (
+            dataset, filename_scans, filename_embedding)
+        feature_rows = _get_feature_rows(dataset, enc)
+        reused_features[filename_encodings] = dataset, []
+        for filename in peak_filenames:
+            metadata_file, reused_scans = None, None
+            if feature_rows is not None:
+                metadata_file, reused_scans = _get_reused_features(
+                    dataset, filename, feature_rows)
+            filenames.append((dataset, filename, metadata_file,
+                              filename_encodings))
+            if reused_scans is not None:
+                reused_features[filename_encodings][1].append(reused_scans)
+    # The converted spectra are embedded by a single model as soon as their
+    # peak file (part) has been converted, while the remaining peak files are
+    # still being processed. The embeddings of each dataset are stored as soon
+    # as all of its peak files have been converted.
+    embedding_stream = _EmbeddingStream(
+        model_filename, enc, num_gpus, num_threads, reused_features)
+    try:
+        for dataset_i, (filename_encodings, file_scans, file_stats) in \
+                enumerate(feature.map_peaks_to_features(
+                    filenames, enc, embedding_stream.embed_part, False,
+                    num_processes), 1):
+            dataset, filename_scans, filename_embedding = \
+                filenames_embedding[filename_encodings]
+            logger.info('Embedded dataset %s [%3d/%3d]', dataset, dataset_i,
+                        len(filenames_embedding))
+            file_stats.to_parquet(feature.get_stats_filename(filename_scans),
+                                  index=False)
+            scans, embeddings = embedding_stream.get_embeddings(
+                filename_encodings, file_scans)
+            if scans is not None:
+                np.save(filename_embedding, embeddings)
+                scans['dataset'] = dataset
+                scans[['dataset', 'filename', 'scan', 'charge', 'mz']]\
+                    .to_parquet(filename_scans, index=False)
+    finally:
+        embedding_stream.close()
+
+
+def _get_num_gpus() -> int:
+    """
+    Get the number of GPUs to embed spectra using Keras, depending on the
+    configured inference engine (see `config.inference_engine`).
+
+    TensorFlow is only imported to find the available GPUs if the Keras
+    inference engine can be used, and it's imported in a separate process so
+    that worker processes can still be forked safely afterwards (see
+    `feature.get_worker_pool`).
+
+    Returns
+    -------
+    int
+        The number of GPUs used by Keras, or 0 if spectra should be embedded on
+        the CPU using NumPy (see `inference.NumpyEmbedder`).
+
+    Raises
+    ------
+    ValueError
+        If the configured inference engine is unknown.
+    RuntimeError
+        If the Keras inference engine is configured but no GPU is available.
+    """
+    if config.inference_engine == 'numpy':
+        return 0
+    elif config.inference_engine not in ('auto', 'keras'):
+        raise ValueError(
+            f'Unknown inference engine {config.inference_engine}')
+    with multiprocessing.Pool(1) as pool:
+        num_gpus = pool.apply(_get_num_gpus_keras)
+    if num_gpus is None:
+        if config.inference_engine == 'keras':
+            raise ImportError('Keras is required for the Keras inference '
+                              'engine')
+        num_gpus = 0
+    if num_gpus == 0 and config.inference_engine == 'keras':
+        raise RuntimeError('No GPU found')
+    return num_gpus
+
+
+def _get_num_gpus_keras() -> Optional[int]:
+    """
+    Get the number of GPUs that are available to Keras.
+
+    Returns
+    -------
+    Optional[int]
+        The number of GPUs that are available to Keras, or None if Keras can't
+        be imported.
+    """
+    try:
+        from gleams.nn import embedder
+    except ImportError:
+        return None
+    return embedder._get_num_gpus()
+
+
+def _get_num_workers(num_gpus: int) -> Tuple[int, int]:
+    """
+    Get the number of feature conversion worker processes and embedding
+    threads to embed spectra.
+
+    When spectra are embedded on the CPU, the CPUs that aren't used by the
+    feature conversion worker processes are used by the embedding threads
+    (see `config.inference_feature_processes` and `config.inference_threads`).
 
     Parameters
     ----------
-    encodings : List[np.ndarray]
-        A list of encoding arrays to be embedded.
-    batch_size : int
-        The number of encodings to embed simultaneously.
-    model_filename : str
-        The GLEAMS model filename.
+    num_gpus : int
+        The number of GPUs to embed spectra using Keras, or 0 to embed spectra
+        on the CPU using NumPy.
+
+    Returns
+    -------
+    Tuple[int, int]
+        The number of feature conversion worker processes and the number of
+        threads of the NumPy engine (0 when embedding spectra using Keras).
+    """
+    num_cpus = os.cpu_count()
+    if num_gpus > 0:
+        return num_cpus, 0
+    num_processes = config.inference_feature_processes
+    num_threads = config.inference_threads
+    if num_processes is None and num_threads is not None:
+        num_processes = max(1, num_cpus - num_threads)
+    elif num_processes is None:
+        # Embedding spectra takes considerably longer than converting them to
+        # features.
+        num_processes = max(1, num_cpus // 4)
+    if num_threads is None:
+        num_threads = max(1, num_cpus - num_processes)
+    return num_processes, num_threads
+
+
+def _get_dataset_feature_filenames(dataset: str) -> Tuple[str, str, str]:
+    """
+    Get the file names of the features of a dataset that were generated for
+    training (see `feature.convert_peaks_to_features`).
+
+    Parameters
+    ----------
+    dataset : str
+        The dataset.
+
+    Returns
+    -------
+    Tuple[str, str, str]
+        The file names of the dense features, the fragment features, and the
+        feature index.
+    """
+    filename_encodings = os.path.join(
+        os.environ['GLEAMS_HOME'], 'data', 'feature', 'dataset',
+        f'{dataset}.npy')
+    return (filename_encodings,
+            feature.get_fragment_filename(filename_encodings),
+            filename_encodings.replace('.npy', '.parquet'))
+
+
+def _get_feature_rows(dataset: str, enc: encoder.MultipleEncoder)\
+        -> Optional[pd.DataFrame]:
+    """
+    Get the spectra in the training features of the given dataset that can be
+    reused.
+
+    Training features can only be reused if they were generated by an encoder
+    with the same settings and reference spectra as the given encoder, and
+    only for peak files that didn't change since (see
+    `feature.get_feature_index_keys`).
+
+    Parameters
+    ----------
+    dataset : str
+        The dataset.
+    enc : encoder.MultipleEncoder
+        The MultipleEncoder used to convert the remaining spectra to features.
+
+    Returns
+    -------
+    Optional[pd.DataFrame]
+        A DataFrame with the peak file name, scan number, and row in the
+        feature files of each reusable spectrum, or None if no reusable
+        training features exist for the dataset.
+    """
+    filename_index = _get_dataset_feature_filenames(dataset)[2]
+    if not all([os.path.isfile(filename) for filename in
+                _get_dataset_feature_filenames(dataset)]):
+        return None
+    encoder_key, file_keys = feature.get_feature_index_keys(filename_index)
+    if encoder_key != cache.get_encoder_key(enc):
+        logger.info('Training features of dataset %s were generated with a '
+                    'different encoder, all spectra are converted to features '
+                    'again', dataset)
+        return None
+    feature_rows = pd.read_parquet(filename_index,
+                                   columns=['filename', 'scan'])
+    feature_rows['row'] = np.arange(len(feature_rows))
+    is_reused = {}
+    for filename in feature_rows['filename'].unique():
+        try:
+            is_reused[filename] = (
+                file_keys.get(filename) == cache.get_file_key(os.path.join(
+                    os.environ['GLEAMS_HOME'], 'data', 'peak', dataset,
+                    filename)))
+        except OSError:
+            is_reused[filename] = False
+        if not is_reused[filename]:
+            logger.debug('Peak file %s/%s changed since its training features '
+                         'were generated, all its spectra are converted to '
+                         'features again', dataset, filename)
+    return feature_rows[feature_rows['filename'].map(is_reused).values]
+
+
+def _get_reused_features(dataset: str, filename: str,
+                         feature_rows: pd.DataFrame)\
+        -> Tuple[Optional[pd.DataFrame], Optional[pd.DataFrame]]:
+    """
+    Split the spectra in a peak file in spectra with training features that
+    can be reused and spectra that need to be converted to features.
+
+    Parameters
+    ----------
+    dataset : str
+        The peak file's dataset.
     filename : str
-        File name to store the embedded encodings.
+        The peak file name.
+    feature_rows : pd.DataFrame
+        The spectra in the training features of the dataset (see
+        `_get_feature_rows`).
+
+    Returns
+    -------
+    Tuple[Optional[pd.DataFrame], Optional[pd.DataFrame]]
+        A tuple of length 2 containing: a DataFrame indexed by the scan
+        numbers of the spectra that need to be converted to features (see
+        `feature.map_peaks_to_features`), and the peak file name, scan number,
+        precursor charge, precursor m/z, and row in the feature files of the
+        spectra with reusable features. If no features can be reused, both
+        elements of the tuple are None and all spectra need to be converted.
     """
-    logger.debug('Load the stored GLEAMS neural network')
-    emb = embedder.Embedder(
-        config.num_precursor_features, config.num_fragment_features,
-        config.num_ref_spectra, config.lr, model_filename)
-    emb.load()
-    logger.debug('Embed the spectrum encodings and save to file %s', filename)
-    encodings_generator = data_generator.EncodingsSequence(
-        encodings, batch_size, _get_feature_split())
-    np.save(filename, np.vstack(emb.embed(encodings_generator)))
-    # FIXME: Avoid Keras memory leak.
-    #        Possible issue: https://github.com/keras-team/keras/issues/13118
-    K.clear_session()
+    file_rows = feature_rows[feature_rows['filename'] == filename]
+    if len(file_rows) == 0:
+        return None, None
+    # The scan numbers of MGF files (and spectrum stores converted from them)
+    # in the spectrum index are the spectra's positions in the file, which
+    # don't match the scan numbers of the training features (see
+    # `feature._get_preprocessed_batches`).
+    if ms_io.get_file_format(filename) in ('mgf', 'spec'):
+        return None, None
+    try:
+        spectrum_info = ms_io.get_spectrum_info(os.path.join(
+            os.environ['GLEAMS_HOME'], 'data', 'peak', dataset, filename))
+    except (OSError, ValueError) as e:
+        logger.warning('Failed to read the spectra in peak file %s/%s, '
+                       'training features are not reused: %s', dataset,
+                       filename, e)
+        return None, None
+    if spectrum_info is None:
+        return None, None
+    is_reused = spectrum_info['scan'].isin(file_rows['scan']).values
+    metadata_file = pd.DataFrame(index=pd.Index(
+        spectrum_info['scan'].values[~is_reused], name='scan'))
+    reused_scans = file_rows.merge(
+        spectrum_info[is_reused].rename(columns={
+            'precursor_charge': 'charge', 'precursor_mz': 'mz'}),
+        on='scan')
+    reused_scans['charge'] = reused_scans['charge'].astype(np.int64)
+    return metadata_file, reused_scans
+
+
+def _load_dataset_features(dataset: str)\
+        -> Tuple[np.ndarray, shard.CsrShard]:
+    """
+    Memory-map the training features of the given dataset.
+
+    Parameters
+    ----------
+    dataset : str
+        The dataset.
+
+    Returns
+    -------
+    Tuple[np.ndarray, shard.CsrShard]
+        The memory-mapped dense features and fragment features.
+    """
+    filename_encodings, filename_fragments, _ = \
+        _get_dataset_feature_filenames(dataset)
+    return (np.load(filename_encodings, mmap_mode='r'),
+            shard.CsrShard(filename_fragments))
+
+
+def _get_row_ranges(rows: np.ndarray) -> List[Tuple[int, int]]:
+    """
+    Split the given rows in ranges of consecutive rows.
+
+    Parameters
+    ----------
+    rows : np.ndarray
+        The rows.
+
+    Returns
+    -------
+    List[Tuple[int, int]]
+        The start and stop of each range of consecutive rows, in the order of
+        the given rows.
+    """
+    splits = np.flatnonzero(np.diff(rows) != 1) + 1
+    starts = np.concatenate([[0], splits])
+    stops = np.concatenate([splits, [len(rows)]])
+    return [(int(rows[start]), int(rows[stop - 1]) + 1)
+            for start, stop in zip(starts, stops)]
+
+
+class _EmbeddingStream:
+    """
+    Embed converted spectra from feature buffers while they're being written,
+    using a single GLEAMS model for all datasets.
+
+    Spectra are embedded using Keras on the GPU(s) or using NumPy on the CPU.
+    Keras is only imported when it's used.
+    """
+
+    def __init__(self, model_filename: str, enc: encoder.MultipleEncoder,
+                 num_gpus: int, num_threads: int,
+                 reused_features: Dict[str, Tuple[str, List[pd.DataFrame]]]):
+        """
+        Instantiate the EmbeddingStream.
+
+        Parameters
+        ----------
+        model_filename : str
+            The GLEAMS model filename.
+        enc : encoder.MultipleEncoder
+            The MultipleEncoder used to convert spectra to features.
+        num_gpus : int
+            The number of GPUs to embed spectra using Keras, or 0 to embed
+            spectra on the CPU using NumPy.
+        num_threads : int
+            The number of threads to embed spectra on the CPU using NumPy.
+        reused_features : Dict[str, Tuple[str, List[pd.DataFrame]]]
+            For each feature buffer file name, the dataset and the spectra with
+            training features that are reused (see `_get_reused_features`).
+        """
+        self.model_filename = model_filename
+        self.enc = enc
+        self.num_gpus = num_gpus
+        self.num_threads = num_threads
+        self.reused_features = reused_features
+        self.emb = None
+        # Embeddings per feature buffer, peak file, and part of the peak file.
+        self.embeddings = collections.defaultdict(
+            lambda: collections.defaultdict(dict))
+        # Spectra and embeddings of the reused training features per feature
+        # buffer.
+        self.reused_embeddings = {}
+
+    def embed_part(self, filename_encodings: str, part_i: int,
+                   result: Tuple[str, pd.DataFrame,
+                                 List[Tuple[int, int, np.ndarray]]]) -> None:
+        """
+        Embed the features of a converted peak file (part) (see
+        `feature.map_peaks_to_features`).
+
+        The reused training features of the feature buffer's dataset are
+        embedded first if this hasn't happened yet.
+
+        Parameters
+        ----------
+        filename_encodings : str
+            The feature buffer file name.
+        part_i : int
+            The index of the converted part of the peak file.
+        result : Tuple[str, pd.DataFrame, List[Tuple[int, int, np.ndarray]]]
+            The peak file name, information about the converted spectra, and
+            the positions of their features in the feature buffer (see
+            `feature._peaks_to_features`).
+        """
+        self._embed_reused(filename_encodings)
+        filename, _, positions = result
+        self.embeddings[filename_encodings][filename][part_i] = self._embed(
+            *feature.read_buffer(filename_encodings, self.enc, positions))
+
+    def get_embeddings(self, filename_encodings: str,
+                       file_scans: List[Tuple[str, pd.DataFrame]])\
+            -> Tuple[Optional[pd.DataFrame], Optional[np.ndarray]]:
+        """
+        Get the embeddings of all spectra in a completed feature buffer.
+
+        Parameters
+        ----------
+        filename_encodings : str
+            The feature buffer file name.
+        file_scans : List[Tuple[str, pd.DataFrame]]
+            The peak file names and information about their converted spectra
+            (see `feature.map_peaks_to_features`).
+
+        Returns
+        -------
+        Tuple[Optional[pd.DataFrame], Optional[np.ndarray]]
+            The peak file name, scan number, precursor charge, and precursor
+            m/z of the embedded spectra, and their embeddings, or None if no
+            spectra were embedded.
+        """
+        self._embed_reused(filename_encodings)
+        file_embeddings = self.embeddings.pop(filename_encodings, {})
+        scans, embeddings = [], []
+        for filename, dataset_file_scans in file_scans:
+            dataset_file_scans['filename'] = filename
+            scans.append(dataset_file_scans)
+            # The spectra of peak files that were split are ordered by part
+            # (see `feature._merge_parts`).
+            embeddings.extend([embeddings_part for _, embeddings_part in
+                               sorted(file_embeddings[filename].items())])
+        if filename_encodings in self.reused_embeddings:
+            reused_scans, reused_embeddings = \
+                self.reused_embeddings.pop(filename_encodings)
+            scans.append(reused_scans)
+            embeddings.append(reused_embeddings)
+        if len(scans) == 0:
+            return None, None
+        return (pd.concat(scans, ignore_index=True, sort=False, copy=False),
+                np.vstack(embeddings))
+
+    def close(self) -> None:
+        """
+        Release the GLEAMS model.
+        """
+        if self.emb is not None and self.num_gpus > 0:
+            from keras import backend as K
+            # FIXME: Avoid Keras memory leak.
+            #        Possible issue:
+            #        https://github.com/keras-team/keras/issues/13118
+            K.clear_session()
+        self.emb = None
+
+    def _embed_reused(self, filename_encodings: str) -> None:
+        """
+        Embed the reused training features of the given feature buffer's
+        dataset, if this hasn't happened yet.
+
+        Parameters
+        ----------
+        filename_encodings : str
+            The feature buffer file name.
+        """
+        if filename_encodings not in self.reused_features:
+            return
+        dataset, reused_scans = self.reused_features.pop(filename_encodings)
+        if len(reused_scans) == 0:
+            return
+        reused_scans = pd.concat(reused_scans, ignore_index=True)
+        logger.debug('Reuse %d training features for dataset %s',
+                     len(reused_scans), dataset)
+        feature_encodings, feature_fragments = _load_dataset_features(dataset)
+        encodings, fragments = [], []
+        for start, stop in _get_row_ranges(reused_scans['row'].values):
+            encodings.append(feature_encodings[start:stop])
+            fragments.append(feature_fragments.get_rows(start, stop))
+        self.reused_embeddings[filename_encodings] = (
+            reused_scans, self._embed(shard.ShardedArray(encodings),
+                                      shard.ShardedArray(fragments)))
+
+    def _embed(self, encodings: Union[np.ndarray, shard.ShardedArray],
+               fragments: Union[ss.csr_matrix, shard.ShardedArray])\
+            -> np.ndarray:
+        """
+        Embed the given encodings.
+
+        The GLEAMS model is loaded when it's used for the first time, so that
+        loading it overlaps with converting the first peak files.
+
+        Parameters
+        ----------
+        encodings : Union[np.ndarray, shard.ShardedArray]
+            The dense encodings (precursor and reference spectra features) to
+            be embedded.
+        fragments : Union[ss.csr_matrix, shard.ShardedArray]
+            The sparse fragment encodings to be embedded.
+
+        Returns
+        -------
+        np.ndarray
+            The embeddings of the given encodings.
+        """
+        if self.emb is None:
+            logger.debug('Load the stored GLEAMS neural network')
+            if self.num_gpus > 0:
+                from gleams.nn import embedder
+                self.emb = embedder.Embedder(
+                    config.num_precursor_features,
+                    config.num_fragment_features, config.num_ref_spectra,
+                    config.lr, self.model_filename)
+            else:
+                self.emb = inference.NumpyEmbedder(
+                    config.num_precursor_features,
+                    config.num_fragment_features, config.num_ref_spectra,
+                    self.model_filename, self.num_threads)
+            self.emb.load()
+        if self.num_gpus == 0:
+            return self.emb.embed(encodings, fragments)
+        from gleams.nn import data_generator
+        encodings_generator = data_generator.EncodingsSequence(
+            encodings, fragments, config.batch_size * self.num_gpus,
+            config.num_precursor_features)
+        return np.vstack(self.emb.embed(encodings_generator))
 
 
 def combine_embeddings(metadata_filename: str) -> None:
     """
-    Combine embedding files for multiple datasets into a single embedding file.
+    Combine embedding files for multiple datasets into a sharded embedding
+    store.
+
+    The per-dataset embedding files are not copied. Instead a manifest refers
+    to them in order (see `shard.write_manifest`), which can be read using
+    `shard.load`. The embedding indexes are combined in a single Parquet file.
 
-    If the combined embedding file already exists it will _not_ be recreated.
+    If the combined embedding manifest already exists it will _not_ be
+    recreated.
 
     Parameters
     ----------
@@ -212,14 +688,14 @@ def combine_embeddings(metadata_filename: str) -> None:
     embed_dir = os.path.join(os.environ['GLEAMS_HOME'], 'data', 'embed')
     embed_filename = os.path.join(embed_dir, os.path.splitext(
         os.path.basename(metadata_filename))[0].replace('metadata_', 'embed_'))
-    if (os.path.isfile(f'{embed_filename}.npy') and
+    if (os.path.isfile(f'{embed_filename}{shard.manifest_ext}') and
             os.path.isfile(f'{embed_filename}.parquet')):
         return
     datasets = pd.read_parquet(
         metadata_filename, columns=['dataset'])['dataset'].unique()
     logger.info('Combine embeddings for metadata file %s containing %d '
                 'datasets', metadata_filename, len(datasets))
-    embeddings, indexes = [], []
+    shard_filenames, indexes = [], []
     for i, dataset in enumerate(datasets, 1):
         logger.debug('Append dataset %s [%3d/%3d]', dataset, i, len(datasets))
         dataset_embeddings_filename = os.path.join(
@@ -231,7 +707,8 @@ def combine_embeddings(metadata_filename: str) -> None:
             logger.warning('Missing embeddings for dataset %s, skipping...',
                            dataset)
         else:
-            embeddings.append(np.load(dataset_embeddings_filename))
+            shard_filenames.append(dataset_embeddings_filename)
             indexes.append(pq.read_table(dataset_index_filename))
-    np.save(f'{embed_filename}.npy', np.vstack(embeddings))
     pq.write_table(pa.concat_tables(indexes), f'{embed_filename}.parquet')
+    shard.write_manifest(f'{embed_filename}{shard.manifest_ext}',
+                         shard_filenames)
@@ -0,0 +1,137 @@
+"""
+Utilities shared by the tests and the benchmarks.
+"""
+from typing import Iterator
+
+import h5py
+import numpy as np
+from pyteomics import mgf
+from spectrum_utils.spectrum import MsmsSpectrum
+
+from gleams import config
+from gleams.nn import inference
+
+
+def get_mgf_spectra_pyteomics(filename: str) -> Iterator[MsmsSpectrum]:
+    """
+    Get the MS/MS spectra from the given MGF file using Pyteomics, which is
+    the reference for the native MGF parser (see `mgf_io.get_spectra`).
+
+    Spectra without a precursor charge are skipped.
+
+    Parameters
+    ----------
+    filename : str
+        The MGF file name.
+
+    Returns
+    -------
+    Iterator[MsmsSpectrum]
+        An iterator over the spectra in the given file.
+    """
+    with mgf.MGF(filename) as f_in:
+        for spectrum_dict in f_in:
+            params = spectrum_dict['params']
+            if 'charge' not in params:
+                continue
+            yield MsmsSpectrum(
+                str(params['title']), float(params['pepmass'][0]),
+                int(params['charge'][0]), spectrum_dict['m/z array'],
+                spectrum_dict['intensity array'], None,
+                float(params['rtinseconds']))
+
+
+def write_random_weights(filename: str, num_precursor_features: int,
+                         num_fragment_features: int,
+                         num_ref_spectra_features: int) -> None:
+    """
+    Write random weights of the embedder model in the Keras HDF5 format
+    without Keras (see `inference.NumpyEmbedder`).
+
+    The kernels are initialized as by Keras (He uniform) and the biases are
+    drawn from a normal distribution.
+
+    Parameters
+    ----------
+    filename : str
+        The model weights file name.
+    num_precursor_features : int
+        The number of precursor features.
+    num_fragment_features : int
+        The number of fragment features.
+    num_ref_spectra_features : int
+        The number of reference spectra features.
+    """
+    rng = np.random.RandomState(1)
+    shapes = {'precursor_dense_32': (num_precursor_features, 32),
+              'precursor_dense_5': (32, 5)}
+    length, channels = num_fragment_features, 1
+    for block_i, (num_convs, filters) in enumerate(
+            zip(inference._fragment_blocks, (30, 60, 120, 240, 240)), 1):
+        for conv_i in range(1, num_convs + 1):
+            shapes[inference._get_fragment_layer(block_i, conv_i)] = \
+                (3, channels, filters)
+            length, channels = length - 2, filters
+        length = (length - 1) // 2 + 1
+    shapes['ref_spectra_dense_750'] = (num_ref_spectra_features, 750)
+    shapes['ref_spectra_output'] = (750, 250)
+    shapes['output'] = (5 + length * channels + 250, config.embedding_size)
+    with h5py.File(filename, 'w') as f_out:
+        f_out.attrs['layer_names'] = [layer.encode() for layer in shapes]
+        for layer, shape in shapes.items():
+            weight_names = f'{layer}/kernel:0', f'{layer}/bias:0'
+            group = f_out.create_group(layer)
+            group.attrs['weight_names'] = [name.encode()
+                                           for name in weight_names]
+            limit = np.sqrt(6 / np.prod(shape[:-1]))
+            group[weight_names[0]] = rng.uniform(
+                -limit, limit, shape).astype(np.float32)
+            group[weight_names[1]] = rng.normal(
+                0, 0.05, shape[-1]).astype(np.float32)
+
+
+def build_random_embedder(filename: str, num_precursor_features: int,
+                          num_fragment_features: int,
+                          num_ref_spectra_features: int):
+    """
+    Build the embedder model with random weights using Keras and save its
+    weights.
+
+    Keras initializes the biases to zero, so they're replaced by random
+    values as well to verify them.
+
+    Parameters
+    ----------
+    filename : str
+        The model weights file name.
+    num_precursor_features : int
+        The number of precursor features.
+    num_fragment_features : int
+        The number of fragment features.
+    num_ref_spectra_features : int
+        The number of reference spectra features.
+
+    Returns
+    -------
+    embedder.Embedder
+        The embedder with random weights.
+
+    Raises
+    ------
+    ImportError
+        If Keras isn't available.
+    """
+    # Keras is only imported when it's used.
+    from gleams.nn import embedder
+    emb = embedder.Embedder(
+        num_precursor_features, num_fragment_features,
+        num_ref_spectra_features, config.lr, filename)
+    emb.build()
+    rng = np.random.RandomState(1)
+    for layer in emb._get_embedder_model().layers:
+        weights = layer.get_weights()
+        if len(weights) == 2:
+            layer.set_weights([weights[0], rng.normal(
+                0, 0.05, weights[1].shape).astype(np.float32)])
+    emb.save()
+    return emb
@@ -10,9 +10,15 @@ setuptools.setup(
     license='Apache 2.0',
     packages=['gleams'],
     install_requires=[
+        'h5py',
         'keras',
         'numpy',
-        'pyteomics',
+        # The mzML and mzXML readers use the private
+        # `_get_info_smart` method of the Pyteomics readers to parse
+        # individual spectrum elements (see `mzml_io.get_spectra_at`), so
+        # only Pyteomics versions for which this was verified are allowed.
+        'pyteomics>=4.1.2,<5.1',
         'spectrum_utils',
+        'threadpoolctl',
         'tqdm']
 )
@@ -0,0 +1,6 @@
+import os
+import tempfile
+
+
+# The GLEAMS config requires the GLEAMS_HOME environment variable.
+os.environ.setdefault('GLEAMS_HOME', tempfile.mkdtemp(prefix='gleams_home_'))
@@ -0,0 +1,38 @@
+import os
+
+import pandas as pd
+from pyteomics import mgf
+
+from gleams import config
+from gleams.feature import feature
+from gleams.ms_io import mgf_io
+
+
+ref_spectra_filename = os.path.join(
+    os.path.dirname(__file__), os.pardir, 'data',
+    'gleams_reference_spectra.mgf')
+
+
+def test_convert_peaks_to_features_mgf_titles(tmp_path, monkeypatch):
+    # The metadata refers to MGF spectra by their title, which differs from
+    # the spectra's positions in the file.
+    monkeypatch.setenv('GLEAMS_HOME', str(tmp_path))
+    monkeypatch.setattr(config, 'ref_spectra_filename', ref_spectra_filename)
+    peak_dir = tmp_path / 'data' / 'peak' / 'dataset'
+    peak_dir.mkdir(parents=True)
+    spectra = list(mgf_io.get_spectra(ref_spectra_filename))[:50]
+    mgf.write([{'m/z array': spec.mz, 'intensity array': spec.intensity,
+                'params': {'title': str(1001 + i),
+                           'pepmass': spec.precursor_mz,
+                           'charge': spec.precursor_charge,
+                           'rtinseconds': spec.retention_time}}
+               for i, spec in enumerate(spectra)],
+              str(peak_dir / 'run.mgf'))
+    metadata_filename = str(tmp_path / 'metadata.parquet')
+    pd.DataFrame({'dataset': 'dataset', 'filename': 'run.mgf',
+                  'scan': [3, 7, 1005, 1020]})\
+        .to_parquet(metadata_filename, index=False)
+    feature.convert_peaks_to_features(metadata_filename)
+    index = pd.read_parquet(
+        str(tmp_path / 'data' / 'feature' / 'dataset' / 'dataset.parquet'))
+    assert index['scan'].tolist() == [1005, 1020]
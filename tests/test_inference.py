@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+import scipy.sparse as ss
+
+from gleams import config, testing
+from gleams.nn import inference
+
+
+def _get_encodings(num_spectra):
+    """
+    Random dense encodings and sparse fragment encodings with up to 150
+    peaks per spectrum, including spectra without fragment peaks.
+    """
+    rng = np.random.RandomState(0)
+    precursor = (rng.random_sample(
+        (num_spectra, config.num_precursor_features)) < 0.2)
+    ref_spectra = rng.uniform(0, 0.3, (num_spectra, config.num_ref_spectra))
+    fragments = ss.lil_matrix((num_spectra, config.num_fragment_features),
+                              dtype=np.float32)
+    for i in range(num_spectra):
+        num_peaks = rng.randint(0, 151) if i % 10 != 0 else 0
+        columns = rng.choice(config.num_fragment_features, num_peaks, False)
+        fragments[i, columns] = rng.uniform(0, 0.3, num_peaks)
+    return (np.hstack([precursor, ref_spectra]).astype(np.float32),
+            fragments.tocsr())
+
+
+@pytest.mark.parametrize('sparse_max_fraction', [0.5, 0.9, 1.])
+def test_numpy_embedder_sparse(tmp_path, monkeypatch, sparse_max_fraction):
+    filename = str(tmp_path / 'gleams.hdf5')
+    testing.write_random_weights(
+        filename, config.num_precursor_features,
+        config.num_fragment_features, config.num_ref_spectra)
+    emb = inference.NumpyEmbedder(
+        config.num_precursor_features, config.num_fragment_features,
+        config.num_ref_spectra, filename)
+    emb.load()
+    encodings, fragments = _get_encodings(100)
+    monkeypatch.setattr(config, 'inference_sparse_max_fraction', 0)
+    embeddings = emb.embed(encodings, fragments)
+    monkeypatch.setattr(config, 'inference_sparse_max_fraction',
+                        sparse_max_fraction)
+    np.testing.assert_allclose(emb.embed(encodings, fragments), embeddings,
+                               rtol=1e-4, atol=1e-4)
+
+
+def test_numpy_embedder_keras(tmp_path):
+    pytest.importorskip('gleams.nn.embedder')
+    filename = str(tmp_path / 'gleams.hdf5')
+    emb_keras = testing.build_random_embedder(
+        filename, config.num_precursor_features,
+        config.num_fragment_features, config.num_ref_spectra)
+    model = emb_keras._get_embedder_model()
+    emb_numpy = inference.NumpyEmbedder(
+        config.num_precursor_features, config.num_fragment_features,
+        config.num_ref_spectra, filename)
+    emb_numpy.load()
+    encodings, fragments = _get_encodings(100)
+    embeddings = model.predict(
+        [encodings[:, :config.num_precursor_features], fragments.toarray(),
+         encodings[:, config.num_precursor_features:]])
+    np.testing.assert_allclose(emb_numpy.embed(encodings, fragments),
+                               embeddings, rtol=1e-4, atol=1e-4)
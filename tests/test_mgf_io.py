@@ -0,0 +1,55 @@
+import os
+
+import numpy as np
+import pytest
+from pyteomics import mgf
+
+from gleams import testing
+from gleams.ms_io import mgf_io
+
+
+ref_spectra_filename = os.path.join(
+    os.path.dirname(__file__), os.pardir, 'data',
+    'gleams_reference_spectra.mgf')
+
+
+def _write_synthetic_mgf(filename):
+    """
+    Random spectra including spectra without a precursor charge or without
+    peaks.
+    """
+    rng = np.random.RandomState(0)
+    spectra = []
+    for i in range(100):
+        num_peaks = rng.randint(0, 200) if i % 10 != 0 else 0
+        params = {'title': f'spectrum_{i}',
+                  'pepmass': rng.uniform(300, 1500),
+                  'rtinseconds': rng.uniform(0, 3600)}
+        if i % 7 != 0:
+            params['charge'] = rng.randint(1, 6)
+        spectra.append({'m/z array': rng.uniform(100, 1500, num_peaks),
+                        'intensity array': rng.exponential(1e4, num_peaks),
+                        'params': params})
+    mgf.write(spectra, filename)
+
+
+@pytest.mark.parametrize('synthetic', [False, True])
+def test_get_spectra_pyteomics(tmp_path, synthetic):
+    if synthetic:
+        filename = str(tmp_path / 'synthetic.mgf')
+        _write_synthetic_mgf(filename)
+    else:
+        filename = ref_spectra_filename
+    spectra_pyteomics = list(testing.get_mgf_spectra_pyteomics(filename))
+    spectra_native = list(mgf_io.get_spectra(filename))
+    assert len(spectra_native) == len(spectra_pyteomics)
+    for spec_native, spec_pyteomics in zip(spectra_native,
+                                           spectra_pyteomics):
+        assert spec_native.identifier == spec_pyteomics.identifier
+        assert spec_native.precursor_mz == spec_pyteomics.precursor_mz
+        assert (spec_native.precursor_charge ==
+                spec_pyteomics.precursor_charge)
+        assert spec_native.retention_time == spec_pyteomics.retention_time
+        np.testing.assert_array_equal(spec_native.mz, spec_pyteomics.mz)
+        np.testing.assert_array_equal(spec_native.intensity,
+                                      spec_pyteomics.intensity)
@@ -0,0 +1,127 @@
+import os
+
+import numpy as np
+import pytest
+from spectrum_utils.spectrum import MsmsSpectrum
+
+from gleams import config
+from gleams.feature import spectrum
+from gleams.ms_io import mgf_io
+from gleams.ms_io.spectrum_batch import SpectrumBatch
+
+
+ref_spectra_filename = os.path.join(
+    os.path.dirname(__file__), os.pardir, 'data',
+    'gleams_reference_spectra.mgf')
+
+
+def _get_synthetic_spectra(num_spectra):
+    """
+    Random spectra with peaks outside the m/z range, with tied intensities,
+    and with peaks near the precursor m/z.
+    """
+    rng = np.random.RandomState(0)
+    spectra = []
+    for i in range(num_spectra):
+        num_peaks = rng.randint(0, 600)
+        mz = rng.uniform(20, 2600, num_peaks)
+        if i % 4 == 0:
+            intensity = rng.randint(1, 20, num_peaks).astype(np.float64)
+        elif i % 4 == 1:
+            intensity = rng.uniform(0, 1e4, num_peaks)
+        elif i % 4 == 2:
+            intensity = np.round(rng.exponential(100, num_peaks))
+        else:
+            intensity = np.full(num_peaks, 5.)
+        precursor_mz, charge = rng.uniform(300, 1500), rng.randint(1, 6)
+        if num_peaks >= 3 and i % 3 == 0:
+            mz[:3] = [(precursor_mz - 1.0072766) * charge / c + 1.0072766 +
+                      rng.uniform(-2.5, 2.5) for c in (1, 2, 3)]
+        spectra.append(MsmsSpectrum(str(i), precursor_mz, charge, mz,
+                                    intensity, None, 1.))
+    return spectra
+
+
+@pytest.fixture(scope='module')
+def spectra():
+    return (list(mgf_io.get_spectra(ref_spectra_filename)) +
+            _get_synthetic_spectra(2000))
+
+
+@pytest.mark.parametrize('scaling', ['sqrt', 'log', 'rank', None])
+@pytest.mark.parametrize('remove_precursor_tolerance', [2, None])
+@pytest.mark.parametrize('max_peaks_used', [150, 50])
+def test_preprocess_batch(spectra, monkeypatch, scaling,
+                          remove_precursor_tolerance, max_peaks_used):
+    monkeypatch.setattr(config, 'scaling', scaling)
+    monkeypatch.setattr(config, 'remove_precursor_tolerance',
+                        remove_precursor_tolerance)
+    monkeypatch.setattr(config, 'max_peaks_used', max_peaks_used)
+    batch = spectrum.preprocess_batch(
+        SpectrumBatch.from_spectra(spectra), config.fragment_mz_min,
+        config.fragment_mz_max)
+    assert batch.is_processed
+    for i, spec in enumerate(spectra):
+        spec = MsmsSpectrum(spec.identifier, spec.precursor_mz,
+                            spec.precursor_charge, spec.mz.copy(),
+                            spec.intensity.copy())
+        spec.is_processed = False
+        spec = spectrum.preprocess(spec, config.fragment_mz_min,
+                                   config.fragment_mz_max)
+        assert batch.is_valid[i] == spec.is_valid
+        mz, intensity = batch.get_peaks(i)
+        if spec.is_valid:
+            np.testing.assert_array_equal(mz, spec.mz)
+            np.testing.assert_array_equal(intensity, spec.intensity)
+        else:
+            assert len(mz) == 0
+
+
+def _get_dot_spectra():
+    """
+    Preprocessed reference spectra and synthetic spectra with duplicate m/z
+    values and tied intensities.
+    """
+    batch = spectrum.preprocess_batch(
+        SpectrumBatch.from_spectra(mgf_io.get_spectra(ref_spectra_filename)),
+        config.fragment_mz_min, config.fragment_mz_max)
+    spectra = [batch.get_peaks(i) for i in np.nonzero(batch.is_valid)[0]]
+    rng = np.random.RandomState(1)
+    for i in range(200):
+        mz = np.round(rng.uniform(100, 1500, rng.randint(1, 100)), 1)
+        mz = np.sort(np.concatenate([mz, mz[:5]])).astype(np.float32)
+        intensity = rng.randint(1, 4, len(mz)).astype(np.float32)
+        spectra.append((mz, intensity / np.linalg.norm(intensity)))
+    return spectra
+
+
+@pytest.mark.parametrize('fragment_mz_tol', [0.02, 0.05, 1.])
+def test_dot_index(fragment_mz_tol):
+    spectra = _get_dot_spectra()
+    refs = spectra[::2]
+    offsets = np.zeros(len(refs) + 1, np.int64)
+    np.cumsum([len(mz) for mz, _ in refs], out=offsets[1:])
+    index = spectrum.get_peak_index(
+        np.concatenate([mz for mz, _ in refs]),
+        np.concatenate([intensity for _, intensity in refs]), offsets,
+        fragment_mz_tol)
+    scores = np.vstack([spectrum.dot_index(mz, intensity, *index,
+                                           fragment_mz_tol)
+                        for mz, intensity in spectra])
+    # The reference spectra are the first spectra in the dot product (see
+    # `encoder.ReferenceSpectraEncoder`).
+    scores_dot = np.asarray(
+        [[spectrum.dot(ref_mz, ref_intensity, mz, intensity,
+                       fragment_mz_tol)
+          for ref_mz, ref_intensity in refs]
+         for mz, intensity in spectra], np.float32)
+    np.testing.assert_array_equal(scores, scores_dot)
+
+    query_offsets = np.zeros(len(spectra) + 1, np.int64)
+    np.cumsum([len(mz) for mz, _ in spectra], out=query_offsets[1:])
+    scores_batch = spectrum.dot_index_batch(
+        np.concatenate([mz for mz, _ in spectra]),
+        np.concatenate([intensity for _, intensity in spectra]),
+        query_offsets, *index, fragment_mz_tol,
+        np.zeros((len(spectra), len(refs)), np.float32))
+    np.testing.assert_array_equal(scores_batch, scores)
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+from pyteomics import mgf
+
+from gleams.ms_io import ms_io, store_io
+from gleams.ms_io.spectrum_batch import SpectrumBatch
+
+
+@pytest.mark.parametrize('titles', [['101', '102', '103', '104', '105'],
+                                    ['a', 'b', 'c', 'd', 'e']])
+def test_convert_mgf_scan_nrs(tmp_path, titles):
+    rng = np.random.RandomState(0)
+    spectra = []
+    for i, title in enumerate(titles):
+        params = {'title': title, 'pepmass': rng.uniform(300, 1500),
+                  'rtinseconds': float(i)}
+        # The second spectrum doesn't have a precursor charge and is skipped.
+        if i != 1:
+            params['charge'] = 2
+        spectra.append({'m/z array': np.sort(rng.uniform(100, 1500, 20)),
+                        'intensity array': rng.uniform(0, 1e4, 20),
+                        'params': params})
+    peak_filename = str(tmp_path / 'run.mgf')
+    mgf.write(spectra, peak_filename)
+    store_filename = store_io.convert(peak_filename)
+
+    info_peak = ms_io.get_spectrum_info(peak_filename)
+    info_peak = info_peak[info_peak['precursor_charge'] > 0]
+    info_store = ms_io.get_spectrum_info(store_filename)
+    np.testing.assert_array_equal(info_store['scan'], info_peak['scan'])
+    np.testing.assert_array_equal(
+        SpectrumBatch.from_spectra(ms_io.get_spectra(peak_filename)).scan,
+        info_store['scan'])
+    for scan_nrs in ([0], [1], [2], [0, 3, 4], [3, 101, 102]):
+        spectra_peak = list(ms_io.get_spectra(peak_filename, scan_nrs))
+        spectra_store = list(ms_io.get_spectra(store_filename, scan_nrs))
+        assert ([spec.identifier for spec in spectra_store] ==
+                [spec.identifier for spec in spectra_peak])
+        assert ([spec.scan for spec in spectra_store] ==
+                [spec.scan for spec in spectra_peak])